@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# Benchmark the bezier flattener against the old subdivideCubicPath()
+#
+# The old function needs Inkscape's bezmisc and cspsubdiv modules, so
+# point INKSCAPE_EXTENSIONS at Inkscape's share/extensions directory
+# (the usual locations are tried otherwise):
+#
+#   INKSCAPE_EXTENSIONS=/usr/share/inkscape/extensions \
+#       python benchmarks/bench_flatten.py --segments 20000
+#
+
+import copy
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+for d in [os.getenv("INKSCAPE_EXTENSIONS"),
+          "/usr/share/inkscape/extensions",
+          "/Applications/Inkscape.app/Contents/Resources/extensions",
+          "C:/Program Files/Inkscape/share/extensions"]:
+    if d and os.path.isdir(d):
+        sys.path.append(d)
+
+from bezmisc import beziersplitatt
+import cspsubdiv
+
+from muralizer_flatten import flatten_subpath
+
+
+def subdivideCubicPath( sp, flat, i=1 ):
+    """
+    The flattener muralizer.py used to use, kept here as the baseline.
+    (A modified version of cspsubdiv.cspsubdiv().)
+    """
+
+    while True:
+        while True:
+            if i >= len( sp ):
+                return
+
+            p0 = sp[i - 1][1]
+            p1 = sp[i - 1][2]
+            p2 = sp[i][0]
+            p3 = sp[i][1]
+
+            b = ( p0, p1, p2, p3 )
+
+            if cspsubdiv.maxdist( b ) > flat:
+                break
+
+            i += 1
+
+        one, two = beziersplitatt( b, 0.5 )
+        sp[i - 1][2] = one[1]
+        sp[i][0] = two[2]
+        p = [one[2], one[3], two[1]]
+        sp[i:1] = [p]
+
+
+def random_subpath(n, scale, seed):
+    """A wiggly cubicsuperpath subpath of [n] segments, like traced art"""
+    rnd = random.Random(seed)
+    x, y = 0.0, 0.0
+    sp = []
+    for i in xrange(n + 1):
+        x += rnd.uniform(-scale, scale)
+        y += rnd.uniform(-scale, scale)
+        c = [x + rnd.uniform(-scale, scale), y + rnd.uniform(-scale, scale)]
+        sp.append([[2*x - c[0], 2*y - c[1]], [x, y], c])
+    return sp
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--segments", type="int", default=5000,
+                      help="Cubic segments per path")
+    parser.add_option("--paths", type="int", default=3, help="Paths to time")
+    parser.add_option("--scale", type="float", default=50.0,
+                      help="Typical segment size (user units)")
+    parser.add_option("--smoothness", type="float", default=0.2)
+    (opts, args) = parser.parse_args()
+
+    t_old = 0.0
+    t_new = 0.0
+    n_nodes = 0
+    for k in xrange(opts.paths):
+        sp = random_subpath(opts.segments, opts.scale, k)
+
+        old_sp = copy.deepcopy(sp)
+        t0 = time.time()
+        subdivideCubicPath(old_sp, opts.smoothness)
+        t_old += time.time() - t0
+
+        t0 = time.time()
+        coords = flatten_subpath(sp, opts.smoothness)
+        t_new += time.time() - t0
+
+        # Same nodes out of both, barring closed-loop cubics (which the
+        # old code never split)
+        if len(coords) != 2*len(old_sp):
+            print("path %d: %d nodes from the old flattener, %d from the new" %
+                  (k, len(old_sp), len(coords)/2))
+        n_nodes += len(coords)/2
+
+    print("%d paths x %d segments -> %d nodes" % (opts.paths, opts.segments, n_nodes))
+    print("subdivideCubicPath: %8.3f s" % t_old)
+    print("flatten_subpath:    %8.3f s  (%.1fx)" % (t_new, t_old/max(t_new, 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
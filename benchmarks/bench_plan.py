@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+# Benchmark the planning pipeline on synthetic documents
+#
+# Generates a set of SVG workloads, plots each one through Muralizer
+# against a null serial device, and times the stages separately:
+#
+#   parse       reading the SVG into a document tree
+#   traverse    recursivelyTraverseSvg(): transforms, <use>, path parsing
+#   flatten     flatten_csp(), and turning basic shapes into points
+#   order       join_strokes() / order_strokes(), with --reorder / --join
+#   kinematics  go_to_area_batch() and friends, less what they emit
+#   emit        pen and move commands through the optimizer to the device
+#
+# Stage times are exclusive: time spent emitting a move isn't also
+# counted as kinematics.  With --workers, paths are flattened on a
+# process pool, and time waiting for the workers counts as traverse.
+# Results are written as JSON (--json), and a previous run can be
+# given with --compare to print the speedups.
+#
+# Like bench_flatten.py, this needs Inkscape's Python extension modules
+# (inkex, simpletransform, ...); point INKSCAPE_EXTENSIONS at them:
+#
+#   INKSCAPE_EXTENSIONS=/usr/share/inkscape/extensions \
+#       python benchmarks/bench_plan.py --json before.json
+#   ... change things ...
+#   python benchmarks/bench_plan.py --json after.json --compare before.json
+#
+
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+for d in [os.getenv("INKSCAPE_EXTENSIONS"),
+          "/usr/share/inkscape/extensions",
+          "/Applications/Inkscape.app/Contents/Resources/extensions",
+          "C:/Program Files/Inkscape/share/extensions"]:
+    if d and os.path.isdir(d):
+        sys.path.append(d)
+
+import muralizer
+import muralizer_pool
+import muralizer_shapes
+from muralizer_state import MuralizerState
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+STAGES = ("parse", "traverse", "flatten", "order", "kinematics", "emit")
+
+SHAPE_FUNCTIONS = ("rect_coords", "line_coords", "polyline_coords", "ellipse_coords")
+
+SVG_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:xlink="http://www.w3.org/1999/xlink"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     width="%(w)d" height="%(h)d" viewBox="0 0 %(w)d %(h)d">
+"""
+SVG_TAIL = "</svg>\n"
+
+# Workloads are drawn on a page of this many user units
+PAGE_W = 1000
+PAGE_H = 1500
+
+
+####################
+# Workload generators
+#
+# Each takes a Random and a size multiplier and returns a list of SVG
+# body lines.
+
+def gen_short_paths(rnd, scale):
+    """Lots of short cubic paths, like hatching or traced stipple"""
+    out = []
+    for i in xrange(int(20000*scale)):
+        x = rnd.uniform(0, PAGE_W)
+        y = rnd.uniform(0, PAGE_H)
+        d = ["M %.2f,%.2f" % (x, y)]
+        for k in xrange(3):
+            d.append("c %.2f,%.2f %.2f,%.2f %.2f,%.2f" %
+                     tuple(rnd.uniform(-4, 4) for j in xrange(6)))
+        out.append('<path id="p%d" d="%s"/>' % (i, " ".join(d)))
+    return out
+
+
+def gen_nested_groups(rnd, scale):
+    """Chains of deeply nested <g> transforms, a shape at every level"""
+    out = []
+    depth = 40
+    for c in xrange(int(150*scale)):
+        out.append('<g transform="translate(%.2f,%.2f)">' %
+                   (rnd.uniform(100, PAGE_W - 100), rnd.uniform(100, PAGE_H - 100)))
+        for k in xrange(depth):
+            out.append('<g transform="rotate(%.1f) scale(0.97) translate(2,1)">' %
+                       rnd.uniform(-20, 20))
+            out.append('<path d="M 0,0 L 20,0 L 20,10 Z"/>')
+        out.append("</g>"*(depth + 1))
+    return out
+
+
+def gen_use_clones(rnd, scale):
+    """A small motif cloned many times with <use>"""
+    out = ["<defs>", '<g id="motif">']
+    for k in xrange(12):
+        a = 2*math.pi*k/12
+        out.append('<path d="M 0,0 Q %.2f,%.2f %.2f,%.2f"/>' %
+                   (10*math.cos(a + 0.3), 10*math.sin(a + 0.3),
+                    15*math.cos(a), 15*math.sin(a)))
+    out += ["</g>", "</defs>"]
+
+    # Enough filler elements that finding the motif by id isn't free
+    for i in xrange(int(2000*scale)):
+        out.append('<rect id="r%d" x="%.1f" y="%.1f" width="3" height="3"/>' %
+                   (i, rnd.uniform(0, PAGE_W), rnd.uniform(0, PAGE_H)))
+    for i in xrange(int(2000*scale)):
+        out.append('<use id="u%d" xlink:href="#motif" x="%.1f" y="%.1f"/>' %
+                   (i, rnd.uniform(0, PAGE_W), rnd.uniform(0, PAGE_H)))
+    return out
+
+
+def gen_polylines(rnd, scale):
+    """A few very long polylines, like a plotted data series"""
+    out = []
+    for i in xrange(20):
+        n = int(10000*scale)
+        y0 = PAGE_H*(i + 0.5)/20
+        pts = []
+        for k in xrange(n):
+            x = PAGE_W*k/float(n)
+            y = y0 + 20*math.sin(k*0.05) + rnd.uniform(-2, 2)
+            pts.append("%.2f,%.2f" % (x, y))
+        out.append('<polyline points="%s"/>' % " ".join(pts))
+    return out
+
+
+def gen_circles(rnd, scale):
+    """Many circles and ellipses"""
+    out = []
+    for i in xrange(int(10000*scale)):
+        x = rnd.uniform(0, PAGE_W)
+        y = rnd.uniform(0, PAGE_H)
+        if i % 2:
+            out.append('<circle cx="%.2f" cy="%.2f" r="%.2f"/>' %
+                       (x, y, rnd.uniform(1, 30)))
+        else:
+            out.append('<ellipse cx="%.2f" cy="%.2f" rx="%.2f" ry="%.2f"/>' %
+                       (x, y, rnd.uniform(1, 30), rnd.uniform(1, 30)))
+    return out
+
+
+WORKLOADS = [
+    ("short_paths", gen_short_paths),
+    ("nested_groups", gen_nested_groups),
+    ("use_clones", gen_use_clones),
+    ("polylines", gen_polylines),
+    ("circles", gen_circles),
+]
+
+
+def write_workload(path, gen, scale, seed):
+    rnd = random.Random(seed)
+    body = gen(rnd, scale)
+    fd = open(path, "w")
+    fd.write(SVG_HEAD % {"w": PAGE_W, "h": PAGE_H})
+    fd.write("\n".join(body))
+    fd.write("\n" + SVG_TAIL)
+    fd.close()
+    return len(body)
+
+
+####################
+# Stage timing
+
+class StageTimer:
+    """Wraps functions so that time spent in them is charged to a stage
+
+    Times are exclusive: a timed call made from inside another timed
+    call is subtracted from the outer one.  Calls can also be counted
+    under a name.
+    """
+    def __init__(self):
+        self.totals = dict((s, 0.0) for s in STAGES)
+        self.counts = {}
+        self.stack = []
+
+    def wrap(self, stage, fn, count=None):
+        if count:
+            self.counts[count] = 0
+
+        def timed(*args, **kwargs):
+            if count:
+                self.counts[count] += 1
+            self.stack.append(0.0)
+            t0 = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                dt = time.time() - t0
+                inner = self.stack.pop()
+                self.totals[stage] += dt - inner
+                if self.stack:
+                    self.stack[-1] += dt
+        return timed
+
+    def patch(self, obj, name, stage, count=None):
+        setattr(obj, name, self.wrap(stage, getattr(obj, name), count))
+
+
+def plot_args(opts):
+    args = ['--tab="splash"',
+            "--canvasWidth=%g" % opts.canvasWidth,
+            "--canvasHeight=%g" % opts.canvasHeight,
+            "--streamWindow=%d" % opts.streamWindow,
+            "--optimizeCommands=%s" % (not opts.no_optimize),
+            "--reorderPaths=%s" % opts.reorder,
+            "--joinPaths=%s" % opts.join,
+            "--planWorkers=%d" % opts.workers]
+    if opts.smoothness is not None:
+        args.append("--smoothness=%g" % opts.smoothness)
+    return args
+
+
+def run_once(svg_path, opts):
+    """Plot one document against the null device; returns stage times
+    and counters"""
+    timer = StageTimer()
+
+    e = muralizer.Muralizer()
+    e.getoptions(plot_args(opts))
+
+    t0 = time.time()
+    e.parse(svg_path)
+    timer.totals["parse"] = time.time() - t0
+
+    e.ms = MuralizerState(options=e.options, serialPort=None)
+    e.svgWidth = e.ms.page_width()
+    e.svgHeight = e.ms.page_height()
+    e.svg = e.document.getroot()
+
+    saved = (muralizer_pool.flatten_csp, muralizer.join_strokes, muralizer.order_strokes)
+    muralizer_pool.flatten_csp = timer.wrap("flatten", muralizer_pool.flatten_csp)
+    for name in SHAPE_FUNCTIONS:
+        timer.patch(muralizer, name, "flatten")
+    muralizer.join_strokes = timer.wrap("order", muralizer.join_strokes)
+    muralizer.order_strokes = timer.wrap("order", muralizer.order_strokes)
+    for name in ("go_to_area_batch", "go_to_area", "batch_kinematics"):
+        timer.patch(e.ms, name, "kinematics")
+    for name in ("_move_to", "cmd_pen_up", "cmd_pen_down", "drain"):
+        timer.patch(e.ms, name, "emit")
+    # What actually reaches the device, after the optimizer
+    timer.patch(e.ms, "_emit_move", "emit", count="moves_sent")
+    timer.patch(e.ms, "_emit_pen", "emit", count="pens_sent")
+    if e.ms.optimizer:
+        e.ms.optimizer.emit_move = e.ms._emit_move
+        e.ms.optimizer.emit_pen = e.ms._emit_pen
+
+    # plot() is chatty on stderr
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, "w")
+    try:
+        t0 = time.time()
+        e.plot()
+        plot_s = time.time() - t0
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+        (muralizer_pool.flatten_csp, muralizer.join_strokes, muralizer.order_strokes) = saved
+        for name in SHAPE_FUNCTIONS:
+            setattr(muralizer, name, getattr(muralizer_shapes, name))
+
+    stages = timer.totals
+    stages["traverse"] = plot_s - sum(stages[s] for s in STAGES
+                                      if s not in ("parse", "traverse"))
+
+    result = {
+        "total_s": stages["parse"] + plot_s,
+        "stages": stages,
+        "paths": e.pathcount,
+        "nodes": e.nodeCount,
+    }
+    result.update(timer.counts)
+    return result
+
+
+def environment():
+    env = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": numpy and numpy.__version__ or None,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    try:
+        env["git"] = subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+            stderr=open(os.devnull, "w")).strip()
+    except Exception:
+        env["git"] = None
+    return env
+
+
+def print_result(out, name, r, baseline=None):
+    line = ["%-14s %8.3f s" % (name, r["total_s"])]
+    for s in STAGES:
+        line.append("%s %.3f" % (s, r["stages"][s]))
+    out.write("  ".join(line) + "\n")
+
+    if baseline and name in baseline.get("workloads", {}):
+        b = baseline["workloads"][name]
+        line = ["%-14s %7.2fx  " % ("  vs baseline", b["total_s"]/max(r["total_s"], 1e-9))]
+        for s in STAGES:
+            if b["stages"].get(s):
+                line.append("%s %.2fx" % (s, b["stages"][s]/max(r["stages"][s], 1e-9)))
+        out.write("  ".join(line) + "\n")
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--scale", type="float", default=1.0,
+                      help="Multiply the size of every workload")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="Runs per workload; the fastest is reported")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--only", action="append", default=[],
+                      help="Run just this workload (may be repeated)")
+    parser.add_option("--json", default=None,
+                      help="Write results here ('-' for stdout)")
+    parser.add_option("--compare", default=None,
+                      help="Earlier --json output to compare against")
+    parser.add_option("--keep", default=None,
+                      help="Write the generated SVGs to this directory and keep them")
+    parser.add_option("--canvasWidth", type="float", default=122)
+    parser.add_option("--canvasHeight", type="float", default=183)
+    parser.add_option("--smoothness", type="float", default=None)
+    parser.add_option("--streamWindow", type="int", default=0)
+    parser.add_option("--no-optimize", action="store_true", default=False)
+    parser.add_option("--reorder", action="store_true", default=False)
+    parser.add_option("--join", action="store_true", default=False)
+    parser.add_option("--workers", type="int", default=0,
+                      help="Flatten paths on this many worker processes")
+    (opts, args) = parser.parse_args()
+
+    baseline = None
+    if opts.compare:
+        baseline = json.load(open(opts.compare))
+
+    # Keep stdout clean for the JSON if it's going there
+    out = opts.json == "-" and sys.stderr or sys.stdout
+
+    workdir = opts.keep or tempfile.mkdtemp(prefix="muralizer-bench-")
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    results = {
+        "environment": environment(),
+        "settings": dict((k, v) for (k, v) in vars(opts).items()
+                         if k not in ("json", "compare", "keep")),
+        "workloads": {},
+    }
+    try:
+        for name, gen in WORKLOADS:
+            if opts.only and name not in opts.only:
+                continue
+
+            svg_path = os.path.join(workdir, name + ".svg")
+            elements = write_workload(svg_path, gen, opts.scale, opts.seed)
+
+            runs = [run_once(svg_path, opts) for k in xrange(max(1, opts.repeat))]
+            best = min(runs, key=lambda r: r["total_s"])
+            best["elements"] = elements
+            best["bytes"] = os.path.getsize(svg_path)
+            best["runs_s"] = [r["total_s"] for r in runs]
+            results["workloads"][name] = best
+
+            print_result(out, name, best, baseline)
+    finally:
+        if not opts.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if opts.json == "-":
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print("")
+    elif opts.json:
+        fd = open(opts.json, "w")
+        json.dump(results, fd, indent=2, sort_keys=True)
+        fd.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+# Benchmark the serial protocols: ASCII lines against binary frames
+#
+# Encodes the same command stream both ways and counts the bytes each
+# puts on the wire, out and back, per move:
+#
+#   ascii         "r 12 -3\n" out, "Rotating 12 -3\r\n" back
+#   binary        moves packed into full frames, one ACK a frame; what
+#                 FrameSender does while the device is busy
+#   binary_eager  one op a frame; what it does when the device is
+#                 waiting on the host, the worst case
+#
+# and from those, how many moves a second each link could carry if
+# the motors were infinitely fast, next to how long encoding takes on
+# the host.  Commands come from synthetic move streams, or from a
+# compiled plan (--plan, as written with the planFile option), so no
+# Inkscape modules are needed:
+#
+#   python benchmarks/bench_protocol.py
+#   python benchmarks/bench_protocol.py --plan drawing.plan --json out.json
+#
+
+import json
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+
+import muralizer_plan
+from muralizer_binary import ASCII_BAUD, BINARY_BAUD, FRAME_PAYLOAD, \
+    encode_command, frame
+from muralizer_sim import BITS_PER_BYTE
+
+ACK_BYTES = 3  # ACK seq ~seq
+
+
+####################
+# Command streams
+#
+# Each takes a Random and a count and returns ASCII command lines.
+
+def gen_hatching(rnd, n):
+    """Short strokes of small moves, as flattened curves give"""
+    out = []
+    while len(out) < n:
+        out.append("p d")
+        for k in xrange(rnd.randint(5, 40)):
+            out.append("r %d %d" % (rnd.randint(-6, 6), rnd.randint(-6, 6)))
+        out.append("p u")
+        out.append("r %d %d" % (rnd.randint(-400, 400), rnd.randint(-400, 400)))
+    return out[:n]
+
+
+def gen_mixed(rnd, n):
+    """Mostly small moves, some medium, a few long travels"""
+    out = []
+    while len(out) < n:
+        u = rnd.random()
+        if u < 0.6:
+            d = 7
+        elif u < 0.95:
+            d = 60
+        else:
+            d = 3000
+        out.append("r %d %d" % (rnd.randint(-d, d), rnd.randint(-d, d)))
+        if rnd.random() < 0.02:
+            out.append(rnd.random() < 0.5 and "p u" or "p d")
+    return out[:n]
+
+
+def gen_long(rnd, n):
+    """Long straight lines: few moves, many steps each"""
+    return ["r %d %d" % (rnd.randint(-2000, 2000), rnd.randint(-2000, 2000))
+            for i in xrange(n)]
+
+
+STREAMS = [
+    ("hatching", gen_hatching),
+    ("mixed", gen_mixed),
+    ("long", gen_long),
+]
+
+
+def plan_commands(path):
+    plan = muralizer_plan.PlanReader(path)
+    try:
+        out = []
+        for (op, a, b, path_i, node_i) in plan.records():
+            if op == muralizer_plan.OP_MOVE:
+                out.append("r %d %d" % (a, b))
+            elif op == muralizer_plan.OP_PEN_UP:
+                out.append("p u")
+            elif op == muralizer_plan.OP_PEN_DOWN:
+                out.append("p d")
+        return out
+    finally:
+        plan.close()
+
+
+####################
+# Encodings
+
+def ascii_reply(line):
+    f = line.split()
+    if f[0] == "r":
+        return "Rotating %s %s" % (f[1], f[2])
+    return f[1] == "u" and "Pen up" or "Pen down"
+
+
+def measure_ascii(lines):
+    t0 = time.time()
+    out = 0
+    back = 0
+    for line in lines:
+        out += len(line) + 1
+        back += len(ascii_reply(line)) + 2
+    return (out, back, 0, time.time() - t0)
+
+
+def measure_binary(lines, per_frame=None):
+    """Bytes out and back, and frames, with at most [per_frame] ops a
+    frame (None: as many as fit)"""
+    t0 = time.time()
+    out = 0
+    frames = 0
+    seq = 0
+    ops = bytearray()
+    n_ops = 0
+    for line in lines:
+        op = encode_command(line)
+        if op is None:
+            continue
+        if len(ops) + len(op) > FRAME_PAYLOAD or (per_frame and n_ops >= per_frame):
+            out += len(frame(seq, ops))
+            frames += 1
+            seq = (seq + 1) & 0xFF
+            ops = bytearray()
+            n_ops = 0
+        ops += op
+        n_ops += 1
+    if ops:
+        out += len(frame(seq, ops))
+        frames += 1
+    return (out, frames*ACK_BYTES, frames, time.time() - t0)
+
+
+PROTOCOLS = [
+    ("ascii", ASCII_BAUD, measure_ascii),
+    ("binary", BINARY_BAUD, measure_binary),
+    ("binary_eager", BINARY_BAUD, lambda lines: measure_binary(lines, 1)),
+]
+
+
+def run_stream(lines, baud=None):
+    moves = sum(1 for line in lines if line.startswith("r ")) or 1
+    results = {}
+    for (name, default_baud, measure) in PROTOCOLS:
+        (out, back, frames, t) = measure(lines)
+        link_baud = baud or default_baud
+        # The link is full duplex: the busier direction sets the pace
+        wire_s = max(out, back)*float(BITS_PER_BYTE)/link_baud
+        results[name] = {
+            "baud": link_baud,
+            "bytes_out": out,
+            "bytes_in": back,
+            "frames": frames,
+            "bytes_per_move": float(out + back)/moves,
+            "link_moves_per_s": moves/max(wire_s, 1e-9),
+            "encode_us_per_move": 1e6*t/moves,
+        }
+    return {"commands": len(lines), "moves": moves, "protocols": results}
+
+
+def print_result(out, name, r):
+    out.write("%s: %d commands, %d moves\n" % (name, r["commands"], r["moves"]))
+    ascii = r["protocols"]["ascii"]
+    for (p, baud, measure) in PROTOCOLS:
+        s = r["protocols"][p]
+        out.write("  %-13s %6d baud  %6.2f bytes/move  %8.0f moves/s on the link"
+                  "  %5.1f us/move to encode  (%.1fx ascii)\n" %
+                  (p, s["baud"], s["bytes_per_move"], s["link_moves_per_s"],
+                   s["encode_us_per_move"],
+                   s["link_moves_per_s"]/ascii["link_moves_per_s"]))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--moves", type="int", default=50000,
+                      help="commands in each synthetic stream")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--only", action="append", default=[],
+                      help="run just this stream (repeatable)")
+    parser.add_option("--plan", action="append", default=[],
+                      help="also measure this compiled plan (repeatable)")
+    parser.add_option("--baud", type="int", default=None,
+                      help="rate for every protocol, instead of its own")
+    parser.add_option("--json", default=None, help="write results here")
+    (opts, args) = parser.parse_args()
+
+    results = {}
+    for (name, gen) in STREAMS:
+        if opts.only and name not in opts.only:
+            continue
+        lines = gen(random.Random(opts.seed), opts.moves)
+        results[name] = run_stream(lines, opts.baud)
+        print_result(sys.stdout, name, results[name])
+
+    for path in opts.plan:
+        name = os.path.basename(path)
+        results[name] = run_stream(plan_commands(path), opts.baud)
+        print_result(sys.stdout, name, results[name])
+
+    if opts.json:
+        fd = open(opts.json, "w")
+        json.dump(results, fd, indent=1)
+        fd.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+# Benchmark how long the firmware sits idle between commands
+#
+# Runs move streams through PlotSimulator, which models firmware.ino
+# and the serial link on a virtual clock, with the host sending three
+# ways:
+#
+#   sync    streamWindow 0: each command waits for the last to finish
+#   window  StreamingSender's window of 4, as big as the firmware's
+#           32-byte buffer allows; the firmware reads between moves
+#   queue   the firmware's command queue ("q 1"), read while the
+#           motors run, kept topped up: 16 slots plus the one running
+#
+# each at a few host latencies, the time it takes the host to answer
+# a reply with the next command (USB, the OS scheduler, a planner
+# busy parsing a big path).  For each it prints the plot time and the
+# firmware's idle time between commands.  Streams are synthetic, or
+# compiled plans (--plan, as written with the planFile option).
+#
+# MuralizerState is only used for its kinematics, but needs pyserial
+# to import:
+#
+#   python benchmarks/bench_queue.py
+#   python benchmarks/bench_queue.py --plan drawing.plan --latency 0.1
+#
+
+import json
+import os
+import random
+import sys
+from optparse import OptionParser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+
+import muralizer_plan
+from muralizer_sim import PlotSimulator, FIRMWARE_QUEUE_SLOTS, format_duration
+from muralizer_state import MuralizerState
+
+# sender configurations: (streamWindow, queue slots)
+CONFIGS = [
+    ("sync", 0, 0),
+    ("window", 4, 0),
+    ("queue", 4, FIRMWARE_QUEUE_SLOTS),
+]
+
+LATENCIES = (0.0, 0.02, 0.1, 0.25)
+
+# Synthetic strokes stay within this many steps of the start: a step
+# is about 4 mm of cord on the default machine
+REACH = 80
+
+
+####################
+# Command streams
+#
+# Each takes a Random and a count and returns (op, dr0, dr1) tuples,
+# with op one of the muralizer_plan opcodes.
+
+def _stroke_stream(rnd, n, moves, size):
+    out = []
+    (p0, p1) = (0, 0)
+    while len(out) < n:
+        # Travel to the next stroke...
+        (t0, t1) = (rnd.randint(-REACH, REACH), rnd.randint(-REACH, REACH))
+        out.append((muralizer_plan.OP_MOVE, t0 - p0, t1 - p1))
+        (p0, p1) = (t0, t1)
+
+        # ... and draw it
+        out.append((muralizer_plan.OP_PEN_DOWN, 0, 0))
+        for k in xrange(rnd.randint(*moves)):
+            dr0 = max(-REACH, min(REACH, p0 + rnd.randint(-size, size))) - p0
+            dr1 = max(-REACH, min(REACH, p1 + rnd.randint(-size, size))) - p1
+            if dr0 or dr1:
+                out.append((muralizer_plan.OP_MOVE, dr0, dr1))
+                (p0, p1) = (p0 + dr0, p1 + dr1)
+        out.append((muralizer_plan.OP_PEN_UP, 0, 0))
+    return out[:n]
+
+
+def gen_hatching(rnd, n):
+    """Strokes of a few dozen small moves, as flattened curves give"""
+    return _stroke_stream(rnd, n, (5, 40), 4)
+
+
+def gen_lettering(rnd, n):
+    """Short strokes of one- and two-step moves"""
+    return _stroke_stream(rnd, n, (2, 8), 1)
+
+
+def gen_lines(rnd, n):
+    """Long straight strokes, a few moves each"""
+    return _stroke_stream(rnd, n, (1, 4), REACH)
+
+
+STREAMS = [
+    ("hatching", gen_hatching),
+    ("lettering", gen_lettering),
+    ("lines", gen_lines),
+]
+
+
+def plan_stream(path):
+    plan = muralizer_plan.PlanReader(path)
+    try:
+        return [(op, a, b) for (op, a, b, path_i, node_i) in plan.records()]
+    finally:
+        plan.close()
+
+
+####################
+# Simulation
+
+def machine():
+    options = muralizer_plan.PlanOptions(
+        canvasWidth=122, canvasHeight=183, marginXL=23, marginXR=23, marginYT=23,
+        stepsPerRev=48, spoolDiameter=63, streamWindow=4, optimizeCommands=False,
+        logLevel="error")
+    return MuralizerState(options=options, serialPort=None,
+                          debugPath=os.devnull)
+
+
+def simulate(ms, stream, window, queue_slots, latency):
+    sim = PlotSimulator(ms, window=window, acks=True, queue_slots=queue_slots,
+                        host_latency=latency)
+    for (op, a, b) in stream:
+        if op == muralizer_plan.OP_MOVE:
+            sim.move(a, b)
+        elif op == muralizer_plan.OP_PEN_UP:
+            sim.pen(True)
+        elif op == muralizer_plan.OP_PEN_DOWN:
+            sim.pen(False)
+    return sim.report()
+
+
+def run_stream(ms, stream, latencies):
+    results = {}
+    for latency in latencies:
+        for (name, window, slots) in CONFIGS:
+            r = simulate(ms, stream, window, slots, latency)
+            results["%s@%g" % (name, latency)] = {
+                "latency_s": latency,
+                "config": name,
+                "total_s": r["total_s"],
+                "idle_s": r["firmware_idle_s"],
+                "stalls": r["firmware_stalls"],
+                "idle_ms_per_command": 1000.0*r["firmware_idle_s"]/max(r["commands"], 1),
+            }
+    return results
+
+
+def print_result(out, name, stream, results, latencies):
+    out.write("%s: %d commands\n" % (name, len(stream)))
+    for latency in latencies:
+        for (config, window, slots) in CONFIGS:
+            r = results["%s@%g" % (config, latency)]
+            out.write("  %5.0f ms  %-7s %s  idle %8.1f s in %6d gaps, %6.2f ms a command\n" %
+                      (1000*latency, config, format_duration(r["total_s"]),
+                       r["idle_s"], r["stalls"], r["idle_ms_per_command"]))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--commands", type="int", default=20000,
+                      help="commands in each synthetic stream")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--only", action="append", default=[],
+                      help="run just this stream (repeatable)")
+    parser.add_option("--plan", action="append", default=[],
+                      help="also simulate this compiled plan (repeatable)")
+    parser.add_option("--latency", type="float", action="append", default=[],
+                      help="host latency to try, seconds (repeatable)")
+    parser.add_option("--json", default=None, help="write results here")
+    (opts, args) = parser.parse_args()
+
+    latencies = opts.latency or LATENCIES
+    ms = machine()
+
+    streams = []
+    for (name, gen) in STREAMS:
+        if not opts.only or name in opts.only:
+            streams.append((name, gen(random.Random(opts.seed), opts.commands)))
+    for path in opts.plan:
+        streams.append((os.path.basename(path), plan_stream(path)))
+
+    results = {}
+    for (name, stream) in streams:
+        results[name] = run_stream(ms, stream, latencies)
+        print_result(sys.stdout, name, stream, results[name], latencies)
+
+    if opts.json:
+        fd = open(opts.json, "w")
+        json.dump(results, fd, indent=1)
+        fd.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,11 @@
   Changelog:
 
   v 3.1.C : First spin of "final" schematic
+  v 3.1.D : Completion acks ("a 1"): moves are answered once they're
+            done, so the host needn't guess how long they take
+  v 3.1.E : Binary framing ("v b" to ask, "b <baud>" to switch)
+  v 3.1.F : Command queue ("q 1"): serial is read while the motors
+            run, so the next move is waiting when this one ends
   
 */
 
@@ -60,6 +65,29 @@ Stepper s_r(48, 13, 5, A0, A1); // Servo at top right of canvas
 
 Servo pen_servo; // on pin 11
 
+// With completion acks on, a move is answered once the motors have
+// finished ("Done i0 i1") rather than before they start ("Rotating i0
+// i1").  It's off at power-up, so hosts that don't ask for it see the
+// old protocol.
+bool completion_acks = false;
+
+// With the queue on ("q 1"), commands are read into a ring while the
+// motors run, and run from there in order; see read_serial().
+#define QUEUE_SLOTS 16
+
+struct command {
+  char op;  // the command letter, or '?' for a line we couldn't use
+  int i0;
+  int i1;
+};
+
+command queue[QUEUE_SLOTS];
+uint8_t queue_head = 0;  // the oldest queued command
+uint8_t queue_count = 0;
+bool queue_mode = false;
+
+#define PEN_DELAY_MS 1000
+
 // NB: We attach/detach from the pen servo a lot, to avoid obnoxious
 // whining sounds.  This will be problematic if your pen servo's
 // gearing is smooth enough to not hold itself up without power
@@ -76,8 +104,38 @@ void print_version() {
   Serial.println((int) VERSION_MINOR);
 }
 
+// "v b": the version, and that we speak binary framing
+void print_version_binary() {
+  Serial.print((int) VERSION_MAJOR);
+  Serial.print(".");
+  Serial.print((int) VERSION_MINOR);
+  Serial.println(" b");
+}
+
 void print_help() {
-  Serial.println("Commands: [v]ersion, [r]otate <l> <r>, [p]en <u> <d>");
+  Serial.println("Commands: [v]ersion, [r]otate <l> <r>, [p]en <u> <d>, [a]cks <0> <1>, [q]ueue <0> <1>, [b]inary <baud>");
+}
+
+void read_serial();
+
+// With the queue on, replies to moves and pen commands end with the
+// number of free slots: how many more the host may send
+void end_reply() {
+  if (queue_mode) {
+    Serial.print(" ");
+    Serial.println((int) (QUEUE_SLOTS - queue_count));
+  } else {
+    Serial.println();
+  }
+}
+
+// Wait for the pen servo, reading commands meanwhile if we can
+void pen_wait() {
+  unsigned long t0 = millis();
+  while (millis() - t0 < PEN_DELAY_MS) {
+    if (queue_mode)
+      read_serial();
+  }
 }
 
 
@@ -88,7 +146,7 @@ void pen_up() {
   digitalWrite(PIN_LED_S2, 0);
   digitalWrite(PIN_LED_S1, 1);
 
-  delay(1000);
+  pen_wait();
   pen_servo.detach();
 
 }
@@ -99,7 +157,7 @@ void pen_down() {
   digitalWrite(PIN_LED_S2, 1);
   digitalWrite(PIN_LED_S1, 0);
 
-  delay(1000);
+  pen_wait();
   pen_servo.detach();
 }
 
@@ -178,6 +236,11 @@ void spin_bresenham(int dr0, int dr1) {
     }
 
     D += 2*dy;
+
+    // Queue up what's come in since the last step; a step is 25 ms,
+    // so the serial buffer is nowhere near full
+    if (queue_mode)
+      read_serial();
 //    delay(1);
   } // for x
 }
@@ -186,23 +249,321 @@ void spin_bresenham(int dr0, int dr1) {
 
 
 
+/* Binary framing.
+
+   Moves come packed into frames, many to a frame:
+
+     0xA5  seq  len  payload[len]  crc8(seq, len, payload)
+
+   The payload is a run of ops: a byte below 225 is a short move,
+   (dr0+7)*15 + (dr1+7); 0xF0 is followed by dr0 and dr1 as zigzag
+   varints; 0xF1 and 0xF2 are pen up and down; and 0xFE goes back to
+   ASCII at 9600 baud.
+
+   Each frame is answered once it's been run, with ACK seq ~seq.  A
+   bad one gets NAK with the seq we want, and we drop input until the
+   line has been quiet for FRAME_QUIET_MS, so the host waits longer
+   than that before sending it again.  A good frame from after one
+   we've missed gets the same NAK, and a frame we've already run is
+   acknowledged again, but not run twice.
+*/
+
+#define FRAME_SYNC 0xA5
+#define FRAME_PAYLOAD 48
+#define FRAME_ACK 0x06
+#define FRAME_NAK 0x15
+#define FRAME_BYTE_TIMEOUT_MS 100
+#define FRAME_QUIET_MS 20
+
+#define SHORT_MOVE 7
+#define OP_MOVE 0xF0
+#define OP_PEN_UP 0xF1
+#define OP_PEN_DOWN 0xF2
+#define OP_ASCII 0xFE
+
+bool binary_mode = false;
+uint8_t frame[FRAME_PAYLOAD];
+uint8_t expected_seq = 0;
+
+uint8_t crc8(uint8_t crc, uint8_t b) {
+  crc ^= b;
+  for (uint8_t i = 0; i < 8; i++)
+    crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+  return crc;
+}
+
+// The next byte of a frame, or -1 if it doesn't come
+int read_frame_byte() {
+  unsigned long t0 = millis();
+  while (!Serial.available()) {
+    if (millis() - t0 > FRAME_BYTE_TIMEOUT_MS)
+      return -1;
+  }
+  return Serial.read();
+}
+
+void reply_frame(uint8_t kind, uint8_t seq) {
+  Serial.write(kind);
+  Serial.write(seq);
+  Serial.write((uint8_t) ~seq);
+}
+
+// Ask for expected_seq again, and drop whatever else is on its way
+void nak_frame() {
+  reply_frame(FRAME_NAK, expected_seq);
+
+  unsigned long t0 = millis();
+  while (millis() - t0 < FRAME_QUIET_MS) {
+    if (Serial.available()) {
+      Serial.read();
+      t0 = millis();
+    }
+  }
+}
+
+int read_varint(uint8_t len, uint8_t *i) {
+  uint16_t z = 0;
+  uint8_t shift = 0;
+  while (*i < len) {
+    uint8_t b = frame[(*i)++];
+    z |= (uint16_t) (b & 0x7F) << shift;
+    if (!(b & 0x80))
+      break;
+    shift += 7;
+  }
+  return (int) ((z >> 1) ^ -(int) (z & 1));
+}
+
+// Run a frame's ops; true if it asked to go back to ASCII
+bool run_frame(uint8_t len) {
+  bool to_ascii = false;
+  uint8_t i = 0;
+  while (i < len) {
+    uint8_t b = frame[i++];
+    if (b < (2*SHORT_MOVE + 1)*(2*SHORT_MOVE + 1)) {
+      spin_bresenham(b/(2*SHORT_MOVE + 1) - SHORT_MOVE,
+		     b%(2*SHORT_MOVE + 1) - SHORT_MOVE);
+    } else if (b == OP_MOVE) {
+      int i0 = read_varint(len, &i);
+      int i1 = read_varint(len, &i);
+      spin_bresenham(i0, i1);
+    } else if (b == OP_PEN_UP) {
+      pen_up();
+    } else if (b == OP_PEN_DOWN) {
+      pen_down();
+    } else if (b == OP_ASCII) {
+      to_ascii = true;
+    }
+  }
+  return to_ascii;
+}
+
+void binary_loop() {
+  if (Serial.available() <= 0)
+    return;
+  if (Serial.read() != FRAME_SYNC)
+    return;  // not the start of a frame; keep looking
+
+  int seq = read_frame_byte();
+  int len = read_frame_byte();
+  if (seq < 0 || len < 0 || len > FRAME_PAYLOAD) {
+    nak_frame();
+    return;
+  }
+
+  uint8_t crc = crc8(crc8(0, seq), len);
+  for (int i = 0; i < len; i++) {
+    int b = read_frame_byte();
+    if (b < 0) {
+      nak_frame();
+      return;
+    }
+    frame[i] = b;
+    crc = crc8(crc, b);
+  }
+  if (read_frame_byte() != crc) {
+    nak_frame();
+    return;
+  }
+
+  if (seq != expected_seq) {
+    if ((uint8_t) (expected_seq - seq) < 128)
+      reply_frame(FRAME_ACK, seq);  // we've run it; the ACK got lost
+    else
+      reply_frame(FRAME_NAK, expected_seq);  // we've missed one
+    return;
+  }
+
+  bool to_ascii = run_frame(len);
+  reply_frame(FRAME_ACK, seq);
+  expected_seq++;
+
+  if (to_ascii) {
+    Serial.flush();
+    Serial.begin(9600);
+    binary_mode = false;
+  }
+}
+
+
 #define BUFLEN 32
 char buf[BUFLEN];
 uint8_t cursor = 0;
+long baud_request;  // for 'b', which won't fit in a command
 
-void loop() {
+// The line in buf, as a command
+command parse_line() {
+  command c;
   const char *s0, *s1;
-  int i0, i1;
 
-  while (!Serial) { 
-    digitalWrite(PIN_LED_L1, 1);
-    delay(50);
-    digitalWrite(PIN_LED_L1, 0);
-    delay(50);
+  c.op = buf[0];
+  c.i0 = 0;
+  c.i1 = 0;
+
+  switch(buf[0]) {
+  case 'v':
+  case 'a':
+  case 'q':
+  case 'p':
+    c.i0 = buf[2];
+    break;
+
+  case 'b':
+    baud_request = atol(buf+2);
+    if (queue_mode) {
+      c.op = '?';
+      c.i0 = 'q';
+    }
+    break;
+
+  case 'r':
+    s0 = strchr(buf, ' ');
+    if (NULL == s0) {
+      c.op = '?';
+      c.i0 = '0';
+      break;
+    }
+
+    s1 = strchr(s0+1, ' ');
+    if (NULL == s1) {
+      c.op = '?';
+      c.i0 = '1';
+      break;
+    }
+
+    c.i0 = atoi(s0);
+    c.i1 = atoi(s1);
+    break;
+
+  default:
+    c.op = '?';
+    break;
   }
 
+  return c;
+}
+
+void run_command(command c) {
+  switch(c.op) {
+  case 'v':
+    if (c.i0 == 'b')
+      print_version_binary();
+    else
+      print_version();
+    break;
+
+  case 'b':
+    if (baud_request <= 0) {
+      Serial.println("Bogus baud rate.");
+      break;
+    }
+    Serial.print("Binary ");
+    Serial.println(baud_request);
+    Serial.flush();
+    Serial.begin(baud_request);
+    expected_seq = 0;
+    binary_mode = true;
+    break;
+
+  case 'r':
+    if (!completion_acks && !queue_mode) {
+      Serial.print("Rotating ");
+      Serial.print(c.i0);
+      Serial.print(" ");
+      Serial.println(c.i1);
+    }
+#if 0	  
+    if (c.i0 != 0)
+      s_l.step(c.i0);
+
+    if (c.i1 != 0)
+      s_r.step(c.i1);
+#else
+    spin_bresenham(c.i0, c.i1);
+#endif
+
+    // Queued moves are always answered when they're done
+    if (completion_acks || queue_mode) {
+      Serial.print("Done ");
+      Serial.print(c.i0);
+      Serial.print(" ");
+      Serial.print(c.i1);
+      end_reply();
+    }
+    break;
+
+  case 'a':
+    completion_acks = (c.i0 == '1');
+    Serial.println(completion_acks ? "Acks on" : "Acks off");
+    break;
+
+  case 'q':
+    queue_mode = (c.i0 == '1');
+    if (queue_mode) {
+      Serial.print("Queue ");
+      Serial.println((int) QUEUE_SLOTS);
+    } else {
+      Serial.println("Queue off");
+    }
+    break;
+
+  case 'p':
+    if (c.i0 == 'u') {
+      pen_up();
+      Serial.print("Pen up");
+      end_reply();
+    } else if (c.i0 == 'd') {
+      pen_down();
+      Serial.print("Pen down");
+      end_reply();
+    }
+    break;
+
+  default:
+    if (c.i0 == '0') {
+      Serial.println("Bogus input line, s0.");
+    } else if (c.i0 == '1') {
+      Serial.println("Bogus input line, s1.");
+    } else if (c.i0 == 'q') {
+      Serial.println("Queue on; q 0 first.");
+    } else {
+      Serial.print("Unknown command. ");
+      print_help();
+    }
+    break;
+  }
+}
+
+// Read whatever has come in, a line at a time.  Without the queue,
+// each line is run as soon as it's read.  With it, lines go into the
+// ring, and this is also called between steps and while the pen
+// settles.  Reading stops while the ring is full, leaving the rest
+// in the serial buffer; the host keeps count, so that's rare.
+void read_serial() {
+  while (Serial.available() > 0 && !binary_mode) {
+    if (queue_mode && queue_count == QUEUE_SLOTS)
+      return;
 
-  if (Serial.available() > 0) {
     uint8_t x = Serial.read();
     buf[cursor] = x;
     cursor++;
@@ -215,66 +576,44 @@ void loop() {
     }
 
     if (x == '\n') {
-      switch(buf[0]) {
-      case 'v':
-	print_version();
-	memset(buf, 0, BUFLEN);
-	break;
-      case 'r':
-	s0 = strchr(buf, ' ');
-	if (NULL == s0) {
-	  Serial.println("Bogus input line, s0.");
-	  memset(buf, 0, BUFLEN);
-	  return;
-	}
-
-	s1 = strchr(s0+1, ' ');
-	if (NULL == s0) {
-	  Serial.println("Bogus input line, s1.");
-	  memset(buf, 0, BUFLEN);
-	  return;
-	}
-
-	i0 = atoi(s0);
-	i1 = atoi(s1);
-
-
-	memset(buf, 0, BUFLEN);
-
-	Serial.print("Rotating ");
-	Serial.print(i0);
-	Serial.print(" ");
-	Serial.println(i1);
-#if 0	  
-	if (i0 != 0)
-	  s_l.step(i0);
-
-	if (i1 != 0)
-	  s_r.step(i1);
-#else
-	spin_bresenham(i0, i1);
-#endif
+      command c = parse_line();
+      memset(buf, 0, BUFLEN);
+      cursor = 0;
 
-	break;
-
-      case 'p':
-	if (buf[2] == 'u') {
-	  pen_up();
-	  Serial.println("Pen up");
-	} else if (buf[2] == 'd') {
-	  pen_down();
-	  Serial.println("Pen down");
-	}
-	break;
-
-      default:
-	Serial.print("Unknown command. ");
-	print_help();
-	memset(buf, 0, BUFLEN);
-	break;
+      if (queue_mode) {
+	queue[(queue_head + queue_count) % QUEUE_SLOTS] = c;
+	queue_count++;
+      } else {
+	run_command(c);
       }
-      cursor = 0;
     }
-    
   }
 }
+
+void run_queued() {
+  command c = queue[queue_head];
+  queue_head = (queue_head + 1) % QUEUE_SLOTS;
+  queue_count--;
+  run_command(c);
+}
+
+void loop() {
+  while (!Serial) { 
+    digitalWrite(PIN_LED_L1, 1);
+    delay(50);
+    digitalWrite(PIN_LED_L1, 0);
+    delay(50);
+  }
+
+  if (binary_mode) {
+    binary_loop();
+    return;
+  }
+
+  // After "q 0", what's left in the ring runs before anything new
+  if (queue_mode || !queue_count)
+    read_serial();
+
+  if (queue_count)
+    run_queued();
+}
@@ -41,6 +41,7 @@ import string
 import sys
 import time
 import json
+import socket
 
 # PySerial import
 import serial
@@ -48,12 +49,28 @@ import serial
 # Inkscape imports
 from bezmisc import *
 from simpletransform import *
-import simplepath
-import cspsubdiv
 
 # Drawbot imports
 #import eggbot_scan
 from muralizer_state import MuralizerState
+from muralizer_plan import PlanReader, Checkpoint, replay_plan
+from muralizer_sender import SenderError, PIPELINE_DEPTH
+from muralizer_order import order_strokes, pen_up_travel, join_strokes
+from muralizer_flatten import coords_to_points, tolerance_for
+from muralizer_pool import PathPool, GeometryCache, path_coords
+from muralizer_shapes import parse_points, polyline_coords, line_coords, \
+    rect_coords, ellipse_coords
+from muralizer_transform import parse_transform, compose_transform, translate_transform, scale_transform
+from muralizer_sim import PlotSimulator
+from muralizer_cache import PlanCache, document_key
+from muralizer_daemon import DEFAULT_PORT, DaemonError, ensure_daemon, format_job, format_device
+from muralizer_daemon import request as daemon_request
+from muralizer_state import find_muralizers
+from muralizer_farm import PlotFarm, load_farm_config, device_options, split_tiles, \
+    unfinished_plans
+from muralizer_telemetry import numbered_path
+from muralizer_timing import calibrate_time_model, load_time_model, save_time_model
+from muralizer_binary import BINARY_BAUD
 
 F_DEFAULT_SPEED = 1
 N_PEN_DOWN_DELAY = 400    # delay (ms) for the pen to go down before the next move
@@ -85,6 +102,10 @@ if platform == 'win32':
 DEBUG_OUTPUT_FILE = os.path.join( HOME, 'test.hpgl' )
 DRY_RUN_OUTPUT_FILE = os.path.join( HOME, 'dry_run.txt' )
 MISC_OUTPUT_FILE = os.path.join( HOME, 'misc.txt' )
+PLAN_CACHE_DIR = os.path.join( HOME, '.muralizer_plans' )
+DAEMON_JOB_DIR = os.path.join( HOME, '.muralizer_jobs' )
+DAEMON_LOG_FILE = os.path.join( HOME, 'muralizer_daemon.log' )
+FARM_PLAN_DIR = os.path.join( HOME, '.muralizer_farm' )
 
 
 def parseLengthWithUnits( str ):  # MCL
@@ -110,39 +131,6 @@ def parseLengthWithUnits( str ):  # MCL
 
     return v, u
 
-def subdivideCubicPath( sp, flat, i=1 ): # MCL
-    """
-    Break up a bezier curve into smaller curves, each of which
-    is approximately a straight line within a given tolerance
-    (the "smoothness" defined by [flat]).
-
-    This is a modified version of cspsubdiv.cspsubdiv(). I rewrote the recursive
-    call because it caused recursion-depth errors on complicated line segments.
-    """
-
-    while True:
-        while True:
-            if i >= len( sp ):
-                return
-
-            p0 = sp[i - 1][1]
-            p1 = sp[i - 1][2]
-            p2 = sp[i][0]
-            p3 = sp[i][1]
-
-            b = ( p0, p1, p2, p3 )
-
-            if cspsubdiv.maxdist( b ) > flat:
-                break
-
-            i += 1
-
-        one, two = beziersplitatt( b, 0.5 )
-        sp[i - 1][2] = one[1]
-        sp[i][0] = two[2]
-        p = [one[2], one[3], two[1]]
-        sp[i:1] = [p]
-
 
 
 
@@ -175,10 +163,43 @@ class Muralizer( inkex.Effect ):
             ("spoolDiameter", "int", 63, "Spool diameter, mm"),
 
 
-            ("smoothness", "float", 0.2, "Curve smoothing"),
+            ("smoothness", "float", 0.2, "Curve smoothing (mm on the wall)"),
+            ("lineTolerance", "float", 1.0, "How far drawn lines may bow, mm (0 to not split them)"),
+
+            ("streamWindow", "int", 4, "Commands kept in flight (0 to wait on each)"),
+            ("completionAcks", "inkbool", True, "Have the firmware acknowledge moves when they're done, if it can"),
+            ("commandQueue", "inkbool", True, "Keep the firmware's command queue topped up, if it has one"),
+            ("serialProtocol", "string", "ascii", "Serial protocol: ascii, or binary frames if the firmware can"),
+            ("binaryBaud", "int", BINARY_BAUD, "Baud rate for binary frames"),
+            ("pipelineDepth", "int", PIPELINE_DEPTH, "Commands planned ahead of the device (0 to plan and send in step)"),
+            ("optimizeCommands", "inkbool", True, "Drop redundant commands and merge moves"),
 
             ("layernumber", "int", 0, "Layer number to print"),
 
+            ("reorderPaths", "inkbool", False, "Reorder paths to minimize pen-up travel"),
+            ("joinPaths", "inkbool", False, "Join paths whose ends meet to save pen lifts"),
+            ("joinTolerance", "float", 0.5, "Largest gap (mm on the wall) to draw through when joining"),
+
+            ("dryRun", "inkbool", False, "Simulate the plot without touching the hardware"),
+
+            ("planFile", "string", "", "Compiled plan file to record or replay"),
+            ("replayPlan", "inkbool", False, "Replay planFile instead of the document"),
+            ("resumePlot", "inkbool", False, "Resume the interrupted plot from its checkpoint"),
+            ("planCache", "inkbool", False, "Reuse the compiled plan when nothing has changed"),
+            ("planCacheDir", "string", "", "Plan cache directory (default ~/.muralizer_plans)"),
+            ("planCacheMB", "int", 200, "Largest the plan cache may grow, MB"),
+
+            ("useDaemon", "inkbool", False, "Hand plots to the background plot daemon"),
+            ("daemonPort", "int", DEFAULT_PORT, "Local TCP port of the plot daemon"),
+
+            ("farmMode", "string", "off", "Split the plot across several muralizers: off, layers or tiles"),
+            ("farmConfig", "string", "", "Farm config file listing the devices (default: every one found)"),
+
+            ("planWorkers", "int", 0, "Worker processes for path geometry (0 to plan in this one)"),
+
+            ("logLevel", "string", "info", "Debug log detail: error, warn, info, debug or trace (every command)"),
+            ("telemetryFile", "string", "", "Write per-command timings here at the end of the plot (.json or .csv)"),
+
 
             ##################################################
             # Manual control
@@ -217,6 +238,11 @@ class Muralizer( inkex.Effect ):
         self.fPrevX = None
         self.fPrevY = None
         self.ptFirst = None
+        self.strokes = None  # Flattened subpaths awaiting the ordering stage
+        self.pathPool = None  # Worker processes flattening paths, with planWorkers
+        self.idIndex = None  # id -> elements with that id, built on the first <use>
+        self.cloneDepth = 0  # how many <use> elements we're inside
+        self.cloneGeometry = None  # GeometryCache for paths drawn by clones
         self.bStopped = False
         self.fSpeed = 1
         self.resumeMode = False
@@ -232,6 +258,7 @@ class Muralizer( inkex.Effect ):
         self.svgLastPathNC = int( 0 )
         self.svgTotalDeltaX = int( 0 )
         self.svgTotalDeltaY = int( 0 )
+        self.svgCheckpoint = None  # where a plot streamed from a plan stopped
 
         self.nDeltaX = 0
         self.nDeltaY = 0
@@ -252,7 +279,18 @@ class Muralizer( inkex.Effect ):
     def effect( self ):  # MCL
         '''Main entry point: check to see which tab is selected, and act accordingly.'''
 
-        self.ms = MuralizerState(options=self.options)
+        if self.options.dryRun or bDryRun:
+            # Commands go to DRY_RUN_OUTPUT_FILE, and a model of the
+            # firmware estimates how the plot would go
+            self.ms = MuralizerState(options=self.options, serialPort=None,
+                                     dryRunPath=DRY_RUN_OUTPUT_FILE)
+            self.ms.simulator = PlotSimulator(self.ms, model=load_time_model())
+        elif self.options.useDaemon or self.options.farmMode != "off":
+            # The daemon owns the port, or each farm device gets its
+            # own state; this one only plans
+            self.ms = MuralizerState(options=self.options, serialPort=None)
+        else:
+            self.ms = MuralizerState(options=self.options)
         self.svgWidth = self.ms.page_width()
         self.svgHeight = self.ms.page_height()
 
@@ -261,7 +299,22 @@ class Muralizer( inkex.Effect ):
 
         if self.options.tab == '"splash"':
             inkex.errormsg("Print!")
-            self.plot()
+            if self.options.farmMode != "off" and self.options.resumePlot:
+                self.resumeFarm()
+            elif self.options.farmMode != "off":
+                self.plotFarm()
+            elif self.options.replayPlan:
+                self.replayPlan()
+            elif self.options.resumePlot:
+                self.resumePlot()
+            else:
+                self.plot()
+
+            if self.ms.simulator:
+                summary = self.ms.simulator.summary()
+                inkex.errormsg("Dry run, commands written to %s" % DRY_RUN_OUTPUT_FILE)
+                inkex.errormsg(summary)
+                self.debugNote(summary)
 
         elif self.options.tab == '"motors"':
             inkex.errormsg("Motor properties: %s" % str(self.ms))
@@ -284,6 +337,8 @@ class Muralizer( inkex.Effect ):
             inkex.errormsg("Unhandled tab: %s" % self.options.tab)
 
 
+        self.ms.stop_sender() # don't exit with commands still queued
+
         self.svgDataRead = False
         self.UpdateSVGEggbotData( self.svg )
         return
@@ -315,6 +370,13 @@ class Muralizer( inkex.Effect ):
                 self.svgLayer = int( node.get( 'layer' ) )
                 self.svgNodeCount = int( node.get( 'node' ) )
 
+                if node.get( 'planfile' ):
+                    self.svgCheckpoint = Checkpoint( node.get( 'planfile' ),
+                        int( node.get( 'planoffset', '0' ) ),
+                        float( node.get( 'r0', '0' ) ),
+                        float( node.get( 'r1', '0' ) ),
+                        { 'up': True, 'down': False }.get( node.get( 'pen' ) ) )
+
                 try:
                     self.svgLastPath = int( node.get( 'lastpath' ) )
                     self.svgLastPathNC = int( node.get( 'lastpathnc' ) )
@@ -341,6 +403,17 @@ class Muralizer( inkex.Effect ):
                     node.set( 'lastpathnc', str( self.svgLastPathNC ) )
                     node.set( 'totaldeltax', str( self.svgTotalDeltaX ) )
                     node.set( 'totaldeltay', str( self.svgTotalDeltaY ) )
+                    if self.svgCheckpoint:
+                        c = self.svgCheckpoint
+                        node.set( 'planfile', c.plan_path )
+                        node.set( 'planoffset', str( c.offset ) )
+                        node.set( 'r0', repr( c.r0 ) )
+                        node.set( 'r1', repr( c.r1 ) )
+                        node.set( 'pen', { True: 'up', False: 'down' }.get( c.pen_up, '' ) )
+                    else:
+                        for a in ( 'planfile', 'planoffset', 'r0', 'r1', 'pen' ):
+                            if a in node.attrib:
+                                del node.attrib[a]
                     self.svgDataRead = True
 
     def resumePlotSetup( self ):
@@ -391,8 +464,23 @@ class Muralizer( inkex.Effect ):
             "walk-r0": lambda: self.ms.cmd_move_r0(self.options.walkDistance),
             "walk-r1": lambda: self.ms.cmd_move_r1(self.options.walkDistance),
             "version-check": lambda: self.ms.cmd_version(),
+            "calibrate": lambda: self.calibrate(),
+            }
+
+        daemon = {
+            "daemon-status": lambda: self.daemonStatus(),
+            "daemon-cancel": lambda: self.daemonRequest({ "cmd": "cancel" }, start=False),
+            "daemon-stop": lambda: self.daemonRequest({ "cmd": "shutdown" }, start=False),
             }
 
+        if self.options.manualType in daemon:
+            daemon[self.options.manualType]()
+            return
+
+        if self.options.useDaemon and self.options.manualType != "none":
+            inkex.errormsg("The plot daemon has the serial port; stop it to use manual commands.")
+            return
+
 
         if self.options.manualType not in dispatch:
             inkex.errormsg("Unknown manual command to dispatch: %s" % self.options.manualType)
@@ -402,6 +490,7 @@ class Muralizer( inkex.Effect ):
 
         try:
             retval = dispatch[self.options.manualType]()
+            self.ms.drain()
 
         finally:
             if serial_fd:
@@ -417,6 +506,17 @@ class Muralizer( inkex.Effect ):
 
 
 
+    def calibrate( self ):
+        '''Time test moves on the device, and save its timing model'''
+        if not self.ms.has_serial:
+            inkex.errormsg("No muralizer to calibrate.")
+            return None
+
+        model = calibrate_time_model( self.ms, self.debugNote )
+        save_time_model( model, self.ms.serial_path )
+        self.debugNote( model.summary() )
+        return model.summary()
+
     def setupCommand( self ): # MIP
         """Execute commands from the "setup" tab"""
         self.ms.ensure_setup(self.options)
@@ -434,28 +534,21 @@ class Muralizer( inkex.Effect ):
 
 
     def getFitScale(self):
-        svgHeight = self.getLength('height', self.ms.page_height())
-        svgWidth = self.getLength('width', self.ms.page_width())
+        svgHeight = self.getLength('height', self.svgHeight)
+        svgWidth = self.getLength('width', self.svgWidth)
 
-        scale_h = self.ms.page_height() / svgHeight
-        scale_w = self.ms.page_width() / svgWidth
+        scale_h = self.svgHeight / svgHeight
+        scale_w = self.svgWidth / svgWidth
 
-        self.debugNote("Scale: svg: %.1f x %.1f; page: %.1f x %.1f; scales: %.3f / %.3f" % (svgWidth, svgHeight, self.ms.page_width(), self.ms.page_height(), scale_w, scale_h))
+        self.debugNote("Scale: svg: %.1f x %.1f; page: %.1f x %.1f; scales: %.3f / %.3f" % (svgWidth, svgHeight, self.svgWidth, self.svgHeight, scale_w, scale_h))
 
         return min(scale_h, scale_w)
 
         
         
 
-    def plot( self ): # MIP
-        '''Perform the actual plotting, if selected in the interface:'''
-        #parse the svg data as a series of line segments and send each segment to be plotted
-
-        inkex.errormsg("Layers to print: " + str(self.svgLayer))
-
-        self.debugNote("Starting plot.  Layers to print: %s" % (str(self.svgLayer)))
-
-
+    def setupTransform( self ):
+        '''Map the document onto a self.svgWidth x self.svgHeight (mm) drawing area'''
 
         # Viewbox handling
         # Also ignores the preserveAspectRatio attribute
@@ -465,39 +558,105 @@ class Muralizer( inkex.Effect ):
             if ( vinfo[2] != 0 ) and ( vinfo[3] != 0 ):
                 sx = self.svgWidth / float( vinfo[2] )
                 sy = self.svgHeight / float( vinfo[3] )
-                xform_scale = 'scale(%f,%f)' % (sx,sy)
 
                 dx = -float(vinfo[0])
                 dy = -float(vinfo[1])
-                xform_xlate = 'translate(%f,%f)' % (dx,dy)
 
-                xform = " ".join([xform_scale, xform_xlate])
-
-                self.svgTransform = parseTransform(xform)
+                self.svgTransform = compose_transform( scale_transform( sx, sy ),
+                                                       translate_transform( dx, dy ) )
         else:
             scalefactor = self.getFitScale()
-            xform = "scale(%f,%f)" % (scalefactor, scalefactor)
-            self.svgTransform = parseTransform(xform)
+            self.svgTransform = scale_transform( scalefactor, scalefactor )
 
         self.debugNote("svgTransform: %s" % self.svgTransform)
 
 
+    def plot( self ): # MIP
+        '''Perform the actual plotting, if selected in the interface:'''
+        #parse the svg data as a series of line segments and send each segment to be plotted
+
+        inkex.errormsg("Layers to print: " + str(self.svgLayer))
+
+        self.debugNote("Starting plot.  Layers to print: %s" % (str(self.svgLayer)))
+
+        self.setupTransform()
+
+
         serial_fd = None
 
+        cache = None
+        planPath = self.options.planFile
+        if self.options.planCache and not self.resumeMode:
+            cache = PlanCache( self.options.planCacheDir or PLAN_CACHE_DIR,
+                               self.options.planCacheMB * 1048576 )
+            cacheKey = document_key( self.svg, self.options,
+                                     ( self.svgLayer, self.options.layernumber,
+                                       self.allLayers, self.plotCurrentLayer ) )
+            cached = cache.lookup( cacheKey )
+            if cached:
+                # Same drawing, same machine: skip straight to the commands
+                inkex.errormsg("Replaying cached plan " + cached)
+                inkex.errormsg( cache.summary() )
+                self.streamPlanFile( cached )
+                return
+
+            if not planPath:
+                planPath = cache.pending_path( cacheKey )
+
+        cleanup = False
+        if self.options.useDaemon and not planPath:
+            # A plan just for this job, which the daemon deletes when done
+            if not os.path.isdir( DAEMON_JOB_DIR ):
+                os.makedirs( DAEMON_JOB_DIR )
+            planPath = os.path.join( DAEMON_JOB_DIR, "job-%d-%d.murp" % ( time.time(), os.getpid() ) )
+            cleanup = True
+
+        if planPath:
+            # Compile the whole plan before moving anything, then stream
+            # it: that way an interrupted plot can pick up from the
+            # checkpoint instead of walking the document again.
+            self.ms.start_compiling( planPath )
+            try:
+                self.plotDocument()
+            except:
+                self.ms.stop_compiling()
+                if cache and not self.options.planFile:
+                    cache.discard( cacheKey )
+                raise
+            n = self.ms.stop_compiling()
+            if self.bStopped:
+                # Nothing has moved yet; there's nothing to resume
+                inkex.errormsg("Stopped while compiling the plan.")
+                if cache and not self.options.planFile:
+                    cache.discard( cacheKey )
+                return
+            self.svgNodeCount = 0
+            inkex.errormsg("Compiled %d plan commands to %s" % (n, planPath))
+
+            if cache:
+                planPath = cache.store( cacheKey, planPath )
+                inkex.errormsg( cache.summary() )
+
+            self.streamPlanFile( planPath, cleanup )
+            return
+
         try:
 
-            self.recursivelyTraverseSvg(self.svg, self.svgTransform)
+            self.plotDocument()
+
+            throughput = self.ms.drain()
+            if throughput:
+                inkex.errormsg(throughput)
             
             inkex.errormsg('Final node count: ' + str(self.svgNodeCount))
             self.debugNote('Final node count: ' + str(self.svgNodeCount))
 
             if ( not self.bStopped ):
-                self.svgLayer = 0
-                self.svgNodeCount = 0
-                self.svgLastPath = 0
-                self.svgLastPathNC = 0
-                self.svgTotalDeltaX = 0
-                self.svgTotalDeltaY = 0
+                self.resetResumeData()
+
+        except Exception as e:
+            self.ms.dump_recent( e )
+            raise
 
         finally:
             if serial_fd:
@@ -505,6 +664,336 @@ class Muralizer( inkex.Effect ):
                 self.ms.detach_serial()
             self.ms.cmd_scram() # This should work even if the serial port is gone
 
+    def plotDocument( self ):
+        '''
+        Walk the document, plotting (or collecting) every path.
+
+        The plot runs as a pipeline: traversal, then path geometry and
+        flattening (on the PathPool with planWorkers), then kinematics
+        and command encoding in MuralizerState, all on this thread, and
+        then the send stage on its own thread (with pipelineDepth).
+        Each hop is a bounded queue, so strokes start going out as soon
+        as the first path is planned, and memory doesn't grow with the
+        document.  Ordering and joining strokes have to see every
+        stroke first, so they hold up the start of the plot.
+        '''
+        if self.options.reorderPaths or self.options.joinPaths:
+            self.strokes = []
+
+        self.startPathPool()
+        try:
+            self.recursivelyTraverseSvg(self.svg, self.svgTransform)
+            if self.pathPool:
+                self.plotPooledPaths( finish=True )
+        finally:
+            self.stopPathPool()
+
+        if self.cloneGeometry:
+            self.debugNote( self.cloneGeometry.summary() )
+
+        if self.strokes is not None:
+            self.plotCollectedStrokes()
+
+    def resetResumeData( self ):
+        '''The plot finished: nothing left to resume'''
+        self.svgLayer = 0
+        self.svgNodeCount = 0
+        self.svgLastPath = 0
+        self.svgLastPathNC = 0
+        self.svgTotalDeltaX = 0
+        self.svgTotalDeltaY = 0
+        if self.svgCheckpoint:
+            self.svgCheckpoint.clear()
+            self.svgCheckpoint = None
+
+    def replayPlan( self ):
+        '''Stream a previously compiled plan file instead of walking the SVG'''
+        if not self.options.planFile:
+            inkex.errormsg("No plan file given to replay.")
+            return
+
+        self.streamPlanFile( self.options.planFile )
+
+    def streamPlanFile( self, path, cleanup=False ):
+        '''Plot a compiled plan, here and now or on the plot daemon'''
+        if self.options.useDaemon:
+            reply = self.daemonRequest( { "cmd": "submit", "plan": path, "cleanup": cleanup } )
+            if reply:
+                inkex.errormsg("Queued as job %d on the plot daemon." % reply["job"])
+                inkex.errormsg('Use "Plot daemon status" on the Manual tab to follow it.')
+                self.resetResumeData()
+            return
+
+        self.replayPlanFile( path )
+        if ( not self.bStopped ):
+            self.resetResumeData()
+
+    def daemonRequest( self, msg, start=True ):
+        '''
+        Send [msg] to the plot daemon, starting one first if [start].
+        Returns the reply, or None (having said why) on failure.
+        '''
+        try:
+            if start:
+                ensure_daemon( self.options.daemonPort,
+                               [ "--streamWindow", str( self.options.streamWindow ),
+                                 "--jobDir", DAEMON_JOB_DIR ],
+                               DAEMON_LOG_FILE )
+            return daemon_request( msg, self.options.daemonPort )
+        except socket.error:
+            inkex.errormsg("The plot daemon isn't running.")
+        except DaemonError as e:
+            inkex.errormsg("Plot daemon: %s" % e)
+        return None
+
+    def daemonStatus( self ):
+        reply = self.daemonRequest( { "cmd": "status" }, start=False )
+        if reply:
+            for j in reply["jobs"][-10:]:
+                inkex.errormsg( format_job( j ) )
+            if not reply["jobs"]:
+                inkex.errormsg("The plot daemon has no jobs.")
+            if reply.get("device"):
+                inkex.errormsg( format_device( reply["device"] ) )
+
+    def resumePlot( self ):
+        '''Carry on with an interrupted plot from its last checkpoint'''
+        if self.options.useDaemon:
+            reply = self.daemonRequest( { "cmd": "resume" } )
+            if reply:
+                inkex.errormsg("Resuming as job %d on the plot daemon." % reply["job"])
+            return
+
+        checkpoint = self.svgCheckpoint
+        if checkpoint:
+            # The file next to the plan may be newer than the document
+            checkpoint = Checkpoint.load( checkpoint.plan_path ) or checkpoint
+        if not checkpoint:
+            inkex.errormsg("There's no interrupted plot to resume.")
+            return
+
+        if not os.path.exists( checkpoint.plan_path ):
+            inkex.errormsg("Can't resume: plan file %s is gone." % checkpoint.plan_path)
+            return
+
+        self.replayPlanFile( checkpoint.plan_path, checkpoint )
+        if ( not self.bStopped ):
+            self.resetResumeData()
+
+    def replayPlanFile( self, path, checkpoint=None ):
+        '''
+        Stream the plan at [path], from the start or from [checkpoint].
+        If the plot is paused or the device goes away, the checkpoint
+        is saved (in the document and next to the plan) for resumePlot.
+        '''
+        plan = PlanReader(path)
+
+        # Plans are recorded after optimizing, and the checkpoint
+        # follows the device's replies one record to one command
+        optimizer = self.ms.optimizer
+        self.ms.optimizer = None
+
+        try:
+            for k, v in plan.machine.items():
+                if float(getattr(self.options, k)) != v:
+                    inkex.errormsg("Warning: plan was compiled with %s=%g, not %g" %
+                                   (k, v, float(getattr(self.options, k))))
+
+            if checkpoint is None:
+                checkpoint = Checkpoint( plan.path, 0, self.ms.r0, self.ms.r1 )
+            elif checkpoint.offset > len( plan ):
+                inkex.errormsg("Can't resume: checkpoint is past the end of %s" % plan.path)
+                return
+            else:
+                # The machine is where the checkpoint left it, not at home
+                inkex.errormsg("Resuming from " + str( checkpoint ))
+                self.ms.r0 = checkpoint.r0
+                self.ms.r1 = checkpoint.r1
+                if checkpoint.pen_up is False:
+                    self.ms.cmd_pen_down()
+                else:
+                    self.ms.cmd_pen_up()
+
+            self.debugNote("Replaying %d plan commands from %s" % (len(plan) - checkpoint.offset, plan.path))
+            try:
+                n = replay_plan(plan, self.ms, start=checkpoint.offset,
+                                stop=self.ms.cmd_button_down, checkpoint=checkpoint)
+                if n < len( plan ):
+                    inkex.errormsg("Plot paused by button press.")
+                    self.bStopped = True
+                else:
+                    self.ms.cmd_pen_up()
+
+                throughput = self.ms.drain()
+                if throughput:
+                    inkex.errormsg(throughput)
+                if ( not self.bStopped ):
+                    checkpoint.clear()
+            except (IOError, OSError, SenderError, serial.SerialException) as e:
+                inkex.errormsg("Plot interrupted: %s" % e)
+                self.ms.dump_recent(e)
+                self.bStopped = True
+
+            if self.bStopped:
+                checkpoint.save()
+                self.svgCheckpoint = checkpoint
+                inkex.errormsg("Stopped at command %d of %d." % (checkpoint.offset, len(plan)))
+                inkex.errormsg('Use "Resume" to continue.')
+        finally:
+            plan.close()
+            self.ms.optimizer = optimizer
+            self.ms.cmd_scram()
+
+    def farmDevices( self ):
+        '''(name, MuralizerState) for each farm device, left to right'''
+        devices = []
+        if self.options.farmConfig:
+            for i, entry in enumerate( load_farm_config( self.options.farmConfig ) ):
+                # A device with no port gets a null serial port, for trying
+                # out a layout
+                ms = MuralizerState( options=device_options( self.options, entry ),
+                                     serialPort=entry.get( "port" ) or None,
+                                     debugPath="%s.%d" % ( self.ms.debug_path, i ),
+                                     telemetryPath=self.farmTelemetryPath( i ) )
+                devices.append( ( "device%d" % i, ms ) )
+        else:
+            found = find_muralizers( self.debugNote )
+            found.sort()
+            for i, ( path, serial_fd ) in enumerate( found ):
+                ms = MuralizerState( options=self.options, serialPort=None,
+                                     debugPath="%s.%d" % ( self.ms.debug_path, i ),
+                                     telemetryPath=self.farmTelemetryPath( i ) )
+                ms.attach_serial( serial_fd, path )
+                devices.append( ( "device%d" % i, ms ) )
+        return devices
+
+    def farmTelemetryPath( self, i ):
+        '''Each farm device's own telemetry file, if there's to be one'''
+        if self.options.telemetryFile:
+            return numbered_path( self.options.telemetryFile, i )
+        return None
+
+    def plotFarm( self ):
+        '''
+        Split the drawing across several muralizers, by layer or by
+        tile, compile a plan for each one, and plot them all at once.
+        '''
+        devices = self.farmDevices()
+        if not devices:
+            inkex.errormsg("No muralizers found for the farm.")
+            return
+        n = len( devices )
+        inkex.errormsg("Farm of %d devices: %s" % ( n, ", ".join( ms.serial_path for name, ms in devices ) ))
+
+        widths = [ms.page_width() for name, ms in devices]
+        heights = [ms.page_height() for name, ms in devices]
+        if self.options.farmMode == "tiles":
+            # The panels sit side by side: one wide drawing area
+            self.svgWidth = sum( widths )
+        else:
+            self.svgWidth = min( widths )
+        self.svgHeight = min( heights )
+        self.setupTransform()
+
+        # Collect every stroke, then deal them out to the devices
+        shards = [[] for d in devices]
+        self.startPathPool()
+        try:
+            if self.options.farmMode == "tiles":
+                self.strokes = []
+                self.recursivelyTraverseSvg( self.svg, self.svgTransform )
+                if self.pathPool:
+                    self.plotPooledPaths( finish=True )
+                shards = split_tiles( self.strokes, widths )
+            elif self.options.farmMode == "layers":
+                nLayer = 0
+                for node in self.svg:
+                    self.strokes = []
+                    self.recursivelyTraverseSvg( [node], self.svgTransform )
+                    if self.pathPool:
+                        self.plotPooledPaths( finish=True )
+                    if node.get( inkex.addNS( 'groupmode', 'inkscape' ) ) == 'layer':
+                        shards[nLayer % n].extend( self.strokes )
+                        nLayer += 1
+                    else:
+                        shards[0].extend( self.strokes )  # loose paths go to the first device
+            else:
+                inkex.errormsg("Unknown farm mode: %s" % self.options.farmMode)
+                return
+        finally:
+            self.stopPathPool()
+        self.strokes = None
+
+        if not os.path.isdir( FARM_PLAN_DIR ):
+            os.makedirs( FARM_PLAN_DIR )
+        stamp = "%d-%d" % ( time.time(), os.getpid() )
+
+        farm = PlotFarm( self.debugNote )
+        planner = self.ms
+        try:
+            for ( name, ms ), strokes in zip( devices, shards ):
+                planPath = os.path.join( FARM_PLAN_DIR, "farm-%s-%s.murp" % ( stamp, name ) )
+
+                # Plan as this device, from wherever its pen is now
+                self.ms = ms
+                self.ptFirst = None
+                self.strokes = strokes
+                ms.start_compiling( planPath )
+                try:
+                    self.plotCollectedStrokes()
+                finally:
+                    count = ms.stop_compiling()
+                inkex.errormsg("%s: %d strokes, %d plan commands in %s" % ( name, len( strokes ), count, planPath ))
+                farm.add( name, ms, planPath )
+        finally:
+            self.ms = planner
+
+        self.runFarm( farm )
+
+    def resumeFarm( self ):
+        '''
+        Carry on with the devices of the last farm plot that stopped,
+        each from its own checkpoint.  The farm settings must be the
+        same as for the plot, so each plan goes back to its device.
+        '''
+        plans = unfinished_plans( FARM_PLAN_DIR )
+        if not plans:
+            inkex.errormsg("There's no interrupted farm plot to resume.")
+            return
+
+        devices = self.farmDevices()
+        farm = PlotFarm( self.debugNote )
+        for name, ms in devices:
+            planPath = plans.pop( name, None )
+            if planPath is None:
+                continue  # it finished
+            checkpoint = Checkpoint.load( planPath )
+            if checkpoint is None:
+                inkex.errormsg("%s: no checkpoint for %s, so it can't be resumed." % ( name, planPath ))
+                continue
+            inkex.errormsg("%s (%s): resuming from %s" % ( name, ms.serial_path, checkpoint ))
+            farm.add( name, ms, planPath, checkpoint )
+        for name in sorted( plans ):
+            inkex.errormsg("%s: not in this farm, so %s is left as it is." % ( name, plans[name] ))
+
+        if farm.runners:
+            self.runFarm( farm )
+
+    def runFarm( self, farm ):
+        '''Plot the farm's plans, then report, and keep what's unfinished'''
+        complete = farm.run()
+        summary = farm.summary()
+        inkex.errormsg( summary )
+        self.debugNote( summary )
+
+        for r in farm.runners:
+            if r.checkpoint.offset == r.total and r.error is None:
+                os.remove( r.plan_path )
+            else:
+                inkex.errormsg("%s stopped; its checkpoint is in %s" % ( r.name, r.checkpoint.path() ))
+        if not complete:
+            inkex.errormsg('Use "Resume" with the same farm settings to carry on.')
+
     def recursivelyTraverseSvg( self, aNodeList,
             matCurrent=[[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
             parent_visibility='visible' ):
@@ -527,11 +1016,14 @@ class Muralizer( inkex.Effect ):
                 pass
 
             # first apply the current matrix transform to this node's tranform
-            matNew = composeTransform( matCurrent, parseTransform( node.get( "transform" ) ) )
+            matNew = compose_transform( matCurrent, parse_transform( node.get( "transform" ) ) )
 
             if node.tag == inkex.addNS( 'g', 'svg' ) or node.tag == 'g':
 
-                self.ms.cmd_pen_up()
+                if not self.pathPool:
+                    # (Pooled paths before this one may not be plotted
+                    # yet; every stroke ends pen up anyway)
+                    self.ms.cmd_pen_up()
                 if ( node.get( inkex.addNS( 'groupmode', 'inkscape' ) ) == 'layer' ):
                     if not self.allLayers:
                         #inkex.errormsg('Plotting layer named: ' + node.get(inkex.addNS('label', 'inkscape')))
@@ -541,10 +1033,11 @@ class Muralizer( inkex.Effect ):
             elif node.tag == inkex.addNS( 'use', 'svg' ) or node.tag == 'use':
 
                 # A <use> element refers to another SVG element via an xlink:href="#blah"
-                # attribute.  We will handle the element by doing an XPath search through
-                # the document, looking for the element with the matching id="blah"
-                # attribute.  We then recursively process that element after applying
-                # any necessary (x,y) translation.
+                # attribute.  We will handle the element by looking up the element with
+                # the matching id="blah" attribute in an index of the document's ids.
+                # We then recursively process that element after applying any necessary
+                # (x,y) translation.  Paths drawn this way have their geometry cached,
+                # since the same few motifs tend to be cloned over and over.
                 #
                 # Notes:
                 #  1. We ignore the height and width attributes as they do not apply to
@@ -556,18 +1049,21 @@ class Muralizer( inkex.Effect ):
                 refid = node.get( inkex.addNS( 'href', 'xlink' ) )
                 if refid:
                     # [1:] to ignore leading '#' in reference
-                    path = '//*[@id="%s"]' % refid[1:]
-                    refnode = node.xpath( path )
+                    refnode = self.findById( refid[1:] )
                     if refnode:
                         x = float( node.get( 'x', '0' ) )
                         y = float( node.get( 'y', '0' ) )
                         # Note: the transform has already been applied
                         if ( x != 0 ) or (y != 0 ):
-                            matNew2 = composeTransform( matNew, parseTransform( 'translate(%f,%f)' % (x,y) ) )
+                            matNew2 = compose_transform( matNew, translate_transform( x, y ) )
                         else:
                             matNew2 = matNew
                         v = node.get( 'visibility', v )
-                        self.recursivelyTraverseSvg( refnode, matNew2, parent_visibility=v )
+                        self.cloneDepth += 1
+                        try:
+                            self.recursivelyTraverseSvg( refnode, matNew2, parent_visibility=v )
+                        finally:
+                            self.cloneDepth -= 1
                     else:
                         pass
                 else:
@@ -594,16 +1090,11 @@ class Muralizer( inkex.Effect ):
 
             elif node.tag == inkex.addNS( 'rect', 'svg' ) or node.tag == 'rect':
 
-                # Manually transform
+                # Draw
                 #
                 #    <rect x="X" y="Y" width="W" height="H"/>
                 #
-                # into
-                #
-                #    <path d="MX,Y lW,0 l0,H l-W,0 z"/>
-                #
-                # I.e., explicitly draw three sides of the rectangle and the
-                # fourth side implicitly
+                # as the closed outline (X,Y) (X+W,Y) (X+W,Y+H) (X,Y+H) (X,Y)
 
                 self.pathcount += 1
                 # if we're in resume mode AND self.pathcount < self.svgLastPath,
@@ -616,36 +1107,19 @@ class Muralizer( inkex.Effect ):
                 if self.resumeMode and ( self.pathcount < self.svgLastPath ):
                     pass
                 else:
-                    # Create a path with the outline of the rectangle
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
                     x = float( node.get( 'x' ) )
                     y = float( node.get( 'y' ) )
                     w = float( node.get( 'width' ) )
                     h = float( node.get( 'height' ) )
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    a = []
-                    a.append( ['M ', [x, y]] )
-                    a.append( [' l ', [w, 0]] )
-                    a.append( [' l ', [0, h]] )
-                    a.append( [' l ', [-w, 0]] )
-                    a.append( [' Z', []] )
-                    newpath.set( 'd', simplepath.formatPath( a ) )
-                    self.plotPath( newpath, matNew )
+                    self.plotCoords( rect_coords( x, y, w, h, matNew, self.flatTolerance() ) )
 
             elif node.tag == inkex.addNS( 'line', 'svg' ) or node.tag == 'line':
 
-                # Convert
+                # Draw
                 #
                 #   <line x1="X1" y1="Y1" x2="X2" y2="Y2/>
                 #
-                # to
-                #
-                #   <path d="MX1,Y1 LX2,Y2"/>
+                # from (X1,Y1) to (X2,Y2)
 
                 self.pathcount += 1
                 # if we're in resume mode AND self.pathcount < self.svgLastPath,
@@ -659,43 +1133,25 @@ class Muralizer( inkex.Effect ):
                 if self.resumeMode and ( self.pathcount < self.svgLastPath ):
                     pass
                 else:
-                    # Create a path to contain the line
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
                     x1 = float( node.get( 'x1' ) )
                     y1 = float( node.get( 'y1' ) )
                     x2 = float( node.get( 'x2' ) )
                     y2 = float( node.get( 'y2' ) )
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    a = []
-                    a.append( ['M ', [x1, y1]] )
-                    a.append( [' L ', [x2, y2]] )
-                    newpath.set( 'd', simplepath.formatPath( a ) )
-                    self.plotPath( newpath, matNew )
+                    self.plotCoords( line_coords( x1, y1, x2, y2, matNew, self.flatTolerance() ) )
                     if ( not self.bStopped ):    #an "index" for resuming plots quickly-- record last complete path
                         self.svgLastPath += 1
                         self.svgLastPathNC = self.nodeCount
 
             elif node.tag == inkex.addNS( 'polyline', 'svg' ) or node.tag == 'polyline':
 
-                # Convert
+                # Draw
                 #
                 #  <polyline points="x1,y1 x2,y2 x3,y3 [...]"/>
                 #
-                # to
-                #
-                #   <path d="Mx1,y1 Lx2,y2 Lx3,y3 [...]"/>
+                # through (x1,y1) (x2,y2) (x3,y3) [...]
                 #
                 # Note: we ignore polylines with no points
 
-                pl = node.get( 'points', '' ).strip()
-                if pl == '':
-                    pass
-
                 self.pathcount += 1
                 #if we're in resume mode AND self.pathcount < self.svgLastPath, then skip over this path.
                 #if we're in resume mode and self.pathcount = self.svgLastPath, then start here, and set
@@ -708,45 +1164,22 @@ class Muralizer( inkex.Effect ):
                     pass
 
                 else:
-                    pa = pl.split()
-                    if not len( pa ):
-                        pass
-                    # Issue 29: pre 2.5.? versions of Python do not have
-                    #    "statement-1 if expression-1 else statement-2"
-                    # which came out of PEP 308, Conditional Expressions
-                    #d = "".join( ["M " + pa[i] if i == 0 else " L " + pa[i] for i in range( 0, len( pa ) )] )
-                    d = "M " + pa[0]
-                    for i in range( 1, len( pa ) ):
-                        d += " L " + pa[i]
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    newpath.set( 'd', d );
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    self.plotPath( newpath, matNew )
+                    pa = parse_points( node.get( 'points' ) )
+                    self.plotCoords( polyline_coords( pa, matNew, self.flatTolerance() ) )
                     if ( not self.bStopped ):    #an "index" for resuming plots quickly-- record last complete path
                         self.svgLastPath += 1
                         self.svgLastPathNC = self.nodeCount
 
             elif node.tag == inkex.addNS( 'polygon', 'svg' ) or node.tag == 'polygon':
 
-                # Convert
+                # Draw
                 #
                 #  <polygon points="x1,y1 x2,y2 x3,y3 [...]"/>
                 #
-                # to
-                #
-                #   <path d="Mx1,y1 Lx2,y2 Lx3,y3 [...] Z"/>
+                # through (x1,y1) (x2,y2) (x3,y3) [...] and back to (x1,y1)
                 #
                 # Note: we ignore polygons with no points
 
-                pl = node.get( 'points', '' ).strip()
-                if pl == '':
-                    pass
-
                 self.pathcount += 1
                 #if we're in resume mode AND self.pathcount < self.svgLastPath, then skip over this path.
                 #if we're in resume mode and self.pathcount = self.svgLastPath, then start here, and set
@@ -759,26 +1192,8 @@ class Muralizer( inkex.Effect ):
                     pass
 
                 else:
-                    pa = pl.split()
-                    if not len( pa ):
-                        pass
-                    # Issue 29: pre 2.5.? versions of Python do not have
-                    #    "statement-1 if expression-1 else statement-2"
-                    # which came out of PEP 308, Conditional Expressions
-                    #d = "".join( ["M " + pa[i] if i == 0 else " L " + pa[i] for i in range( 0, len( pa ) )] )
-                    d = "M " + pa[0]
-                    for i in range( 1, len( pa ) ):
-                        d += " L " + pa[i]
-                    d += " Z"
-                    newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                    newpath.set( 'd', d );
-                    s = node.get( 'style' )
-                    if s:
-                        newpath.set( 'style', s )
-                    t = node.get( 'transform' )
-                    if t:
-                        newpath.set( 'transform', t )
-                    self.plotPath( newpath, matNew )
+                    pa = parse_points( node.get( 'points' ) )
+                    self.plotCoords( polyline_coords( pa, matNew, self.flatTolerance(), closed=True ) )
                     if ( not self.bStopped ):    #an "index" for resuming plots quickly-- record last complete path
                         self.svgLastPath += 1
                         self.svgLastPathNC = self.nodeCount
@@ -788,19 +1203,9 @@ class Muralizer( inkex.Effect ):
                 node.tag == inkex.addNS( 'circle', 'svg' ) or \
                 node.tag == 'circle':
 
-                    # Convert circles and ellipses to a path with two 180 degree arcs.
-                    # In general (an ellipse), we convert
-                    #
-                    #   <ellipse rx="RX" ry="RY" cx="X" cy="Y"/>
-                    #
-                    # to
-                    #
-                    #   <path d="MX1,CY A RX,RY 0 1 0 X2,CY A RX,RY 0 1 0 X1,CY"/>
-                    #
-                    # where
-                    #
-                    #   X1 = CX - RX
-                    #   X2 = CX + RX
+                    # Draw circles and ellipses as polygons, fine enough to stay
+                    # within the smoothing tolerance, starting from the leftmost
+                    # point, (CX - RX, CY)
                     #
                     # Note: ellipses or circles with a radius attribute of value 0 are ignored
 
@@ -827,22 +1232,7 @@ class Muralizer( inkex.Effect ):
                     else:
                         cx = float( node.get( 'cx', '0' ) )
                         cy = float( node.get( 'cy', '0' ) )
-                        x1 = cx - rx
-                        x2 = cx + rx
-                        d = 'M %f,%f ' % ( x1, cy ) + \
-                            'A %f,%f ' % ( rx, ry ) + \
-                            '0 1 0 %f,%f ' % ( x2, cy ) + \
-                            'A %f,%f ' % ( rx, ry ) + \
-                            '0 1 0 %f,%f' % ( x1, cy )
-                        newpath = inkex.etree.Element( inkex.addNS( 'path', 'svg' ) )
-                        newpath.set( 'd', d );
-                        s = node.get( 'style' )
-                        if s:
-                            newpath.set( 'style', s )
-                        t = node.get( 'transform' )
-                        if t:
-                            newpath.set( 'transform', t )
-                        self.plotPath( newpath, matNew )
+                        self.plotCoords( ellipse_coords( cx, cy, rx, ry, matNew, self.flatTolerance() ) )
                         if ( not self.bStopped ):    #an "index" for resuming plots quickly-- record last complete path
                             self.svgLastPath += 1
                             self.svgLastPathNC = self.nodeCount
@@ -906,6 +1296,22 @@ class Muralizer( inkex.Effect ):
                     self.warnings[str( node.tag )] = 1
                 pass
 
+    def findById( self, id ):
+        '''
+        Every element with the given id, in document order.  The index
+        is built on the first lookup, rather than searching the whole
+        document for each <use>.
+        '''
+        if self.idIndex is None:
+            self.idIndex = {}
+            for node in self.svg.iter():
+                if not isinstance( node.tag, basestring ):
+                    continue # comments and processing instructions
+                nodeId = node.get( 'id' )
+                if nodeId is not None:
+                    self.idIndex.setdefault( nodeId, [] ).append( node )
+        return self.idIndex.get( id, [] )
+
     def DoWePlotLayer( self, strLayerName ):
         """
         We are only plotting *some* layers. Check to see
@@ -982,56 +1388,198 @@ class Muralizer( inkex.Effect ):
         Plot the path while applying the transformation defined
         by the matrix [matTransform].
         '''
-        # turn this path into a cubicsuperpath (list of beziers)...
-
         d = path.get( 'd' )
 
-        if len( simplepath.parsePath( d ) ) == 0:
+        if self.pathPool:
+            # A worker flattens it; plotPooledPaths plots it in turn
+            if not self.bStopped:
+                self.pathPool.submit( d, matTransform, ( self.pathcount, self.plotCurrentLayer ),
+                                      clone=self.cloneDepth > 0 )
+                self.plotPooledPaths()
             return
 
-        p = cubicsuperpath.parsePath( d )
+        # Parse, transform onto the wall, and flatten in mm
+        flat = self.flatTolerance()
+        if self.cloneDepth:
+            if self.cloneGeometry is None:
+                self.cloneGeometry = GeometryCache( flat )
+            self.plotFlattened( self.cloneGeometry.coords( d, matTransform ) )
+        else:
+            self.plotFlattened( path_coords( d, matTransform, flat ) )
 
-        # ...and apply the transformation to each point
-        applyTransformToPath( matTransform, p )
+    def plotCoords( self, flattened ):
+        '''
+        Plot a shape already turned into wall coordinates, as
+        path_coords would give them, in its turn among pooled paths.
+        '''
+        if self.pathPool:
+            if not self.bStopped:
+                self.pathPool.submit_coords( flattened, ( self.pathcount, self.plotCurrentLayer ) )
+                self.plotPooledPaths()
+            return
 
-        # p is now a list of lists of cubic beziers [control pt1, control pt2, endpoint]
-        # where the start-point is the last point in the previous segment.
-        for sp in p:
+        self.plotFlattened( flattened )
 
-            subdivideCubicPath( sp, self.options.smoothness )
-            nIndex = 0
+    def flatTolerance( self ):
+        '''How far (mm) flattened curves may stray from the real ones'''
+        return tolerance_for( self.options.smoothness, self.ms.stepMM )
 
-            for csp in sp:
-                if self.bStopped:
-                    return
+    def plotFlattened( self, flattened ):
+        '''Plot (or collect) a path flattened by path_coords'''
+        for coords in flattened:
+            points = coords_to_points( coords )
 
+            if self.strokes is not None:
+                # Collecting for the ordering stage; plotted later
                 if self.plotCurrentLayer:
-                    if nIndex == 0: # Pen up to start of curve
-                        self.ms.cmd_pen_up()
-                        self.virtualPenIsUp = True
-                    elif nIndex == 1: # Pen down to the end of the curve
-                        self.ms.cmd_pen_down()
-                        self.virtualPenIsUp = False
+                    self.strokes.append( points )
+                continue
 
-                nIndex += 1
+            self.plotStroke( points )
+            if self.bStopped:
+                return
 
-                self.fX = float( csp[1][0] )
-                self.fY = float( csp[1][1] )
+    def startPathPool( self ):
+        '''Hand path geometry to worker processes, with planWorkers'''
+        if self.options.planWorkers > 0:
+            self.pathPool = PathPool( self.options.planWorkers, self.flatTolerance() )
 
-                # Precondition: where the heck are we coming from?
-                if self.ptFirst is None:
-                    self.fPrevX = self.ms.area_x()
-                    self.fPrevY = self.ms.area_y()
+    def stopPathPool( self ):
+        if self.pathPool:
+            self.debugNote( self.pathPool.summary() )
+            self.pathPool.close()
+            self.pathPool = None
 
-                    self.ptFirst = (self.fPrevX, self.fPrevY)
+    def plotPooledPaths( self, finish=False ):
+        '''
+        Plot the paths the workers have finished, in document order.
+        With [finish], wait for all of them.
+        '''
+        for ( tag, flattened ) in self.pathPool.results( finish ):
+            # Plot it as of when the traversal reached it
+            current = ( self.pathcount, self.plotCurrentLayer )
+            ( self.pathcount, self.plotCurrentLayer ) = tag
+            nodes = self.nodeCount
+            self.plotFlattened( flattened )
+            ( self.pathcount, self.plotCurrentLayer ) = current
+
+            if self.bStopped:
+                # The traversal has counted paths we never got to as done
+                self.svgLastPath = tag[0] - 1
+                self.svgLastPathNC = nodes
+                return
 
+    def plotStroke( self, points ):
+        '''
+        Plot one flattened subpath, given as a list of (x,y) points
+        in the drawing area: pen up to its start, then pen down along it.
+        '''
+        nIndex = 0
 
-                if self.plotCurrentLayer:
-                    self.plotLineAndTime()
-                    self.fPrevX = self.fX
-                    self.fPrevY = self.fY
+        for (x, y) in points:
+            if self.bStopped:
+                return
+
+            if self.plotCurrentLayer:
+                if nIndex == 0: # Pen up to start of curve
+                    self.ms.cmd_pen_up()
+                    self.virtualPenIsUp = True
+                elif nIndex == 1: # Pen down to the end of the curve
+                    self.ms.cmd_pen_down()
+                    self.virtualPenIsUp = False
+
+                    if not self.resumeMode:
+                        self.plotRun( points[1:] )
+                        break
+
+            nIndex += 1
+
+            self.fX = x
+            self.fY = y
 
-            self.ms.cmd_pen_up() # Raise the pen at the end of each curve
+            # Precondition: where the heck are we coming from?
+            if self.ptFirst is None:
+                self.fPrevX = self.ms.area_x()
+                self.fPrevY = self.ms.area_y()
+
+                self.ptFirst = (self.fPrevX, self.fPrevY)
+
+
+            if self.plotCurrentLayer:
+                self.plotLineAndTime()
+                self.fPrevX = self.fX
+                self.fPrevY = self.fY
+
+        self.ms.cmd_pen_up() # Raise the pen at the end of each curve
+
+    def plotRun( self, points ):
+        '''
+        Draw through [points] with the pen down, handing the whole run
+        to the batch kinematics at once.  Nodes are counted and skipped
+        just as plotLineAndTime would do one at a time.
+        '''
+        start = ( self.fPrevX, self.fPrevY )
+
+        run = []
+        for (x, y) in points:
+            if int( x ) != int( self.fPrevX ) or int( y ) != int( self.fPrevY ):
+                run.append( (x, y) )
+            self.fPrevX = x
+            self.fPrevY = y
+
+        self.fX = self.fPrevX
+        self.fY = self.fPrevY
+
+        n = len( run )
+        nodes = self.nodeCount + 1
+        if self.options.lineTolerance > 0:
+            # Split moves so they stay straight on the wall, not just in spool space
+            tol = tolerance_for( self.options.lineTolerance, self.ms.stepMM )
+            run, index = self.ms.straight_run( start, run, tol )
+            nodes = [nodes + i for i in index]
+
+        self.ms.go_to_area_batch( run, self.pathcount, nodes )
+        self.nodeCount += n
+
+        if self.ms.cmd_button_down():
+            self.svgNodeCount = self.nodeCount;
+            inkex.errormsg( 'Plot paused by button press after segment number ' + str( self.nodeCount ) + '.' )
+            inkex.errormsg( 'Use the "resume" feature to continue.' )
+            self.bStopped = True
+
+    def plotCollectedStrokes( self ):
+        '''
+        Plot the strokes gathered by plotPath when the joining or
+        ordering stages are on, after joining strokes that meet and
+        reordering them to cut down on pen-up travel.
+        '''
+        strokes = self.strokes
+        self.strokes = None
+
+        if self.options.joinPaths:
+            n = len( strokes )
+            strokes, saved = join_strokes( strokes, self.options.joinTolerance )
+            msg = "Joined %d subpaths into %d strokes, saving %d pen lifts" % \
+                ( n, len( strokes ), saved )
+            inkex.errormsg( msg )
+            self.debugNote( msg )
+
+        if self.options.reorderPaths:
+            start = ( self.ms.area_x(), self.ms.area_y() )
+            before = pen_up_travel( strokes, self.ms.spool_steps, start )
+
+            strokes = order_strokes( strokes, self.ms.spool_steps, start )
+
+            after = pen_up_travel( strokes, self.ms.spool_steps, start )
+            msg = "Pen-up travel: %.0f steps (%.0f mm) before ordering, %.0f steps (%.0f mm) after" % \
+                ( before[0], before[1], after[0], after[1] )
+            inkex.errormsg( msg )
+            self.debugNote( msg )
+
+        for points in strokes:
+            self.plotStroke( points )
+            if self.bStopped:
+                return
 
     def doTimedPause( self, nPause ):
         while ( nPause > 0 ):
@@ -1077,6 +1625,7 @@ class Muralizer( inkex.Effect ):
             # Actual motion control
 
             if not self.resumeMode:
+                self.ms.set_cursor(self.pathcount, self.nodeCount)
                 self.ms.go_to_area(self.fX, self.fY)
 
             ####################
@@ -1096,5 +1645,6 @@ def distance( x, y ):
     '''
     return sqrt( x * x + y * y )
 
-e = Muralizer()
-e.affect()
+if __name__ == '__main__':
+    e = Muralizer()
+    e.affect()
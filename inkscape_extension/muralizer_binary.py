@@ -0,0 +1,482 @@
+import threading
+import time
+
+from muralizer_sender import SenderError
+
+# Binary framing for the serial link.
+#
+# In ASCII, every move is "r 12 -3\n" going out and "Rotating 12 -3"
+# (or "Done 12 -3") coming back, over 20 bytes a move at 9600 baud.
+# In binary mode moves are packed into frames,
+#
+#   0xA5  seq  len  payload[len]  crc8(seq, len, payload)
+#
+# whose payload is a run of ops:
+#
+#   0x00-0xE0   a short move, dr0 and dr1 in -7..7: (dr0+7)*15 + (dr1+7)
+#   0xF0 v0 v1  any other move, dr0 and dr1 as zigzag varints
+#   0xF1        pen up
+#   0xF2        pen down
+#   0xFE        back to ASCII at 9600 baud, after acknowledging
+#
+# The firmware runs a frame's ops and then acknowledges it with ACK
+# seq ~seq.  An ACK covers every frame up to seq.  A frame with a bad
+# CRC, or too long for the firmware's buffer, gets NAK seq ~seq with
+# the sequence number it wanted, and so does a good frame that comes
+# after one the firmware is missing; it isn't run.  A repeat of a
+# frame it has already run (its ACK was lost) is acknowledged again
+# but not run.  The host keeps up to [window] frames unacknowledged.
+# When the oldest is overdue it sends them all again, oldest first
+# (go-back-N).  On a NAK it does the same, but only after
+# NAK_RESEND_DELAY_S: after a bad frame the firmware throws input away
+# until the line has been quiet for 20 ms, and would lose a resend
+# that came sooner.
+#
+# Binary mode is negotiated with the existing "v" command.  Firmware
+# that speaks it answers "v b" with "3.1 b"; older firmware just says
+# "3.1".  "b <baud>" then switches, answered with "Binary <baud>" at
+# the old rate.
+
+FRAME_SYNC = 0xA5
+FRAME_PAYLOAD = 48  # the firmware's frame buffer
+ACK = 0x06
+NAK = 0x15
+
+SHORT_MOVE = 7  # largest |dr| of a one-byte move
+OP_MOVE = 0xF0
+OP_PEN_UP = 0xF1
+OP_PEN_DOWN = 0xF2
+OP_ASCII = 0xFE
+
+ASCII_BAUD = 9600
+BINARY_BAUD = 57600
+BAUD_SWITCH_S = 0.05  # for the firmware to come back at the new rate
+
+FRAME_WINDOW = 2  # one frame running, one waiting in the serial buffer
+
+# How long to wait for a frame's ACK before sending it again
+ACK_TIMEOUT_S = 1.0
+ACK_TIMEOUT_PER_STEP_S = 0.05  # twice the nominal step time
+ACK_TIMEOUT_PER_PEN_S = 1.5
+MAX_RETRIES = 8
+
+# How long to hold off resending after a NAK: longer than the
+# firmware's FRAME_QUIET_MS, plus a window of frames still on the wire
+NAK_RESEND_DELAY_S = 0.1
+
+
+def crc8(data, crc=0):
+    """CRC-8, polynomial 0x07, over the byte values in [data]"""
+    for b in data:
+        crc ^= b
+        for i in range(8):
+            if crc & 0x80:
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return crc
+
+
+def zigzag_varint(n):
+    """[n] as a zigzag-encoded varint: small magnitudes, few bytes"""
+    if n >= 0:
+        z = 2*n
+    else:
+        z = -2*n - 1
+    out = bytearray()
+    while z >= 0x80:
+        out.append((z & 0x7F) | 0x80)
+        z >>= 7
+    out.append(z)
+    return out
+
+
+def read_varint(data, i):
+    """(value, next index) of the zigzag varint at data[i]"""
+    z = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        z |= (b & 0x7F) << shift
+        if not b & 0x80:
+            break
+        shift += 7
+    if z & 1:
+        return (-(z >> 1) - 1, i)
+    return (z >> 1, i)
+
+
+def encode_move(dr0, dr1):
+    dr0 = int(dr0)
+    dr1 = int(dr1)
+    if -SHORT_MOVE <= dr0 <= SHORT_MOVE and -SHORT_MOVE <= dr1 <= SHORT_MOVE:
+        return bytearray([(dr0 + SHORT_MOVE)*(2*SHORT_MOVE + 1) + dr1 + SHORT_MOVE])
+    return bytearray([OP_MOVE]) + zigzag_varint(dr0) + zigzag_varint(dr1)
+
+
+def encode_command(line):
+    """The ops for ASCII command [line], or None if it has none"""
+    f = line.split()
+    if f[0] == "r":
+        return encode_move(int(f[1]), int(f[2]))
+    if f == ["p", "u"]:
+        return bytearray([OP_PEN_UP])
+    if f == ["p", "d"]:
+        return bytearray([OP_PEN_DOWN])
+    return None
+
+
+def decode_ops(payload):
+    """The (op, dr0, dr1) of each op in a frame's payload; dr0 and dr1
+    are 0 except for moves"""
+    ops = []
+    i = 0
+    short = 2*SHORT_MOVE + 1
+    while i < len(payload):
+        b = payload[i]
+        i += 1
+        if b < short*short:
+            ops.append((OP_MOVE, b//short - SHORT_MOVE, b % short - SHORT_MOVE))
+        elif b == OP_MOVE:
+            (dr0, i) = read_varint(payload, i)
+            (dr1, i) = read_varint(payload, i)
+            ops.append((OP_MOVE, dr0, dr1))
+        else:
+            ops.append((b, 0, 0))
+    return ops
+
+
+def frame(seq, payload):
+    """A whole frame, sync byte to CRC"""
+    head = bytearray([seq & 0xFF, len(payload)])
+    return bytearray([FRAME_SYNC]) + head + payload + \
+        bytearray([crc8(payload, crc8(head))])
+
+
+class FrameSender:
+    """Sends commands to firmware in binary mode, packed into frames
+
+    Takes the same calls as StreamingSender, with the same ASCII
+    command lines, so MuralizerState needn't know which one it has.
+    Ops go into the frame being built.  The frame goes out as soon as
+    the window has room, so while the device is busy, frames fill up,
+    and when it's waiting on us, they go out right away.  send() only
+    blocks when the frame is full and so is the window.
+    """
+    def __init__(self, serial_fd, window=FRAME_WINDOW, alert=None,
+                 telemetry=None, version=None, baud=BINARY_BAUD):
+        self.serial_fd = serial_fd
+        self.window = max(1, int(window))
+        self.alert = alert or (lambda s: None)
+        self.telemetry = telemetry
+        self.version = version
+        self.baud = baud
+
+        self.cond = threading.Condition()
+        self.ops = bytearray()  # the frame being built
+        self.ops_steps = 0
+        self.ops_pens = 0
+        self.ops_marks = []
+        self.seq = 0
+        self.in_flight = []  # [seq, frame, timeout, sent_at, tries, marks], oldest first
+        self.t_front = None  # when in_flight[0] became the oldest
+        self.t_resend = None  # when to resend after a NAK
+        self.error = None
+        self.running = True
+
+        self.reset_stats()
+
+        try:
+            self.serial_fd.timeout = 0.25
+        except AttributeError:
+            pass
+
+        self.reader = threading.Thread(target=self._reader_loop,
+                                       name="muralizer-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def reset_stats(self):
+        self.t_start = time.time()
+        self.t_last_ack = self.t_start
+        self.n_commands = 0
+        self.n_moves = 0
+        self.n_steps = 0
+        self.n_frames = 0
+        self.n_bytes_out = 0
+        self.n_bytes_in = 0
+        self.n_resent = 0
+        self.n_naks = 0
+        self.t_blocked = 0.0
+
+    def _check_error(self):
+        if self.error is not None:
+            raise SenderError(self.error)
+
+    def _wait(self, done):
+        """Wait on the condition until done() or an error"""
+        t0 = time.time()
+        while not done() and self.error is None:
+            self.cond.wait(0.25)
+        self.t_blocked += time.time() - t0
+        self._check_error()
+
+    def send(self, line, steps=0, mark=None):
+        """Add a command to the frame being built; [mark], if given,
+        is called once its frame has been acknowledged"""
+        op = encode_command(line)
+        if op is None:
+            raise SenderError("No binary form for command '%s'" % line)
+
+        self.cond.acquire()
+        try:
+            self._check_error()
+            if len(self.ops) + len(op) > FRAME_PAYLOAD:
+                self._wait(lambda: len(self.in_flight) < self.window)
+                self._send_frame()
+
+            self.ops += op
+            self.ops_steps += steps
+            if mark:
+                self.ops_marks.append(mark)
+            self.n_commands += 1
+            if steps:
+                self.n_moves += 1
+                self.n_steps += steps
+            if op[0] in (OP_PEN_UP, OP_PEN_DOWN):
+                self.ops_pens += 1
+
+            if len(self.in_flight) < self.window:
+                self._send_frame()
+        finally:
+            self.cond.release()
+
+    def query(self, line):
+        """Only "v" can be asked in binary mode: the version we
+        negotiated with"""
+        if line.strip() != "v":
+            raise SenderError("Can't ask '%s' in binary mode" % line)
+        self.drain()
+        return self.version
+
+    def drain(self):
+        """Send the frame being built, and wait until every frame has
+        been acknowledged (and so run)"""
+        self.cond.acquire()
+        try:
+            self._check_error()
+            if self.ops:
+                self._wait(lambda: len(self.in_flight) < self.window)
+                self._send_frame()
+            self._wait(lambda: not self.in_flight)
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Put the firmware back in ASCII mode, and stop the reader"""
+        try:
+            if self.error is None:
+                self.drain()
+                self.cond.acquire()
+                try:
+                    self.ops = bytearray([OP_ASCII])
+                    self._send_frame()
+                    self._wait(lambda: not self.in_flight)
+                finally:
+                    self.cond.release()
+                time.sleep(BAUD_SWITCH_S)
+                try:
+                    self.serial_fd.baudrate = ASCII_BAUD
+                except AttributeError:
+                    pass
+        except SenderError as e:
+            self.alert("BINARY: couldn't go back to ASCII: %s" % e)
+        finally:
+            self.running = False
+            self.reader.join(2.0)
+
+    def _send_frame(self):
+        """Frame up the ops built so far, and send it; with the lock held"""
+        if not self.ops:
+            return
+        data = frame(self.seq, self.ops)
+        timeout = ACK_TIMEOUT_S + self.ops_steps*ACK_TIMEOUT_PER_STEP_S + \
+            self.ops_pens*ACK_TIMEOUT_PER_PEN_S
+        now = time.time()
+        if not self.in_flight:
+            self.t_front = now
+            if self.telemetry:
+                self.telemetry.device_busy(now)
+        self.in_flight.append([self.seq, data, timeout, now, 0, self.ops_marks])
+        self.seq = (self.seq + 1) & 0xFF
+        self.ops = bytearray()
+        self.ops_steps = 0
+        self.ops_pens = 0
+        self.ops_marks = []
+        self.n_frames += 1
+        if self.t_resend is None:
+            self._write(data)  # else it goes with the resend
+
+    def _write(self, data):
+        t0 = time.time()
+        self.serial_fd.write(bytes(data))
+        self.n_bytes_out += len(data)
+        if self.telemetry:
+            self.telemetry.record("write", time.time() - t0)
+
+    def _resend(self, why):
+        """Send every unacknowledged frame again, oldest first"""
+        if not self.in_flight:
+            return
+        if self.in_flight[0][4] >= MAX_RETRIES:
+            self.error = "Frame %d not acknowledged after %d tries (%s)" % \
+                (self.in_flight[0][0], MAX_RETRIES + 1, why)
+            self.cond.notifyAll()
+            return
+
+        self.alert("BINARY: resending %d frames from %d: %s" %
+                   (len(self.in_flight), self.in_flight[0][0], why))
+        now = time.time()
+        self.t_front = now
+        for f in self.in_flight:
+            f[3] = now
+            f[4] += 1
+            self.n_resent += 1
+            self._write(f[1])
+
+    def _index(self, seq):
+        for (i, f) in enumerate(self.in_flight):
+            if f[0] == seq:
+                return i
+        return None
+
+    def _handle(self, kind, seq):
+        done = []  # frames the firmware has run
+        self.cond.acquire()
+        try:
+            now = time.time()
+            if kind == ACK:
+                i = self._index(seq)
+                if i is None:
+                    return  # a repeat of an ACK we've had
+                for f in self.in_flight[:i + 1]:
+                    if self.telemetry:
+                        self.telemetry.record("reply", now - f[3])
+                done = self.in_flight[:i + 1]
+                del self.in_flight[:i + 1]
+                self.t_front = now
+                self.t_last_ack = now
+                if not self.in_flight:
+                    self.t_resend = None
+                    if self.telemetry:
+                        self.telemetry.device_idle(now)
+            else:
+                self.n_naks += 1
+                i = self._index(seq)
+                if i is None:
+                    if seq != self.seq:
+                        return  # stale: it's asking for one we've had acknowledged
+                    i = len(self.in_flight)  # it's run everything we've sent
+                done = self.in_flight[:i]  # the firmware has run these
+                del self.in_flight[:i]
+                self.t_front = now
+                if self.in_flight:
+                    # Let the firmware finish discarding first
+                    self.t_resend = now + NAK_RESEND_DELAY_S
+                else:
+                    self.t_resend = None
+                    if self.telemetry:
+                        self.telemetry.device_idle(now)
+
+            # There's room now: ops built while the window was full
+            # shouldn't wait for the next send()
+            if self.ops and self.t_resend is None and self.error is None and \
+                    len(self.in_flight) < self.window:
+                self._send_frame()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        for f in done:
+            for mark in f[5]:
+                mark()
+
+    def _check_timeout(self):
+        self.cond.acquire()
+        try:
+            now = time.time()
+            if not self.in_flight or self.error is not None:
+                pass
+            elif self.t_resend is not None:
+                if now >= self.t_resend:
+                    self.t_resend = None
+                    self._resend("NAK")
+            else:
+                f = self.in_flight[0]
+                if now - max(f[3], self.t_front) > f[2]:
+                    self._resend("timed out")
+        finally:
+            self.cond.release()
+
+    def _reader_loop(self):
+        # Replies are [ACK or NAK] seq ~seq; anything else is skipped
+        pending = bytearray()
+        while self.running:
+            try:
+                data = self.serial_fd.read(3 - len(pending))
+            except Exception as e:
+                self.cond.acquire()
+                self.error = "Serial read failed: %s" % e
+                self.cond.notifyAll()
+                self.cond.release()
+                return
+
+            if not data:
+                self._check_timeout()
+                continue
+
+            self.n_bytes_in += len(data)
+            pending += bytearray(data)
+            try:
+                while len(pending) >= 3:
+                    if pending[0] in (ACK, NAK) and pending[1] ^ pending[2] == 0xFF:
+                        self._handle(pending[0], pending[1])
+                        pending = pending[3:]
+                    else:
+                        pending = pending[1:]  # out of step; look again
+                self._check_timeout()
+            except Exception as e:
+                # Don't leave the senders waiting on a dead reader
+                self.cond.acquire()
+                self.error = "Reply handling failed: %s" % e
+                self.cond.notifyAll()
+                self.cond.release()
+                return
+
+    def stats(self):
+        elapsed = max(self.t_last_ack - self.t_start, 1e-6)
+        return {
+            "commands": self.n_commands,
+            "moves": self.n_moves,
+            "steps": self.n_steps,
+            "frames": self.n_frames,
+            "bytes_out": self.n_bytes_out,
+            "bytes_in": self.n_bytes_in,
+            "resent": self.n_resent,
+            "naks": self.n_naks,
+            "elapsed_s": elapsed,
+            "blocked_s": self.t_blocked,
+            "commands_per_s": self.n_commands/elapsed,
+            "moves_per_s": self.n_moves/elapsed,
+            "bytes_per_move": self.n_moves and float(self.n_bytes_out + self.n_bytes_in)/self.n_moves or 0.0,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return ("Sent %d commands (%d moves, %d steps) in %d frames, %d bytes out, "
+                "%d in (%.1f a move) at %d baud, in %.1f s: %.1f moves/s; "
+                "%d frames resent, %d NAKs"
+                % (s["commands"], s["moves"], s["steps"], s["frames"],
+                   s["bytes_out"], s["bytes_in"], s["bytes_per_move"], self.baud,
+                   s["elapsed_s"], s["moves_per_s"], s["resent"], s["naks"]))
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from muralizer_plan import PLAN_VERSION, PLAN_MACHINE_OPTIONS
+
+# On-disk cache of compiled plans.
+#
+# Replotting an unchanged document (say, after a stall) shouldn't mean
+# parsing, flattening and solving the kinematics all over again.  A
+# plan is keyed by a hash of the drawing plus every option that changes
+# what gets drawn, and stored as a plan file under that key; a hit is
+# just replayed.
+#
+# Files are <key>.murp in the cache directory.  Their mtimes are
+# bumped on every hit, and the least recently used ones are deleted
+# whenever the directory grows past its size limit.  Hit/miss counts
+# are kept in stats.json alongside.
+
+# Bump this whenever the planner changes what it would emit for the
+# same document, so that stale plans are never replayed
+CACHE_VERSION = 3
+
+# Options, besides PLAN_MACHINE_OPTIONS, that change the commands the
+# planner emits
+PLAN_CACHE_OPTIONS = ("smoothness", "lineTolerance", "optimizeCommands",
+                      "reorderPaths", "joinPaths", "joinTolerance")
+
+# Top-level elements that don't affect the plot.  The eggbot element
+# holds resume state and is rewritten on every run.
+IGNORED_TAGS = ("eggbot", "namedview", "metadata")
+
+PLAN_SUFFIX = ".murp"
+STATS_FILE = "stats.json"
+
+
+def _local_name(tag):
+    if not isinstance(tag, basestring):
+        return None  # comments and processing instructions
+    return tag.rsplit("}", 1)[-1]
+
+
+def document_key(svg, options, extra=()):
+    """Cache key for plotting <svg> root element [svg] with [options]
+
+    [extra] is anything else that decides what gets drawn, such as
+    the layer selection.
+    """
+    from lxml import etree
+
+    h = hashlib.sha1()
+    h.update("muralizer plan %d/%d\n" % (PLAN_VERSION, CACHE_VERSION))
+
+    for k in PLAN_MACHINE_OPTIONS + PLAN_CACHE_OPTIONS:
+        h.update("%s=%r\n" % (k, getattr(options, k, None)))
+    h.update("extra=%r\n" % (tuple(extra),))
+
+    for k, v in sorted(svg.attrib.items()):
+        h.update("%s=%s\n" % (k, v.encode("utf-8")))
+    for child in svg:
+        name = _local_name(child.tag)
+        if name is None or name in IGNORED_TAGS:
+            continue
+        h.update(etree.tostring(child))
+
+    return h.hexdigest()
+
+
+class PlanCache:
+    """A size-bounded directory of compiled plans"""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.stats_path = os.path.join(directory, STATS_FILE)
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        try:
+            self.stats.update(json.load(open(self.stats_path)))
+        except (IOError, ValueError):
+            pass
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + PLAN_SUFFIX)
+
+    def lookup(self, key):
+        """Path of the cached plan for [key], or None on a miss"""
+        path = self.path_for(key)
+        if os.path.exists(path):
+            os.utime(path, None)
+            self.stats["hits"] += 1
+            self._save_stats()
+            return path
+
+        self.stats["misses"] += 1
+        self._save_stats()
+        return None
+
+    def pending_path(self, key):
+        """Where to record a plan that store() will later take in"""
+        return os.path.join(self.directory, "%s.%d.tmp" % (key, os.getpid()))
+
+    def store(self, key, path):
+        """Add the plan at [path] to the cache under [key]
+
+        Plans recorded at pending_path() are moved in; anything else is
+        copied.  Either way the plan appears in the cache atomically.
+        """
+        dest = self.path_for(key)
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.directory):
+            tmp = path
+        else:
+            tmp = self.pending_path(key)
+            shutil.copyfile(path, tmp)
+
+        if os.path.exists(dest):
+            os.remove(dest)  # os.rename() won't replace on Windows
+        os.rename(tmp, dest)
+
+        self.stats["stores"] += 1
+        self.evict()
+        self._save_stats()
+        return dest
+
+    def discard(self, key):
+        """Drop an unfinished pending_path() plan"""
+        try:
+            os.remove(self.pending_path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        """(mtime, size, path) for every cached plan, oldest first"""
+        out = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(PLAN_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, path))
+        out.sort()
+        return out
+
+    def evict(self):
+        """Delete least recently used plans until we fit in max_bytes
+        (always keeping the newest one)"""
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        while len(entries) > 1 and total > self.max_bytes:
+            mtime, size, path = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.stats["evictions"] += 1
+
+    def _save_stats(self):
+        self.stats["updated"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            fd = open(self.stats_path, "w")
+            json.dump(self.stats, fd)
+            fd.close()
+        except IOError:
+            pass  # stats are nice to have, never worth failing a plot
+
+    def summary(self):
+        entries = self.entries()
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return ("Plan cache: %d hits, %d misses (%.0f%% hit rate), %d evicted; "
+                "%d plans, %.1f of %.1f MB, in %s"
+                % (self.stats["hits"], self.stats["misses"],
+                   lookups and 100.0*self.stats["hits"]/lookups or 0,
+                   self.stats["evictions"], len(entries),
+                   sum(e[1] for e in entries)/1048576.0,
+                   self.max_bytes/1048576.0, self.directory))
+
+
+if __name__ == '__main__':
+    # Show (or clear) the plan cache
+    import sys
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] cache-dir")
+    parser.add_option("--clear", action="store_true", default=False,
+                      help="Delete every cached plan and reset the stats")
+    parser.add_option("--max-mb", type="float", default=200,
+                      help="Size limit to report against")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need the cache directory")
+
+    cache = PlanCache(args[0], int(opts.max_mb*1048576))
+    if opts.clear:
+        for mtime, size, path in cache.entries():
+            os.remove(path)
+        if os.path.exists(cache.stats_path):
+            os.remove(cache.stats_path)
+        sys.exit(0)
+
+    print(cache.summary())
+    for mtime, size, path in reversed(cache.entries()):
+        print("%s  %8d  %s" % (time.strftime("%Y-%m-%d %H:%M", time.localtime(mtime)),
+                               size, os.path.basename(path)))
@@ -0,0 +1,467 @@
+import Queue
+import SocketServer
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from muralizer_plan import PlanReader, Checkpoint, replay_plan
+
+# Background plot daemon.
+#
+# Opening the port resets the board, and a plot can take hours, so
+# rather than doing both inside Inkscape, the extension compiles a plan
+# and hands it to a long-lived daemon that keeps the device open and
+# plots jobs one after another.  The extension gets a job id back
+# straight away and can ask how it's going later.
+#
+# The protocol is one JSON object per line over a TCP connection to
+# localhost (Windows has no Unix sockets):
+#
+#   {"cmd": "ping"}                         -> {"ok": true, "pid": ...}
+#   {"cmd": "submit", "plan": path,
+#    "cleanup": bool}                       -> {"ok": true, "job": id}
+#   {"cmd": "resume", "job": id}            -> {"ok": true, "job": new id}
+#   {"cmd": "status", "job": id}            -> {"ok": true, "jobs": [...]}
+#   {"cmd": "cancel", "job": id}            -> {"ok": true}
+#   {"cmd": "shutdown"}                     -> {"ok": true}
+#
+# Without a "job", status covers every job, resume picks the most
+# recent interrupted one, and cancel stops the running one.  Failures
+# come back as {"ok": false, "error": message}.
+#
+# There's no authentication: anyone who can connect to the port on
+# this machine, any user or program, can queue plans, cancel jobs or
+# shut the daemon down, and so drive the plotter.  "cleanup" is only
+# honoured for plans in the daemon's job directory (--jobDir, where
+# the extension writes them), so it can't be used to delete anything
+# else.
+
+DEFAULT_PORT = 47820
+HOST = "127.0.0.1"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+STARTUP_WAIT_S = 10.0  # for a freshly spawned daemon to start listening
+
+
+class DaemonError(Exception):
+    pass
+
+
+class Job:
+    """One plan to be plotted, and how far it's got"""
+    def __init__(self, job_id, plan_path, cleanup=False, checkpoint=None):
+        self.id = job_id
+        self.plan_path = plan_path
+        self.cleanup = cleanup  # delete the plan once it's plotted
+        self.checkpoint = checkpoint or Checkpoint(plan_path)
+        self.resumed = checkpoint is not None
+        self.state = QUEUED
+        self.total = None
+        self.error = None
+        self.cancel = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.start_offset = self.checkpoint.offset
+
+    def as_dict(self):
+        d = {"job": self.id, "plan": self.plan_path, "state": self.state,
+             "done": self.checkpoint.offset, "total": self.total,
+             "error": self.error, "submitted": self.submitted,
+             "started": self.started, "finished": self.finished}
+
+        if self.total:
+            d["percent"] = 100.0*self.checkpoint.offset/self.total
+        if self.started:
+            end = self.finished or time.time()
+            d["elapsed_s"] = end - self.started
+            sent = self.checkpoint.offset - self.start_offset
+            if self.state == RUNNING and sent > 0 and self.total:
+                d["eta_s"] = d["elapsed_s"]*(self.total - self.checkpoint.offset)/sent
+        return d
+
+
+class PlotDaemon:
+    """Owns the device connection and plots queued jobs in order
+
+    The MuralizerState (and with it the serial port) is created for
+    the first job and then kept for the life of the daemon, along with
+    its idea of where the gondola is, so later jobs start from there.
+    """
+    def __init__(self, port=DEFAULT_PORT, serial_kwargs=None, stream_window=4,
+                 log=None, job_dir=None):
+        self.port = port
+        self.job_dir = job_dir and os.path.realpath(job_dir)
+        self.serial_kwargs = serial_kwargs or {}
+        self.stream_window = stream_window
+        self.log = log or sys.stderr
+
+        self.ms = None
+        self.jobs = {}
+        self.next_id = 1
+        self.current = None
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+
+        self.server = None
+
+    def alert(self, s):
+        self.log.write("%s %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), s))
+        self.log.flush()
+
+    ####################
+    # Requests
+
+    def handle(self, req):
+        cmd = req.get("cmd")
+        handler = getattr(self, "req_" + str(cmd), None)
+        if handler is None:
+            raise DaemonError("unknown command: %s" % cmd)
+        return handler(req)
+
+    def _job(self, req):
+        try:
+            return self.jobs[int(req["job"])]
+        except (KeyError, ValueError):
+            raise DaemonError("no such job: %s" % req["job"])
+
+    def _add(self, job):
+        self.jobs[job.id] = job
+        self.queue.put(job)
+        self.alert("JOB %d: queued %s from record %d" %
+                   (job.id, job.plan_path, job.checkpoint.offset))
+        return {"job": job.id}
+
+    def req_ping(self, req):
+        return {"pid": os.getpid(), "connected": self.ms is not None and self.ms.has_serial}
+
+    def owns(self, path):
+        """True if [path] is a plan in our job directory, ours to delete"""
+        return bool(self.job_dir) and \
+            os.path.dirname(os.path.realpath(path)) == self.job_dir
+
+    def req_submit(self, req):
+        path = os.path.abspath(req["plan"])
+        if not os.path.exists(path):
+            raise DaemonError("no such plan: %s" % path)
+        cleanup = bool(req.get("cleanup"))
+        if cleanup and not self.owns(path):
+            raise DaemonError("won't clean up %s: it's not in the job directory" % path)
+
+        with self.lock:
+            job = Job(self.next_id, path, cleanup)
+            self.next_id += 1
+            return self._add(job)
+
+    def req_resume(self, req):
+        with self.lock:
+            if req.get("job") is not None:
+                old = self._job(req)
+            else:
+                stopped = [j for j in self.jobs.values() if j.state in (FAILED, CANCELLED)]
+                if not stopped:
+                    raise DaemonError("there's no interrupted job to resume")
+                old = max(stopped, key=lambda j: j.id)
+
+            if old.state not in (FAILED, CANCELLED):
+                raise DaemonError("job %d is %s" % (old.id, old.state))
+            if not os.path.exists(old.plan_path):
+                raise DaemonError("plan %s is gone" % old.plan_path)
+
+            checkpoint = Checkpoint.load(old.plan_path) or old.checkpoint
+            if not checkpoint.positioned():
+                # It never got going, so there's nowhere to carry on
+                # from: plot it again from the start
+                checkpoint = None
+            job = Job(self.next_id, old.plan_path, old.cleanup, checkpoint)
+            self.next_id += 1
+            old.cleanup = False  # the new job owns the plan now
+            return self._add(job)
+
+    def req_status(self, req):
+        with self.lock:
+            if req.get("job") is not None:
+                jobs = [self._job(req)]
+            else:
+                jobs = sorted(self.jobs.values(), key=lambda j: j.id)
+            reply = {"jobs": [j.as_dict() for j in jobs]}
+            if self.current and self.ms:
+                reply["device"] = self.ms.telemetry_status()
+            return reply
+
+    def req_cancel(self, req):
+        with self.lock:
+            if req.get("job") is not None:
+                job = self._job(req)
+            elif self.current:
+                job = self.current
+            else:
+                raise DaemonError("nothing is plotting")
+
+            job.cancel = True
+            if job.state == QUEUED:
+                job.state = CANCELLED
+            return {"job": job.id}
+
+    def req_shutdown(self, req):
+        with self.lock:
+            if self.current:
+                self.current.cancel = True
+        self.queue.put(None)
+        # shutdown() waits for serve_forever(), so it can't be called
+        # from a request handler
+        threading.Thread(target=self.server.shutdown).start()
+        return {}
+
+    ####################
+    # Plotting
+
+    def connect(self, options):
+        """Open the device for the first job, or retarget the open one"""
+        from muralizer_state import MuralizerState
+
+        if self.ms is None:
+            self.ms = MuralizerState(options=options, **self.serial_kwargs)
+            self.alert("Connected to %s" % self.ms.serial_path)
+            return
+
+        # update_options() puts the gondola back at home, but it's
+        # wherever the last job left it
+        r = (self.ms.r0, self.ms.r1)
+        self.ms.update_options(options)
+        self.ms.r0, self.ms.r1 = r
+
+    def run_job(self, job):
+        plan = PlanReader(job.plan_path)
+        cp = job.checkpoint
+        try:
+            job.total = len(plan)
+            self.connect(plan.options(streamWindow=self.stream_window,
+                                      optimizeCommands=False))
+
+            if job.resumed:
+                # The machine is where the checkpoint left it
+                self.ms.r0 = cp.r0
+                self.ms.r1 = cp.r1
+                if cp.pen_up is False:
+                    self.ms.cmd_pen_down()
+                else:
+                    self.ms.cmd_pen_up()
+            else:
+                cp.r0, cp.r1 = self.ms.r0, self.ms.r1
+
+            n = replay_plan(plan, self.ms, start=cp.offset,
+                            stop=lambda: job.cancel, checkpoint=cp)
+            if n == len(plan):
+                self.ms.cmd_pen_up()
+            throughput = self.ms.drain()
+            if throughput:
+                self.alert("JOB %d: %s" % (job.id, throughput))
+
+            if n < len(plan):
+                job.state = CANCELLED
+                cp.save()
+            else:
+                job.state = DONE
+                cp.clear()
+        except Exception as e:
+            job.state = FAILED
+            job.error = str(e)
+            if self.ms:
+                self.ms.dump_recent(e)
+            cp.save()
+        finally:
+            plan.close()
+
+        if job.state == DONE and job.cleanup and self.owns(job.plan_path):
+            os.remove(job.plan_path)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+
+            with self.lock:
+                if job.state != QUEUED:
+                    continue
+                job.state = RUNNING
+                job.started = time.time()
+                self.current = job
+
+            self.alert("JOB %d: plotting %s" % (job.id, job.plan_path))
+            self.run_job(job)
+
+            with self.lock:
+                job.finished = time.time()
+                self.current = None
+            self.alert("JOB %d: %s at record %d of %s%s" % (
+                job.id, job.state, job.checkpoint.offset, job.total,
+                job.error and (": " + job.error) or ""))
+
+    def serve(self):
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in iter(self.rfile.readline, ""):
+                    try:
+                        reply = daemon.handle(json.loads(line))
+                        reply["ok"] = True
+                    except Exception as e:
+                        reply = {"ok": False, "error": str(e)}
+                    self.wfile.write(json.dumps(reply) + "\n")
+                    self.wfile.flush()
+
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        self.server = SocketServer.ThreadingTCPServer((HOST, self.port), Handler)
+        self.server.daemon_threads = True
+
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+        self.alert("Listening on %s:%d" % (HOST, self.port))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            if self.ms:
+                self.ms.cmd_scram()
+            self.alert("Shut down")
+
+
+####################
+# Client side
+
+def request(msg, port=DEFAULT_PORT, timeout=5.0):
+    """Send one request to the daemon and return its reply
+
+    Raises socket.error if there's no daemon, and DaemonError if it
+    turned the request down.
+    """
+    s = socket.create_connection((HOST, port), timeout)
+    try:
+        s.sendall(json.dumps(msg) + "\n")
+        reply = s.makefile("r").readline()
+    finally:
+        s.close()
+
+    if not reply:
+        raise DaemonError("no reply from the plot daemon")
+    reply = json.loads(reply)
+    if not reply.get("ok"):
+        raise DaemonError(reply.get("error"))
+    return reply
+
+
+def ensure_daemon(port=DEFAULT_PORT, args=(), log_path=None):
+    """Make sure a daemon is listening on [port], starting one (with
+    extra command line [args]) if need be; returns its ping reply"""
+    try:
+        return request({"cmd": "ping"}, port)
+    except socket.error:
+        pass
+
+    cmd = [sys.executable, os.path.abspath(__file__), "--port", str(port)] + list(args)
+    if log_path:
+        cmd += ["--log", log_path]
+
+    kwargs = {}
+    if os.name == "posix":
+        kwargs["preexec_fn"] = os.setsid  # outlive Inkscape
+        kwargs["close_fds"] = True
+    null = open(os.devnull, "r+")
+    subprocess.Popen(cmd, stdin=null, stdout=null, stderr=null, **kwargs)
+
+    deadline = time.time() + STARTUP_WAIT_S
+    while True:
+        try:
+            return request({"cmd": "ping"}, port)
+        except socket.error:
+            if time.time() > deadline:
+                raise DaemonError("the plot daemon didn't start; see %s" % log_path)
+            time.sleep(0.1)
+
+
+def format_job(j):
+    s = "Job %d: %s" % (j["job"], j["state"])
+    if j.get("total"):
+        s += ", %d of %d commands (%.0f%%)" % (j["done"], j["total"], j.get("percent", 0))
+    if j.get("elapsed_s") is not None:
+        s += ", %.0f s" % j["elapsed_s"]
+    if j.get("eta_s") is not None:
+        s += ", about %.0f s to go" % j["eta_s"]
+    if j.get("error"):
+        s += ": " + j["error"]
+    return s
+
+
+def format_device(t):
+    """One line from a device's telemetry status"""
+    h = t["histograms"]
+    return ("Device: %d steps, %.1f steps/s lately; replies take %.3f s (p90 %.3f s); "
+            "idle %.1f s waiting on the host" %
+            (t["steps"], t["recent_steps_per_s"], h["reply"]["p50_s"],
+             h["reply"]["p90_s"], h["idle"]["total_s"]))
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] [status|submit PLAN|resume|cancel|shutdown]")
+    parser.add_option("--port", type="int", default=DEFAULT_PORT)
+    parser.add_option("--serialPort", default=None,
+                      help="Serial port (default: scan for a muralizer)")
+    parser.add_option("--no-serial", dest="no_serial", action="store_true", default=False,
+                      help="Plot to the bit bucket, for testing")
+    parser.add_option("--streamWindow", type="int", default=4)
+    parser.add_option("--log", default=None, help="Log file (default: stderr)")
+    parser.add_option("--jobDir", default=None,
+                      help="Where the extension writes plans it hands over; "
+                      "only these are deleted once plotted")
+    parser.add_option("--job", type="int", default=None)
+    (opts, args) = parser.parse_args()
+
+    if not args:
+        # Run the daemon itself
+        serial_kwargs = {}
+        if opts.no_serial:
+            serial_kwargs["serialPort"] = None
+        elif opts.serialPort:
+            serial_kwargs["serialPort"] = opts.serialPort
+
+        log = opts.log and open(opts.log, "a") or sys.stderr
+        PlotDaemon(opts.port, serial_kwargs, opts.streamWindow, log, opts.jobDir).serve()
+        sys.exit(0)
+
+    # Otherwise we're a client
+    msg = {"cmd": args[0]}
+    if opts.job is not None:
+        msg["job"] = opts.job
+    if args[0] == "submit":
+        if len(args) != 2:
+            parser.error("submit needs a plan file")
+        msg["plan"] = os.path.abspath(args[1])
+
+    try:
+        reply = request(msg, opts.port)
+    except socket.error as e:
+        sys.exit("No plot daemon on port %d: %s" % (opts.port, e))
+    except DaemonError as e:
+        sys.exit(str(e))
+
+    if "jobs" in reply:
+        for j in reply["jobs"]:
+            print(format_job(j))
+    elif "job" in reply:
+        print("Job %d" % reply["job"])
@@ -0,0 +1,259 @@
+import json
+import os
+import re
+import threading
+import time
+
+from muralizer_plan import PlanOptions, PlanReader, Checkpoint, replay_plan, \
+    CHECKPOINT_SUFFIX
+
+# Plot farms: several muralizers on adjacent wall panels.
+#
+# The drawing is split into shards, one per device, either by layer
+# (layer i goes to device i mod n) or by tile (the devices' drawing
+# areas sit side by side, left to right, and each gets the part of
+# the drawing over its panel).  Each shard is compiled to its own plan
+# with that device's MuralizerState, and then every plan is streamed
+# at once, one thread (and so one StreamingSender) per device.
+#
+# A farm config file lists the devices and any per-device canvas
+# options, left to right:
+#
+#   {"devices": [
+#       {"port": "/dev/ttyACM0", "marginXL": 30},
+#       {"port": "/dev/ttyACM1", "canvasWidth": 150}
+#   ]}
+#
+# Without one, every muralizer we can find is used, ordered by port,
+# with the extension's own canvas options.
+#
+# Plans are named farm-<stamp>-device<i>.murp.  A device's plan is
+# deleted once it's finished; one that stops leaves its plan and a
+# checkpoint, and resuming the farm (with the same config, so device
+# i is on the same port) carries each such device on from there.
+
+PROGRESS_EVERY_S = 30.0  # between progress lines in the log
+
+FARM_PLAN_RE = re.compile(r"^farm-(\d+)-(\d+)-(device\d+)\.murp$")
+
+
+def load_farm_config(path):
+    """The list of device entries from a farm config file"""
+    config = json.load(open(path))
+    devices = config.get("devices")
+    if not devices:
+        raise Exception("No devices listed in farm config %s" % path)
+    return devices
+
+
+def unfinished_plans(plan_dir):
+    """{device name: plan path} for the most recent farm in
+    [plan_dir] that has a device still to finish, or {}"""
+    farms = {}
+    if os.path.isdir(plan_dir):
+        for f in os.listdir(plan_dir):
+            m = FARM_PLAN_RE.match(f)
+            if m:
+                stamp = (int(m.group(1)), int(m.group(2)))
+                farms.setdefault(stamp, {})[m.group(3)] = os.path.join(plan_dir, f)
+
+    for stamp in sorted(farms, reverse=True):
+        plans = farms[stamp]
+        if any(os.path.exists(p + CHECKPOINT_SUFFIX) for p in plans.values()):
+            return plans
+    return {}
+
+
+def device_options(options, overrides):
+    """[options], with a device's own settings from the farm config"""
+    kwargs = dict(vars(options))
+    for k, v in overrides.items():
+        if k != "port":
+            kwargs[str(k)] = v
+    return PlanOptions(**kwargs)
+
+
+def clip_stroke(points, x0, x1):
+    """The pieces of the polyline [points] with x0 <= x <= x1"""
+    if len(points) == 1:
+        if x0 <= points[0][0] <= x1:
+            return [list(points)]
+        return []
+
+    pieces = []
+    cur = None
+    for i in xrange(1, len(points)):
+        (ax, ay) = points[i - 1]
+        (bx, by) = points[i]
+        dx = float(bx - ax)
+
+        if dx == 0:
+            if not (x0 <= ax <= x1):
+                cur = None
+                continue
+            t0, t1 = 0.0, 1.0
+        else:
+            ta = (x0 - ax)/dx
+            tb = (x1 - ax)/dx
+            t0 = max(0.0, min(ta, tb))
+            t1 = min(1.0, max(ta, tb))
+            if t0 > t1:
+                cur = None
+                continue
+
+        if cur is None or t0 > 0:
+            cur = [(ax + t0*dx, ay + t0*(by - ay))]
+            pieces.append(cur)
+        cur.append((ax + t1*dx, ay + t1*(by - ay)))
+        if t1 < 1:
+            cur = None
+
+    return pieces
+
+
+def split_tiles(strokes, widths):
+    """Split strokes across tiles of the given widths, laid left to
+    right from x = 0; each tile's strokes are moved to its own origin"""
+    tiles = []
+    x0 = 0.0
+    for w in widths:
+        tile = []
+        for s in strokes:
+            for piece in clip_stroke(s, x0, x0 + w):
+                tile.append([(x - x0, y) for (x, y) in piece])
+        tiles.append(tile)
+        x0 += w
+    return tiles
+
+
+class DeviceRunner(threading.Thread):
+    """Streams one plan to one device, from the start or from where
+    [checkpoint] left it"""
+    def __init__(self, name, ms, plan_path, checkpoint=None):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.ms = ms
+        self.plan_path = plan_path
+        self.resumed = checkpoint is not None and checkpoint.positioned()
+        if not self.resumed:
+            checkpoint = Checkpoint(plan_path, 0, ms.r0, ms.r1)
+        self.checkpoint = checkpoint
+        self.start_offset = checkpoint.offset
+        self.total = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+        self.throughput = None
+        self.stopping = False
+
+    def run(self):
+        self.started = time.time()
+        plan = PlanReader(self.plan_path)
+
+        # As in Muralizer.replayPlanFile: one command per record, so
+        # the checkpoint can follow the device's replies
+        optimizer = self.ms.optimizer
+        self.ms.optimizer = None
+        try:
+            self.total = len(plan)
+            cp = self.checkpoint
+            if self.resumed:
+                # The machine is where the checkpoint left it
+                self.ms.r0 = cp.r0
+                self.ms.r1 = cp.r1
+                if cp.pen_up is False:
+                    self.ms.cmd_pen_down()
+                else:
+                    self.ms.cmd_pen_up()
+            n = replay_plan(plan, self.ms, start=cp.offset,
+                            stop=lambda: self.stopping or self.ms.cmd_button_down(),
+                            checkpoint=cp)
+            if n == len(plan):
+                self.ms.cmd_pen_up()
+            self.throughput = self.ms.drain()
+            if n == len(plan):
+                self.checkpoint.clear()
+            else:
+                self.stopping = True
+                self.checkpoint.save()
+        except Exception as e:
+            self.error = e
+            self.ms.dump_recent(e)
+            self.checkpoint.save()
+        finally:
+            plan.close()
+            self.ms.optimizer = optimizer
+            self.ms.cmd_scram()
+            self.finished = time.time()
+
+    def progress(self):
+        done = self.checkpoint.offset
+        elapsed = ((self.finished or time.time()) - self.started) if self.started else 0.0
+        return {
+            "device": self.name,
+            "port": self.ms.serial_path,
+            "done": done,
+            "total": self.total,
+            "elapsed_s": elapsed,
+            "commands_per_s": elapsed and (done - self.start_offset)/elapsed or 0.0,
+            "finished": self.finished is not None,
+            "stopped": self.stopping,
+            "error": self.error and str(self.error) or None,
+            "telemetry": self.ms.telemetry_status(),
+        }
+
+
+class PlotFarm:
+    """Plots one plan per device, all at once"""
+    def __init__(self, alert):
+        self.alert = alert
+        self.runners = []
+
+    def add(self, name, ms, plan_path, checkpoint=None):
+        self.runners.append(DeviceRunner(name, ms, plan_path, checkpoint))
+
+    def run(self, stop=None):
+        """Stream every plan and wait for them all to finish; [stop],
+        if given, is polled to halt every device early"""
+        for r in self.runners:
+            r.start()
+
+        last = time.time()
+        while any(r.is_alive() for r in self.runners):
+            for r in self.runners:
+                r.join(0.5)
+            if stop and stop():
+                for r in self.runners:
+                    r.stopping = True
+            if time.time() - last > PROGRESS_EVERY_S:
+                self.alert("FARM: " + self.summary().replace("\n", "; "))
+                last = time.time()
+
+        return all(r.error is None and r.checkpoint.offset == r.total
+                   for r in self.runners)
+
+    def progress(self):
+        devices = [r.progress() for r in self.runners]
+        done = sum(d["done"] for d in devices)
+        total = sum(d["total"] for d in devices)
+        return {
+            "done": done,
+            "total": total,
+            "percent": total and 100.0*done/total or 0.0,
+            "devices": devices,
+        }
+
+    def summary(self):
+        p = self.progress()
+        lines = ["Farm: %d of %d commands (%.0f%%) on %d devices" %
+                 (p["done"], p["total"], p["percent"], len(p["devices"]))]
+        for d in p["devices"]:
+            s = "  %s (%s): %d of %d commands in %.0f s, %.1f cmd/s" % (
+                d["device"], d["port"], d["done"], d["total"],
+                d["elapsed_s"], d["commands_per_s"])
+            if d["error"]:
+                s += ", failed: " + d["error"]
+            elif d["finished"] and d["stopped"]:
+                s += ", paused"
+            lines.append(s)
+        return "\n".join(lines)
@@ -0,0 +1,116 @@
+import array
+import math
+
+# Bezier flattening.
+#
+# Paths arrive as cubicsuperpaths: a list of subpaths, each a list of
+# [control pt 1, node, control pt 2] triples.  We flatten each subpath
+# into a flat array of node coordinates, x0, y0, x1, y1, ..., by
+# splitting every cubic in half until its control points lie within
+# [flat] of its chord, which is the same test (and so the same
+# smoothness semantics) as cspsubdiv.maxdist().
+#
+# Splitting works on an explicit stack of plain floats rather than by
+# splicing new nodes into the middle of the subpath list, so the cost
+# is linear in the number of segments produced.
+#
+# Paths are flattened after they've been transformed onto the wall,
+# so [flat] is in mm.  There's no point in going much below the
+# machine's step size: see tolerance_for().
+
+# Smallest flattening tolerance, as a fraction of MuralizerState.stepMM
+MIN_FLAT_STEPS = 0.25
+
+# Never split a single cubic more than this many times deep (2**16
+# segments); this only matters for degenerate input like NaNs.
+MAX_DEPTH = 16
+
+
+def _maxdist(x0, y0, x1, y1, x2, y2, x3, y3):
+    """Largest distance from the control points to the chord p0-p3"""
+    dx = x3 - x0
+    dy = y3 - y0
+    l = math.sqrt(dx*dx + dy*dy)
+    if l == 0:
+        # Closed loop: cspsubdiv gives up here (and never splits it),
+        # but the distance from the end point is what we want.
+        return max(math.sqrt((x1-x0)*(x1-x0) + (y1-y0)*(y1-y0)),
+                   math.sqrt((x2-x0)*(x2-x0) + (y2-y0)*(y2-y0)))
+    return max(abs(dx*(y0 - y1) - (x0 - x1)*dy),
+               abs(dx*(y0 - y2) - (x0 - x2)*dy)) / l
+
+
+def tolerance_for(smoothness, stepMM):
+    """Flattening tolerance (mm) for a requested smoothness (mm on the
+    wall), clamped so we don't resolve detail the steppers can't draw"""
+    return max(smoothness, MIN_FLAT_STEPS*stepMM)
+
+
+def flatten_subpath(sp, flat, min_seg=0.0):
+    """Flatten one cubicsuperpath subpath to an array('d') of node
+    coordinates, x0, y0, x1, y1, ...
+
+    Nodes closer than [min_seg] to the previous one are dropped
+    (except the last one, so the subpath still ends where it should).
+    """
+    out = array.array('d')
+    if not sp:
+        return out
+
+    px, py = sp[0][1]
+    out.append(px)
+    out.append(py)
+    lx, ly = px, py
+    min_seg2 = min_seg*min_seg
+    last = len(sp) - 1
+
+    stack = []
+    for i in xrange(1, len(sp)):
+        c1x, c1y = sp[i - 1][2]
+        c2x, c2y = sp[i][0]
+        ex, ey = sp[i][1]
+
+        # Depth-first, first half on top, so nodes come out in order
+        stack.append((px, py, c1x, c1y, c2x, c2y, ex, ey, 0))
+        while stack:
+            x0, y0, x1, y1, x2, y2, x3, y3, depth = stack.pop()
+
+            if depth < MAX_DEPTH and _maxdist(x0, y0, x1, y1, x2, y2, x3, y3) > flat:
+                # de Casteljau at t = 0.5
+                ax = (x0 + x1)*0.5
+                ay = (y0 + y1)*0.5
+                bx = (x1 + x2)*0.5
+                by = (y1 + y2)*0.5
+                cx = (x2 + x3)*0.5
+                cy = (y2 + y3)*0.5
+                dx = (ax + bx)*0.5
+                dy = (ay + by)*0.5
+                ex_ = (bx + cx)*0.5
+                ey_ = (by + cy)*0.5
+                mx = (dx + ex_)*0.5
+                my = (dy + ey_)*0.5
+
+                depth += 1
+                stack.append((mx, my, ex_, ey_, cx, cy, x3, y3, depth))
+                stack.append((x0, y0, ax, ay, dx, dy, mx, my, depth))
+            else:
+                if min_seg2 and (x3-lx)*(x3-lx) + (y3-ly)*(y3-ly) < min_seg2 \
+                        and (stack or i != last):
+                    continue
+                out.append(x3)
+                out.append(y3)
+                lx, ly = x3, y3
+
+        px, py = ex, ey
+
+    return out
+
+
+def flatten_csp(p, flat, min_seg=0.0):
+    """Flatten a whole cubicsuperpath; one coordinate array per subpath"""
+    return [flatten_subpath(sp, flat, min_seg) for sp in p]
+
+
+def coords_to_points(coords):
+    """array('d') of x0, y0, x1, y1, ... to a list of (x, y) pairs"""
+    return zip(coords[0::2], coords[1::2])
@@ -0,0 +1,107 @@
+import atexit
+import collections
+import threading
+import time
+
+# The debug log, kept out of the plot's way.
+#
+# MuralizerState used to write and flush a line to the debug file for
+# every command, and format a few more (one through json.dumps) for
+# every move, whether or not anyone would read them.  Here lines are
+# leveled: a message above the log's level costs one comparison, and
+# its format arguments are only applied when it's kept.  Kept lines
+# are buffered and written in blocks; warnings and errors go out at
+# once, and whatever's buffered goes when the log is flushed or the
+# process exits.
+#
+# The last RECENT_COMMANDS commands written to the device are always
+# kept, whatever the level, in a ring that dump_recent() writes to the
+# log when something goes wrong.
+
+ERROR, WARN, INFO, DEBUG, TRACE = range(5)
+
+LEVELS = {"error": ERROR, "warn": WARN, "info": INFO,
+          "debug": DEBUG, "trace": TRACE}
+
+LOG_BUFFER_LINES = 256  # kept lines buffered before a write
+RECENT_COMMANDS = 64    # device commands remembered for dump_recent()
+
+
+def parse_level(name):
+    """The level called [name] ("info", "debug", ...), or INFO"""
+    return LEVELS.get(str(name).lower(), INFO)
+
+
+class DebugLog:
+    """A leveled, buffered log file, with a ring of recent commands"""
+    def __init__(self, path, level=INFO, buffer_lines=LOG_BUFFER_LINES,
+                 recent=RECENT_COMMANDS):
+        self.path = path
+        self.fd = file(path, "w")
+        self.level = level
+        self.buffer_lines = buffer_lines
+        self.lines = []
+        self.lock = threading.Lock()  # the send thread logs too
+        self.recent = collections.deque(maxlen=recent)
+        atexit.register(self.flush)
+
+    def enabled(self, level):
+        return level <= self.level
+
+    def log(self, level, msg, *args):
+        """Log [msg] % [args], if [level] is enabled"""
+        if level > self.level:
+            return
+        if args:
+            msg = msg % args
+
+        with self.lock:
+            self.lines.append(msg)
+            if level <= WARN or len(self.lines) >= self.buffer_lines:
+                self._write()
+
+    def error(self, msg, *args):
+        self.log(ERROR, msg, *args)
+
+    def warn(self, msg, *args):
+        self.log(WARN, msg, *args)
+
+    def info(self, msg, *args):
+        self.log(INFO, msg, *args)
+
+    def debug(self, msg, *args):
+        self.log(DEBUG, msg, *args)
+
+    def trace(self, msg, *args):
+        self.log(TRACE, msg, *args)
+
+    def command(self, s):
+        """Remember device command [s] for dump_recent()"""
+        self.recent.append((time.time(), s))
+
+    def dump_recent(self, why):
+        """Write the remembered commands to the log, newest last"""
+        recent = list(self.recent)
+        if not recent:
+            return
+        now = time.time()
+        self.error("Last %d commands before %s:", len(recent), why)
+        for (t, s) in recent:
+            self.error("  %8.3f s ago: %s", now - t, s)
+
+    def _write(self):
+        if self.lines and self.fd:
+            self.fd.write("\n".join(self.lines) + "\n")
+            self.fd.flush()
+        self.lines = []
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        with self.lock:
+            self._write()
+            if self.fd:
+                self.fd.close()
+                self.fd = None
@@ -0,0 +1,279 @@
+import math
+
+# Pen-up travel minimization.
+#
+# Strokes are lists of (x, y) points in drawing-area mm.  The cost of
+# travelling between two points is measured in spool space: the
+# firmware's spin_bresenham() takes max(|dr0|, |dr1|) steps to do a
+# move, so that (and not the distance on the wall) is what a pen-up
+# move actually costs us in time.
+#
+# A pen plotter doesn't care which end of a stroke it starts from, so
+# every stroke may be drawn in either direction.
+#
+# Before ordering, strokes whose ends (nearly) meet can be joined into
+# one, so the pen stays down across the joint instead of lifting.
+
+
+def spool_cost(a, b):
+    """Steps the firmware takes to get from spool position a to b"""
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
+
+def wall_distance(a, b):
+    """Straight-line distance between two drawing-area points, in mm"""
+    return math.hypot(a[0] - b[0], a[1] - b[1])
+
+
+class EndpointGrid:
+    """Uniform grid over stroke endpoints
+
+    By default the points are in spool (r0, r1) space and distance is
+    spool_cost (a Chebyshev metric); wall_distance works just as well.
+    Cells are square, so a ring search outwards from the query cell
+    finds the nearest endpoint under either metric exactly.
+    """
+    def __init__(self, cell, metric=spool_cost):
+        self.cell = float(cell)
+        self.metric = metric
+        self.cells = {}
+        self.count = 0
+        self.lo = None
+        self.hi = None
+
+    def _key(self, p):
+        return (int(math.floor(p[0]/self.cell)), int(math.floor(p[1]/self.cell)))
+
+    def add(self, p, item):
+        k = self._key(p)
+        self.cells.setdefault(k, {})[item] = p
+        self.count += 1
+
+        if self.lo is None:
+            self.lo = list(k)
+            self.hi = list(k)
+        else:
+            self.lo = [min(self.lo[0], k[0]), min(self.lo[1], k[1])]
+            self.hi = [max(self.hi[0], k[0]), max(self.hi[1], k[1])]
+
+    def remove(self, p, item):
+        k = self._key(p)
+        bucket = self.cells[k]
+        del bucket[item]
+        if not bucket:
+            del self.cells[k]
+        self.count -= 1
+
+    def _ring(self, k0, k1, r):
+        if r == 0:
+            yield (k0, k1)
+            return
+        for i in xrange(k0 - r, k0 + r + 1):
+            yield (i, k1 - r)
+            yield (i, k1 + r)
+        for j in xrange(k1 - r + 1, k1 + r):
+            yield (k0 - r, j)
+            yield (k0 + r, j)
+
+    def nearest(self, p, limit=None):
+        """Return (cost, item, point) for the closest entry to p, or
+        None if there's nothing within [limit] of it."""
+        if not self.count:
+            return None
+
+        k0, k1 = self._key(p)
+        max_r = max(abs(k0 - self.lo[0]), abs(k0 - self.hi[0]),
+                    abs(k1 - self.lo[1]), abs(k1 - self.hi[1]))
+        if limit is not None:
+            max_r = min(max_r, int(math.ceil(limit/self.cell)) + 1)
+
+        best = None
+        for r in xrange(0, max_r + 1):
+            for k in self._ring(k0, k1, r):
+                bucket = self.cells.get(k)
+                if not bucket:
+                    continue
+                for item, q in bucket.iteritems():
+                    c = self.metric(p, q)
+                    if best is None or c < best[0]:
+                        best = (c, item, q)
+
+            # Anything further out is at least r cells away
+            if best is not None and best[0] <= r*self.cell:
+                break
+
+        if best is not None and limit is not None and best[0] > limit:
+            return None
+        return best
+
+
+def join_strokes(strokes, tolerance):
+    """Chain together strokes whose ends are within [tolerance] mm
+
+    Strokes are reversed as needed to make their ends meet, and any
+    gap left between two joined strokes is simply drawn through with
+    the pen down.  Strokes of a single point draw nothing and are
+    dropped.  Returns (joined strokes, pen lifts saved).
+    """
+    strokes = [s for s in strokes if len(s) > 1]
+    if len(strokes) < 2:
+        return (strokes, 0)
+
+    grid = EndpointGrid(max(tolerance, 0.1), metric=wall_distance)
+    for i, s in enumerate(strokes):
+        grid.add(s[0], (i, False))
+        grid.add(s[-1], (i, True))
+
+    def take(i):
+        grid.remove(strokes[i][0], (i, False))
+        grid.remove(strokes[i][-1], (i, True))
+
+    def extend(chain, seg):
+        # Don't repeat a point the chain already ends on
+        if seg[0] == chain[-1]:
+            chain.extend(seg[1:])
+        else:
+            chain.extend(seg)
+
+    joined = []
+    used = [False]*len(strokes)
+    for i in xrange(len(strokes)):
+        if used[i]:
+            continue
+        used[i] = True
+        take(i)
+
+        # Grow forwards from the end of the stroke...
+        tail = list(strokes[i])
+        while True:
+            hit = grid.nearest(tail[-1], limit=tolerance)
+            if hit is None:
+                break
+            j, at_end = hit[1]
+            used[j] = True
+            take(j)
+            if at_end:
+                extend(tail, strokes[j][::-1])
+            else:
+                extend(tail, strokes[j])
+
+        # ...then backwards from its start, building the head reversed
+        head = [tail[0]]
+        while True:
+            hit = grid.nearest(head[-1], limit=tolerance)
+            if hit is None:
+                break
+            j, at_end = hit[1]
+            used[j] = True
+            take(j)
+            if at_end:
+                extend(head, strokes[j][::-1])
+            else:
+                extend(head, strokes[j])
+
+        head.reverse()
+        joined.append(head[:-1] + tail)
+
+    return (joined, len(strokes) - len(joined))
+
+
+def pen_up_travel(strokes, to_steps, start):
+    """Total pen-up travel for plotting [strokes] in order from the
+    drawing-area point [start], as (spool steps, wall mm)."""
+    steps = 0.0
+    mm = 0.0
+    prev = start
+    prev_r = to_steps(*start)
+    for s in strokes:
+        if not s:
+            continue
+        r = to_steps(*s[0])
+        steps += spool_cost(prev_r, r)
+        mm += math.hypot(s[0][0] - prev[0], s[0][1] - prev[1])
+        prev = s[-1]
+        prev_r = to_steps(*prev)
+    return (steps, mm)
+
+
+def order_strokes(strokes, to_steps, start, window=16, passes=2):
+    """Reorder (and possibly reverse) strokes to cut pen-up travel
+
+    [to_steps] maps a drawing-area point to spool (r0, r1) steps, and
+    [start] is the drawing-area point the pen is at before the first
+    stroke.  We build a greedy nearest-neighbour tour over an
+    EndpointGrid, then refine it with 2-opt moves between strokes at
+    most [window] positions apart.  Returns a new list of strokes.
+    """
+    strokes = [s for s in strokes if s]
+    n = len(strokes)
+    if n < 2:
+        return strokes
+
+    ends = [(to_steps(*s[0]), to_steps(*s[-1])) for s in strokes]
+    here = to_steps(*start)
+
+    # Aim for a handful of endpoints per cell
+    r0s = [e[j][0] for e in ends for j in (0, 1)]
+    r1s = [e[j][1] for e in ends for j in (0, 1)]
+    span = max(max(r0s) - min(r0s), max(r1s) - min(r1s), 1.0)
+    grid = EndpointGrid(max(span/math.sqrt(n), 1.0))
+    for i, (a, b) in enumerate(ends):
+        grid.add(a, (i, False))
+        grid.add(b, (i, True))
+
+    # Greedy nearest neighbour: (index, reversed) pairs
+    tour = []
+    while grid.count:
+        cost, (i, rev), q = grid.nearest(here)
+        grid.remove(ends[i][0], (i, False))
+        grid.remove(ends[i][1], (i, True))
+        tour.append((i, rev))
+        here = ends[i][1 - int(rev)]
+
+    tour = _two_opt(tour, ends, to_steps(*start), window, passes)
+
+    out = []
+    for i, rev in tour:
+        if rev:
+            out.append(strokes[i][::-1])
+        else:
+            out.append(strokes[i])
+    return out
+
+
+def _two_opt(tour, ends, start, window, passes):
+    """Windowed 2-opt over an open tour of reversible strokes
+
+    Reversing tour[i..j] flips the order and direction of those
+    strokes, which only changes the two pen-up moves at its edges.
+    """
+    def entry(t):
+        return ends[t[0]][int(t[1])]
+
+    def exit(t):
+        return ends[t[0]][1 - int(t[1])]
+
+    n = len(tour)
+    for p in xrange(passes):
+        improved = False
+        for i in xrange(n):
+            if i:
+                a = exit(tour[i - 1])
+            else:
+                a = start
+            for j in xrange(i, min(n, i + window)):
+                old = spool_cost(a, entry(tour[i]))
+                new = spool_cost(a, exit(tour[j]))
+                if j + 1 < n:
+                    b = entry(tour[j + 1])
+                    old += spool_cost(exit(tour[j]), b)
+                    new += spool_cost(entry(tour[i]), b)
+
+                if new < old:
+                    seg = [(k, not rev) for (k, rev) in reversed(tour[i:j + 1])]
+                    tour[i:j + 1] = seg
+                    improved = True
+        if not improved:
+            break
+
+    return tour
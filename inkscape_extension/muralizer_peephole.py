@@ -0,0 +1,109 @@
+# Peephole optimization of the muralizer command stream.
+#
+# The traversal is generous with commands: every <g> raises the pen,
+# every subpath raises it again on the way in and out, and moves can
+# round to zero steps.  CommandOptimizer sits between MuralizerState's
+# cmd_* wrappers and the wire, and drops or merges what it can before
+# anything is sent.
+
+# The firmware parses step counts with atoi() into a 16-bit int
+MAX_MOVE_STEPS = 32767
+
+
+class CommandOptimizer:
+    """Filters moves and pen commands on their way to the device
+
+    [emit_move] and [emit_pen] are called with the surviving commands
+    as (dr0, dr1) and (up), in order.  We hold back at most one move,
+    so that it can be merged with the next one when they're collinear
+    in step space (or, with the pen up, when they're any moves at all:
+    only the end point of pen-up travel matters).
+    """
+    def __init__(self, emit_move, emit_pen):
+        self.emit_move = emit_move
+        self.emit_pen = emit_pen
+
+        self.pen_up = None  # unknown until we've sent a pen command
+        self.pending = None
+
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.moves_in = 0
+        self.moves_out = 0
+        self.pens_in = 0
+        self.pens_out = 0
+        self.zero_moves = 0
+        self.merged_moves = 0
+        self.redundant_pens = 0
+
+    def _mergeable(self, a, b):
+        m0 = a[0] + b[0]
+        m1 = a[1] + b[1]
+        if abs(m0) > MAX_MOVE_STEPS or abs(m1) > MAX_MOVE_STEPS:
+            return False
+
+        if self.pen_up:
+            return True
+
+        # Collinear and pointing the same way
+        return (a[0]*b[1] == a[1]*b[0]) and (a[0]*b[0] + a[1]*b[1] > 0)
+
+    def move(self, dr0, dr1):
+        self.moves_in += 1
+
+        if dr0 == 0 and dr1 == 0:
+            self.zero_moves += 1
+            return
+
+        if self.pending is not None and self._mergeable(self.pending, (dr0, dr1)):
+            self.pending = (self.pending[0] + dr0, self.pending[1] + dr1)
+            self.merged_moves += 1
+            return
+
+        self.flush()
+        self.pending = (dr0, dr1)
+
+    def pen(self, up):
+        self.pens_in += 1
+
+        if up == self.pen_up:
+            self.redundant_pens += 1
+            return
+
+        self.flush()
+        self.pen_up = up
+        self.pens_out += 1
+        self.emit_pen(up)
+
+    def flush(self):
+        """Send the held-back move, if any"""
+        p = self.pending
+        self.pending = None
+        if p is None:
+            return
+
+        if p == (0, 0):
+            # Pen-up travel that went out and came back
+            self.zero_moves += 1
+            return
+
+        self.moves_out += 1
+        self.emit_move(p[0], p[1])
+
+    def stats(self):
+        return {
+            "moves_in": self.moves_in,
+            "moves_out": self.moves_out,
+            "pens_in": self.pens_in,
+            "pens_out": self.pens_out,
+            "zero_moves_dropped": self.zero_moves,
+            "moves_merged": self.merged_moves,
+            "redundant_pens_dropped": self.redundant_pens,
+        }
+
+    def summary(self):
+        return ("Optimizer: %d of %d moves sent (%d zero-step dropped, %d merged), "
+                "%d of %d pen commands sent (%d redundant dropped)"
+                % (self.moves_out, self.moves_in, self.zero_moves, self.merged_moves,
+                   self.pens_out, self.pens_in, self.redundant_pens))
@@ -0,0 +1,329 @@
+import array
+import json
+import mmap
+import os
+import struct
+import sys
+
+# A compiled motion plan is just the stream of commands the planner
+# would have sent to the muralizer, stored as fixed-size records so it
+# can be memory-mapped and replayed without touching the SVG again.
+#
+# Layout (all little-endian):
+#
+#   header:  magic, version, record count, start (r0, r1) in steps,
+#            then the machine options the plan was built for
+#   records: opcode, a, b, path index, node index  (five int32s)
+#
+# For OP_MOVE, (a, b) are the (dr0, dr1) step deltas; pen opcodes
+# leave them zero.  The path/node indices are the traversal counters
+# (pathcount, nodeCount) at the time the command was issued, so a
+# plot can be resumed from the middle of a plan.
+
+PLAN_MAGIC = "MURP"
+PLAN_VERSION = 1
+
+OP_MOVE = 1
+OP_PEN_UP = 2
+OP_PEN_DOWN = 3
+
+# The options MuralizerState.update_options() needs, in their
+# original (cm / mm / count) units
+PLAN_MACHINE_OPTIONS = ("canvasWidth", "canvasHeight",
+                        "marginXL", "marginXR", "marginYT",
+                        "stepsPerRev", "spoolDiameter")
+
+HEADER = struct.Struct("<4sHHqii" + "d"*len(PLAN_MACHINE_OPTIONS))
+RECORD = struct.Struct("<iiiii")
+RECORD_INTS = 5
+
+WRITE_BATCH = 4096  # records to buffer before hitting the disk
+
+CHECKPOINT_SUFFIX = ".resume"
+CHECKPOINT_EVERY = 64  # records between checkpoint file updates
+
+
+class PlanOptions:
+    """Just enough of an options object to build a MuralizerState"""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class PlanWriter:
+    """Writes a compiled plan while the planner runs
+
+    Records are batched in an int32 array and appended to the file
+    every WRITE_BATCH commands, so memory stays flat however big the
+    plan gets.  The header is rewritten with the final record count
+    on close().
+    """
+    def __init__(self, path, options, r0, r1):
+        self.path = path
+        self.machine = [float(getattr(options, k)) for k in PLAN_MACHINE_OPTIONS]
+        self.start = (int(r0), int(r1))
+        self.count = 0
+        self.buf = array.array("i")
+
+        self.fd = open(path, "wb")
+        self._write_header()
+
+    def _write_header(self):
+        self.fd.seek(0)
+        self.fd.write(HEADER.pack(PLAN_MAGIC, PLAN_VERSION, 0, self.count,
+                                  self.start[0], self.start[1], *self.machine))
+
+    def _append(self, op, a, b, path, node):
+        self.buf.extend((op, a, b, path, node))
+        self.count += 1
+        if len(self.buf) >= WRITE_BATCH*RECORD_INTS:
+            self.flush()
+
+    def move(self, dr0, dr1, path=0, node=0):
+        self._append(OP_MOVE, int(dr0), int(dr1), path, node)
+
+    def pen(self, up, path=0, node=0):
+        self._append(up and OP_PEN_UP or OP_PEN_DOWN, 0, 0, path, node)
+
+    def flush(self):
+        if not self.buf:
+            return
+        if sys.byteorder != "little":
+            self.buf.byteswap()
+        self.buf.tofile(self.fd)
+        self.buf = array.array("i")
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        self._write_header()
+        self.fd.close()
+        self.fd = None
+
+
+class PlanReader:
+    """Memory-mapped, random-access view of a compiled plan
+
+    Records are unpacked on demand, so iterating over a plan of any
+    size only ever holds one record in memory.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fd = open(path, "rb")
+
+        header = self.fd.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise Exception("Truncated plan file: %s" % path)
+
+        fields = HEADER.unpack(header)
+        if fields[0] != PLAN_MAGIC or fields[1] != PLAN_VERSION:
+            raise Exception("Not a muralizer plan (or wrong version): %s" % path)
+
+        self.count = fields[3]
+        self.start = (fields[4], fields[5])
+        self.machine = dict(zip(PLAN_MACHINE_OPTIONS, fields[6:]))
+
+        size = os.fstat(self.fd.fileno()).st_size
+        if size < HEADER.size + self.count*RECORD.size:
+            raise Exception("Plan file is shorter than its header claims: %s" % path)
+
+        self.map = None
+        if self.count:
+            self.map = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("plan record %d out of range" % i)
+        return RECORD.unpack_from(self.map, HEADER.size + i*RECORD.size)
+
+    def records(self, start=0):
+        """Yield (opcode, a, b, path, node) from record [start] on."""
+        offset = HEADER.size + start*RECORD.size
+        for i in xrange(start, self.count):
+            yield RECORD.unpack_from(self.map, offset)
+            offset += RECORD.size
+
+    def options(self, **extra):
+        """Machine options this plan was compiled for."""
+        kwargs = dict(self.machine)
+        kwargs.update(extra)
+        return PlanOptions(**kwargs)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fd.close()
+
+
+class Checkpoint:
+    """How far a plot streamed from a plan has got
+
+    [offset] is the index of the next record to send; (r0, r1) and
+    [pen_up] are where the records before it left the machine.  That's
+    all it takes to resume: seek to [offset] and carry on.  (r0, r1) is
+    None until we know where the machine is, when the plot starts or
+    the device answers its first command; such a checkpoint can only
+    be started over, not resumed.
+
+    Checkpoints are kept next to the plan, in <plan>.resume, and
+    rewritten every CHECKPOINT_EVERY records, so they survive even if
+    Inkscape never gets to save the document.
+    """
+    def __init__(self, plan_path, offset=0, r0=None, r1=None, pen_up=None):
+        self.plan_path = plan_path
+        self.offset = offset
+        self.r0 = r0
+        self.r1 = r1
+        self.pen_up = pen_up
+
+    def path(self):
+        return self.plan_path + CHECKPOINT_SUFFIX
+
+    def positioned(self):
+        """True if we know where the machine is"""
+        return self.r0 is not None and self.r1 is not None
+
+    def update(self, offset, r0, r1, pen_up):
+        self.offset = offset
+        self.r0 = r0
+        self.r1 = r1
+        self.pen_up = pen_up
+        if offset % CHECKPOINT_EVERY == 0:
+            self.save()
+
+    def as_dict(self):
+        return {"plan": self.plan_path, "offset": self.offset,
+                "r0": self.r0, "r1": self.r1, "pen_up": self.pen_up}
+
+    def save(self):
+        # Write and rename, so a crash never leaves half a checkpoint
+        tmp = self.path() + ".tmp"
+        fd = open(tmp, "w")
+        json.dump(self.as_dict(), fd)
+        fd.close()
+        if os.path.exists(self.path()):
+            os.remove(self.path())  # os.rename() won't replace on Windows
+        os.rename(tmp, self.path())
+
+    def clear(self):
+        """The plot finished: forget the checkpoint"""
+        if os.path.exists(self.path()):
+            os.remove(self.path())
+
+    @classmethod
+    def load(cls, plan_path):
+        """The checkpoint saved for [plan_path], or None"""
+        try:
+            d = json.load(open(plan_path + CHECKPOINT_SUFFIX))
+        except (IOError, ValueError):
+            return None
+        (r0, r1) = (d["r0"], d["r1"])
+        if r0 is not None and r1 is not None:
+            (r0, r1) = (float(r0), float(r1))
+        return cls(plan_path, int(d["offset"]), r0, r1, d["pen_up"])
+
+    def __str__(self):
+        if self.positioned():
+            at = "<%d, %d>" % (self.r0, self.r1)
+        else:
+            at = "an unknown position"
+        return "record %d of %s at %s, pen %s" % (
+            self.offset, self.plan_path, at,
+            {True: "up", False: "down", None: "unknown"}[self.pen_up])
+
+
+def replay_plan(plan, ms, start=0, stop=None, checkpoint=None):
+    """Stream a compiled plan to the device behind MuralizerState [ms].
+
+    Returns the index of the next record to send, which is len(plan)
+    unless [stop] (a callable) asked us to halt early.
+
+    [checkpoint] follows the device, not us: each record's command
+    carries where the machine will be once it's done, and the
+    checkpoint moves on when the device answers it.  Commands still in
+    the pipeline or the sender's window when a plot fails are never
+    counted, so a resume starts from the last one the device finished.
+    That takes one command per record, so ms mustn't be optimizing.
+    """
+    if (ms.r0, ms.r1) != plan.start and start == 0:
+        ms.alert("PLAN: moving to plan start <%d, %d>" % plan.start)
+        if checkpoint:
+            ms.set_mark(_checkpoint_mark(checkpoint, 0, (ms.r0, ms.r1), True))
+        ms.cmd_pen_up()
+        if checkpoint:
+            ms.set_mark(_checkpoint_mark(checkpoint, 0, plan.start, True))
+        ms.cmd_move_rs(plan.start[0], plan.start[1])
+        ms.set_mark(None)
+
+    pen_up = checkpoint and checkpoint.pen_up
+    i = start
+    for op, a, b, path, node in plan.records(start):
+        if stop and stop():
+            return i
+
+        ms.set_cursor(path, node)
+        if op == OP_MOVE:
+            r = (ms.r0 + a, ms.r1 + b)
+        elif op == OP_PEN_UP:
+            r = (ms.r0, ms.r1)
+            pen_up = True
+        elif op == OP_PEN_DOWN:
+            r = (ms.r0, ms.r1)
+            pen_up = False
+        else:
+            ms.alert("PLAN: skipping unknown opcode %d at record %d" % (op, i))
+            op = None
+        i += 1
+
+        if checkpoint and op is not None:
+            ms.set_mark(_checkpoint_mark(checkpoint, i, r, pen_up))
+        if op == OP_MOVE:
+            ms.cmd_move_rs(r[0], r[1])
+        elif op == OP_PEN_UP:
+            ms.cmd_pen_up()
+        elif op == OP_PEN_DOWN:
+            ms.cmd_pen_down()
+        ms.set_mark(None)
+
+    return i
+
+
+def _checkpoint_mark(checkpoint, offset, r, pen_up):
+    return lambda: checkpoint.update(offset, r[0], r[1], pen_up)
+
+
+if __name__ == '__main__':
+    # Stream a plan straight to the first muralizer we can find
+    from optparse import OptionParser
+    from muralizer_state import MuralizerState
+
+    parser = OptionParser(usage="%prog [options] plan-file")
+    parser.add_option("--port", dest="port", default=None,
+                      help="Serial port (default: scan for a muralizer)")
+    parser.add_option("--streamWindow", dest="streamWindow", type="int",
+                      default=4, help="Commands kept in flight")
+    parser.add_option("--no-optimize", dest="optimizeCommands", default=True,
+                      action="store_false", help="Send the plan exactly as recorded")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need exactly one plan file")
+
+    plan = PlanReader(args[0])
+    try:
+        kwargs = {"options": plan.options(streamWindow=opts.streamWindow,
+                                          optimizeCommands=opts.optimizeCommands)}
+        if opts.port:
+            kwargs["serialPort"] = opts.port
+        ms = MuralizerState(**kwargs)
+
+        n = replay_plan(plan, ms)
+        ms.cmd_pen_up()
+        print(ms.drain() or "Replayed %d records" % n)
+    finally:
+        plan.close()
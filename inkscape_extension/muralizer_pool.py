@@ -0,0 +1,187 @@
+import array
+import multiprocessing
+
+import cubicsuperpath
+import simplepath
+
+from muralizer_flatten import flatten_csp
+from muralizer_transform import apply_transform
+
+# Path geometry on a process pool.
+#
+# Parsing a path's d string, transforming it onto the wall and
+# flattening it are pure CPU work, and for big documents they're most
+# of the planning time.  With planWorkers > 0 the traversal hands each
+# path to a PathPool instead of doing that work itself.  Paths go out
+# to the workers in batches (one pickle per batch, not per path), and
+# the flattened results come back strictly in submission order, so
+# what reaches the device is exactly what a serial plot would send.
+#
+# Only a bounded number of batches is ever in flight: the traversal
+# keeps going while the workers chew, but it can't run off and hold
+# the whole document's geometry in memory.
+#
+# Paths drawn through <use> clones go through a GeometryCache, here and
+# on the workers: a motif cloned a thousand times is parsed and
+# flattened once per scale and rotation, and just moved into place for
+# every other clone.
+
+POOL_BATCH = 256  # paths per batch sent to a worker
+BATCHES_PER_WORKER = 4  # batches in flight per worker before we wait
+GEOMETRY_CACHE_SIZE = 4096  # flattened clone paths kept for reuse
+
+
+def path_coords(d, mat, flat):
+    """Parse the path data [d], apply transform [mat] and flatten it to
+    tolerance [flat]; one array('d') of x0, y0, x1, y1, ... per subpath"""
+    if len(simplepath.parsePath(d)) == 0:
+        return []
+
+    p = cubicsuperpath.parsePath(d)
+    apply_transform(mat, p)
+    return flatten_csp(p, flat, flat)
+
+
+def translate_coords(coords, dx, dy):
+    """A copy of the array('d') x0, y0, x1, y1, ... moved by (dx, dy)"""
+    out = array.array('d', coords)
+    out[0::2] = array.array('d', [x + dx for x in coords[0::2]])
+    out[1::2] = array.array('d', [y + dy for y in coords[1::2]])
+    return out
+
+
+class GeometryCache:
+    """Flattened paths, for reuse wherever the same path is drawn again
+    with the same scale and rotation, as the clones of a motif are
+
+    Flattening doesn't care where a path is, so paths are flattened
+    under just the linear part of their transform, and the translation
+    is added afterwards.
+    """
+    def __init__(self, flat, size=GEOMETRY_CACHE_SIZE):
+        self.flat = flat
+        self.size = size
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def coords(self, d, mat):
+        """path_coords(d, mat, flat), from the cache if we can"""
+        key = (d, mat[0][0], mat[0][1], mat[1][0], mat[1][1])
+        flattened = self.entries.get(key)
+        if flattened is None:
+            self.misses += 1
+            flattened = path_coords(d, [[mat[0][0], mat[0][1], 0.0],
+                                        [mat[1][0], mat[1][1], 0.0]], self.flat)
+            if len(self.entries) >= self.size:
+                self.entries.clear()  # a new generation of motifs
+            self.entries[key] = flattened
+        else:
+            self.hits += 1
+
+        return [translate_coords(c, mat[0][2], mat[1][2]) for c in flattened]
+
+    def summary(self):
+        return "Clone geometry: %d paths reused, %d flattened" % \
+            (self.hits, self.misses)
+
+
+_worker_cache = None  # each worker's GeometryCache
+
+
+def _flatten_batch(args):
+    """Worker side: path_coords() for a batch of (d, mat, clone) paths"""
+    global _worker_cache
+    (flat, paths) = args
+    if _worker_cache is None or _worker_cache.flat != flat:
+        _worker_cache = GeometryCache(flat)
+
+    out = []
+    for (d, mat, clone) in paths:
+        if clone:
+            out.append(_worker_cache.coords(d, mat))
+        else:
+            out.append(path_coords(d, mat, flat))
+    return out
+
+
+class PathPool:
+    """Flattens paths on worker processes, returning them in order"""
+    def __init__(self, processes, flat, batch=POOL_BATCH):
+        self.processes = processes
+        self.flat = flat
+        self.batch = batch
+        self.pool = multiprocessing.Pool(processes)
+
+        self.pending = []  # (d, mat, clone) for the batch being built
+        self.tags = []     # caller's tag for each item in the batch
+        self.slots = []    # coords of items that needed no worker, else None
+        self.in_flight = []  # (tags, slots, AsyncResult or None), oldest first
+        self.paths = 0
+        self.batches = 0
+
+    def submit(self, d, mat, tag=None, clone=False):
+        """Queue path data [d] under transform [mat]; [tag] comes back
+        with its result.  Paths under a <use> should set [clone], so
+        the workers cache their geometry."""
+        self.pending.append((d, mat, clone))
+        self._add(tag, None)
+        self.paths += 1
+
+    def submit_coords(self, coords, tag=None):
+        """Queue something already turned into coordinates (a basic
+        shape, say), to come back in its turn with the paths"""
+        self._add(tag, coords)
+
+    def _add(self, tag, slot):
+        self.tags.append(tag)
+        self.slots.append(slot)
+        if len(self.tags) >= self.batch:
+            self._send()
+
+    def _send(self):
+        if not self.tags:
+            return
+        r = None
+        if self.pending:
+            r = self.pool.map_async(_flatten_batch, [(self.flat, self.pending)])
+            self.batches += 1
+        self.in_flight.append((self.tags, self.slots, r))
+        self.pending = []
+        self.tags = []
+        self.slots = []
+
+    def results(self, finish=False):
+        """Yield (tag, coords) for finished items, in submission order
+
+        Without [finish] this only yields batches that are already done,
+        waiting just when too many are in flight.  With it, everything
+        submitted is flushed and waited for.
+        """
+        if finish:
+            self._send()
+
+        limit = self.processes*BATCHES_PER_WORKER
+        while self.in_flight:
+            (tags, slots, r) = self.in_flight[0]
+            if r and not (finish or r.ready() or len(self.in_flight) > limit):
+                return
+            flattened = iter(r and r.get()[0] or [])
+            self.in_flight.pop(0)
+            for (tag, slot) in zip(tags, slots):
+                if slot is None:
+                    slot = flattened.next()
+                yield (tag, slot)
+
+    def close(self):
+        """Stop the workers, dropping anything not yet collected"""
+        self.pending = []
+        self.tags = []
+        self.slots = []
+        self.in_flight = []
+        self.pool.terminate()
+        self.pool.join()
+
+    def summary(self):
+        return "Path pool: %d paths in %d batches on %d processes" % \
+            (self.paths, self.batches, self.processes)
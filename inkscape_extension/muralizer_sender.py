@@ -0,0 +1,439 @@
+import Queue
+import threading
+import time
+
+# The firmware collects each command line in a 32-byte buffer
+# (BUFLEN in firmware.ino), and only pulls bytes off the serial port
+# when it's not busy spinning motors or waiting on the pen servo.
+# Anything we've written but the firmware hasn't acknowledged is
+# sitting in the board's receive buffer, so we keep that under BUFLEN.
+FIRMWARE_BUFLEN = 32
+
+# How long to wait for the oldest command's reply before giving up on
+# the device.  Its reply can wait on the command before it, which may
+# still be running, so both are allowed for.
+REPLY_TIMEOUT_S = 1.0
+REPLY_TIMEOUT_PER_STEP_S = 0.05  # twice the nominal step time
+REPLY_TIMEOUT_PER_PEN_S = 1.5
+
+
+class SenderError(Exception):
+    pass
+
+
+class StreamingSender:
+    """Keeps a window of commands in flight to the muralizer
+
+    The firmware answers every command line with exactly one reply
+    line ("Rotating i0 i1", "Pen up", ...), in order.  Rather than
+    waiting for each reply and then guessing how long the move will
+    take, we write commands as long as the window has room, and let a
+    background reader thread match replies to commands in FIFO order.
+
+    The window is bounded both by a command count and by the number of
+    unacknowledged bytes, so we never overrun the firmware's buffer.
+    send() only blocks when the window is full.
+
+    With [completion_acks], the firmware answers each move when it's
+    finished rather than before it starts.  The window then counts
+    commands up to their completion, so drain() waits for the motors
+    to stop, and the oldest command in flight is the one running:
+    it's out of the firmware's buffer, so its bytes don't count
+    against window_bytes.
+
+    With [queue_slots], the firmware has a command queue ("q 1"): it
+    reads commands into a ring of that many slots while the motors
+    run, and answers each when it's done, with the number of slots
+    then free.  Bytes no longer pile up in its serial buffer, so the
+    window is just the queue plus the command running, and replies
+    are completions whatever [completion_acks] says.
+
+    With a [telemetry] (a muralizer_telemetry.Telemetry), the write
+    time, reply latency and device idle time of every command are
+    recorded there.
+
+    If the oldest command in flight goes unanswered for longer than
+    its moves and pen changes could take (a silent or reset board, a
+    lost reply), the sender fails and send(), query() and drain()
+    raise SenderError rather than waiting forever.
+    """
+    def __init__(self, serial_fd, window=4, window_bytes=FIRMWARE_BUFLEN,
+                 alert=None, telemetry=None, completion_acks=False,
+                 queue_slots=0):
+        self.serial_fd = serial_fd
+        self.window = max(1, int(window))
+        self.window_bytes = window_bytes
+        self.alert = alert or (lambda s: None)
+        self.telemetry = telemetry
+        self.completion_acks = completion_acks or bool(queue_slots)
+        self.queue_slots = queue_slots
+        if queue_slots:
+            self.window = queue_slots + 1
+            self.window_bytes = None
+
+        self.cond = threading.Condition()
+        self.in_flight = []     # [line, nbytes, steps, sent_at, reply, mark, timeout]
+        self.bytes_in_flight = 0
+        self.t_front = None     # when in_flight[0] became the oldest
+        self.last_timeout = 0.0  # allowance for the last command sent
+        self.error = None
+        self.running = True
+
+        self.reset_stats()
+
+        # Let the reader wake up now and then to notice close()
+        try:
+            self.serial_fd.timeout = 0.25
+        except AttributeError:
+            pass
+
+        self.reader = threading.Thread(target=self._reader_loop,
+                                       name="muralizer-reader")
+        self.reader.daemon = True
+        self.reader.start()
+
+    def reset_stats(self):
+        self.t_start = time.time()
+        self.t_last_ack = self.t_start
+        self.n_commands = 0
+        self.n_moves = 0
+        self.n_steps = 0
+        self.n_bytes_out = 0
+        self.n_bytes_in = 0
+        self.t_blocked = 0.0
+        self.max_in_flight = 0
+        self.n_free_replies = 0  # replies giving the queue's free slots
+        self.n_free_total = 0
+        self.n_dry = 0  # ... and how many of those found it empty
+
+    def _window_full(self, nbytes):
+        if not self.in_flight:
+            return False  # always let one command through
+        if len(self.in_flight) >= self.window:
+            return True
+        if self.window_bytes is None:
+            return False
+        buffered = self.bytes_in_flight
+        if self.completion_acks:
+            buffered -= self.in_flight[0][1]  # already read; it's running
+        return buffered + nbytes > self.window_bytes
+
+    def _check_error(self):
+        if self.error is not None:
+            raise SenderError(self.error)
+
+    def _wait(self):
+        """Wait on the condition for a while, with the lock held, and
+        fail if the oldest command is overdue"""
+        self.cond.wait(0.25)
+        if self.in_flight and self.error is None:
+            entry = self.in_flight[0]
+            if time.time() - self.t_front > entry[6]:
+                self.error = "No reply to '%s' after %.1f s" % (entry[0], entry[6])
+                self.cond.notifyAll()
+
+    def send(self, line, steps=0, mark=None):
+        """Queue a command line for the device, blocking only if the
+        window is full.  Returns the in-flight entry, whose reply
+        element is filled in when it arrives.  [mark], if given, is
+        called (from the reader thread) once the reply is in."""
+        data = line + "\n"
+        nbytes = len(data)
+
+        self.cond.acquire()
+        try:
+            self._check_error()
+            if self._window_full(nbytes):
+                t0 = time.time()
+                while self._window_full(nbytes) and self.error is None:
+                    self._wait()
+                self.t_blocked += time.time() - t0
+                self._check_error()
+
+            timeout = REPLY_TIMEOUT_S + steps*REPLY_TIMEOUT_PER_STEP_S
+            if line.startswith("p "):
+                timeout += REPLY_TIMEOUT_PER_PEN_S
+            entry = [line, nbytes, steps, time.time(), None, mark,
+                     timeout + self.last_timeout]
+            self.last_timeout = timeout
+            if not self.in_flight:
+                self.t_front = entry[3]
+                if self.telemetry:
+                    self.telemetry.device_busy(entry[3])
+            self.in_flight.append(entry)
+            self.bytes_in_flight += nbytes
+            self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+
+            self.n_commands += 1
+            self.n_bytes_out += nbytes
+            if steps:
+                self.n_moves += 1
+                self.n_steps += steps
+        finally:
+            self.cond.release()
+
+        self.serial_fd.write(data)
+        if self.telemetry:
+            self.telemetry.record("write", time.time() - entry[3])
+        return entry
+
+    def query(self, line):
+        """Send a command and wait for its reply."""
+        entry = self.send(line)
+
+        self.cond.acquire()
+        try:
+            while entry[4] is None and self.error is None:
+                self._wait()
+            self._check_error()
+        finally:
+            self.cond.release()
+
+        return entry[4]
+
+    def drain(self):
+        """Wait until every command in flight has been acknowledged."""
+        self.cond.acquire()
+        try:
+            while self.in_flight and self.error is None:
+                self._wait()
+            self._check_error()
+        finally:
+            self.cond.release()
+
+    def close(self):
+        self.running = False
+        self.reader.join(2.0)
+
+    def _reader_loop(self):
+        partial = ""
+        while self.running:
+            try:
+                chunk = self.serial_fd.readline()
+            except Exception as e:
+                self._fail("Serial read failed: %s" % e)
+                return
+
+            if not chunk:
+                continue
+
+            partial += chunk
+            if not partial.endswith("\n"):
+                continue  # readline timed out mid-line
+
+            reply = partial.strip()
+            partial = ""
+            try:
+                self._handle_reply(reply)
+            except Exception as e:
+                # Don't leave the senders waiting on a dead reader
+                self._fail("Reply '%s' failed: %s" % (reply, e))
+                return
+
+    def _handle_reply(self, reply):
+        entry = None
+        self.cond.acquire()
+        try:
+            self.n_bytes_in += len(reply) + 2
+            if not self.in_flight:
+                self.alert("SENDER: unsolicited reply '%s'" % reply)
+                return
+
+            entry = self.in_flight.pop(0)
+            self.bytes_in_flight -= entry[1]
+            entry[4] = reply
+            self.t_last_ack = time.time()
+            self.t_front = self.t_last_ack
+
+            if self.telemetry:
+                self.telemetry.record("reply", self.t_last_ack - entry[3])
+                if not self.in_flight:
+                    self.telemetry.device_idle(self.t_last_ack)
+
+            if reply.startswith("BUFFER OVERFLOW"):
+                self.error = "Firmware buffer overflow after '%s'" % entry[0]
+            elif self.queue_slots:
+                self._count_free(reply)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        if entry and entry[5]:
+            entry[5]()
+
+    def _count_free(self, reply):
+        # "Done i0 i1 <free>" and "Pen up <free>" say how full the
+        # firmware's queue was as this command finished
+        f = reply.split()
+        if not f or f[0] not in ("Done", "Pen") or not f[-1].isdigit():
+            return
+        free = int(f[-1])
+        self.n_free_replies += 1
+        self.n_free_total += free
+        if free >= self.queue_slots:
+            self.n_dry += 1
+
+    def _fail(self, msg):
+        self.cond.acquire()
+        try:
+            self.error = msg
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        """Throughput counters for the current plot."""
+        elapsed = max(self.t_last_ack - self.t_start, 1e-6)
+        return {
+            "commands": self.n_commands,
+            "moves": self.n_moves,
+            "steps": self.n_steps,
+            "bytes_out": self.n_bytes_out,
+            "bytes_in": self.n_bytes_in,
+            "elapsed_s": elapsed,
+            "blocked_s": self.t_blocked,
+            "max_in_flight": self.max_in_flight,
+            "commands_per_s": self.n_commands / elapsed,
+            "steps_per_s": self.n_steps / elapsed,
+            "queue_slots": self.queue_slots,
+            "queue_mean_free": self.n_free_replies and
+                float(self.n_free_total)/self.n_free_replies,
+            "queue_dry": self.n_dry,
+        }
+
+    def summary(self):
+        s = self.stats()
+        line = ("Sent %d commands (%d moves, %d steps, %d bytes) in %.1f s: "
+                "%.1f cmd/s, %.1f steps/s, %.1f s blocked on a full window"
+                % (s["commands"], s["moves"], s["steps"], s["bytes_out"],
+                   s["elapsed_s"], s["commands_per_s"], s["steps_per_s"],
+                   s["blocked_s"]))
+        if self.queue_slots:
+            line += ("; firmware queue %.1f of %d slots free on average, "
+                     "empty %d times" % (s["queue_mean_free"], self.queue_slots,
+                                         s["queue_dry"]))
+        return line
+
+
+# Commands the planner may run ahead of the send stage
+PIPELINE_DEPTH = 256
+
+
+class CommandPipeline:
+    """Runs the send stage on its own thread
+
+    Planning (traversal, flattening, kinematics, encoding) and sending
+    are the two ends of the plot.  Without this, the planner stalls
+    whenever the sender waits on the device.  With it, encoded command
+    lines go into a bounded queue and a "muralizer-send" thread feeds
+    them to [send].  The planner runs up to [depth] commands ahead of
+    the motors, and only waits when the queue is full, so memory stays
+    bounded however big the document is.
+
+    An error in the send stage is raised as a SenderError from the next
+    put() or flush().
+    """
+    def __init__(self, send, depth=PIPELINE_DEPTH, alert=None):
+        self.send = send
+        self.depth = max(1, int(depth))
+        self.alert = alert or (lambda s: None)
+
+        self.queue = Queue.Queue(self.depth)
+        self.error = None
+
+        self.reset_stats()
+
+        self.thread = threading.Thread(target=self._send_loop,
+                                       name="muralizer-send")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reset_stats(self):
+        self.t_start = time.time()
+        self.t_first = None
+        self.n_commands = 0
+        self.max_queued = 0
+        self.t_blocked = 0.0   # planner waiting on a full queue
+        self.t_starved = 0.0   # send stage waiting on the planner
+
+    def _check_error(self):
+        if self.error is not None:
+            raise SenderError(self.error)
+
+    def put(self, line, dr0=0, dr1=0, mark=None):
+        """Queue a command, and the move (dr0, dr1) it makes, for the
+        send stage"""
+        self._check_error()
+        item = (line, dr0, dr1, mark)
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            t0 = time.time()
+            while True:
+                self._check_error()
+                try:
+                    self.queue.put(item, True, 1.0)
+                    break
+                except Queue.Full:
+                    pass
+            self.t_blocked += time.time() - t0
+
+        self.n_commands += 1
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+
+    def flush(self):
+        """Wait until the send stage has sent everything queued"""
+        done = self.queue.all_tasks_done
+        done.acquire()
+        try:
+            while self.queue.unfinished_tasks and self.error is None:
+                done.wait(1.0)
+        finally:
+            done.release()
+        self._check_error()
+
+    def close(self):
+        """Send whatever is queued, then stop the send stage"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _send_loop(self):
+        while True:
+            t0 = time.time()
+            item = self.queue.get()
+            if self.t_first is not None and item is not None:
+                self.t_starved += time.time() - t0
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.send(*item)
+                    if self.t_first is None:
+                        self.t_first = time.time()
+            except Exception as e:
+                # Keep taking items off the queue, so the planner
+                # doesn't hang on a full one before it sees the error
+                self.error = "Send failed: %s" % e
+                self.alert("PIPELINE: " + self.error)
+            finally:
+                self.queue.task_done()
+
+    def stats(self):
+        return {
+            "commands": self.n_commands,
+            "depth": self.depth,
+            "max_queued": self.max_queued,
+            "first_command_s": self.t_first and self.t_first - self.t_start,
+            "blocked_s": self.t_blocked,
+            "starved_s": self.t_starved,
+        }
+
+    def summary(self):
+        s = self.stats()
+        first = s["first_command_s"]
+        return ("Pipelined %d commands (up to %d of %d queued), first sent after %s; "
+                "planner waited %.1f s on the device, sender waited %.1f s on the planner"
+                % (s["commands"], s["max_queued"], s["depth"],
+                   first is None and "-" or "%.2f s" % first,
+                   s["blocked_s"], s["starved_s"]))
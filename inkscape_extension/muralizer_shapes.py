@@ -0,0 +1,100 @@
+import array
+import math
+import re
+
+# Basic SVG shapes, straight to coordinates.
+#
+# The traversal used to turn every <rect>, <line>, <polyline>,
+# <polygon>, <circle> and <ellipse> into a throwaway <path> element,
+# format its d string, and have plotPath parse that string back.  Here
+# each shape goes directly to what path_coords() would have produced:
+# one array('d') of x0, y0, x1, y1, ... per subpath, transformed onto
+# the wall, with nodes closer than the flattening tolerance dropped
+# just as flatten_subpath() drops them.
+#
+# Circles and ellipses are sampled at an even angle step chosen so the
+# chords stay within the tolerance, rather than going through arcs,
+# then cubics, then subdivision.  They start at the leftmost point
+# and go round the same way as the arcs the old path did.
+
+MIN_ELLIPSE_SEGMENTS = 8
+
+_number = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+
+
+def parse_points(s):
+    """The (x, y) pairs in a polyline or polygon points attribute"""
+    v = [float(n) for n in _number.findall(s or "")]
+    return zip(v[0::2], v[1::2])
+
+
+def points_coords(points, mat, flat):
+    """One subpath through [points], transformed by [mat]"""
+    if not points:
+        return []
+
+    ((a, c, e), (b, d, f)) = mat
+    out = array.array('d')
+    min_seg2 = flat*flat
+    last = len(points) - 1
+    lx = ly = 0.0
+    for i in xrange(len(points)):
+        (x, y) = points[i]
+        px = a*x + c*y + e
+        py = b*x + d*y + f
+        if i and i != last and (px-lx)*(px-lx) + (py-ly)*(py-ly) < min_seg2:
+            continue
+        out.append(px)
+        out.append(py)
+        lx, ly = px, py
+
+    return [out]
+
+
+def polyline_coords(points, mat, flat, closed=False):
+    """A polyline, or with [closed] a polygon, back to its first point"""
+    if closed and points:
+        points = list(points) + [points[0]]
+    return points_coords(points, mat, flat)
+
+
+def line_coords(x1, y1, x2, y2, mat, flat):
+    return points_coords([(x1, y1), (x2, y2)], mat, flat)
+
+
+def rect_coords(x, y, w, h, mat, flat):
+    return points_coords([(x, y), (x + w, y), (x + w, y + h), (x, y + h), (x, y)],
+                         mat, flat)
+
+
+def _max_stretch(a, b, c, d):
+    """Largest factor by which the 2x2 matrix [[a, c], [b, d]] scales a
+    distance (its largest singular value)"""
+    s = a*a + b*b + c*c + d*d
+    det = a*d - b*c
+    return math.sqrt((s + math.sqrt(max(s*s - 4*det*det, 0.0)))/2)
+
+
+def ellipse_coords(cx, cy, rx, ry, mat, flat):
+    """An ellipse, sampled finely enough that no chord strays more
+    than [flat] from the curve on the wall"""
+    if rx <= 0 or ry <= 0:
+        return []
+
+    ((a, c, e), (b, d, f)) = mat
+
+    # The ellipse on the wall is the unit circle under this matrix
+    r = _max_stretch(a*rx, b*rx, c*ry, d*ry)
+    if flat < r:
+        step = 2*math.acos(1 - flat/r)
+        n = max(MIN_ELLIPSE_SEGMENTS, int(math.ceil(2*math.pi/step)))
+    else:
+        n = MIN_ELLIPSE_SEGMENTS
+
+    points = []
+    for k in xrange(n):
+        t = math.pi - 2*math.pi*k/n
+        points.append((cx + rx*math.cos(t), cy + ry*math.sin(t)))
+    points.append(points[0])
+
+    return points_coords(points, mat, flat)
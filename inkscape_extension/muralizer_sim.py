@@ -0,0 +1,270 @@
+import collections
+import math
+
+# Offline plot simulation.
+#
+# PlotSimulator watches the commands MuralizerState would put on the
+# wire and runs them against a model of firmware.ino and the serial
+# link, on a virtual clock, so a plot's duration can be estimated
+# without touching any hardware.
+#
+# The model:
+#
+#  - Both steppers are Stepper(48, ...) with setSpeed(50), so a step
+#    takes 60/(50*48) s = 25 ms.  spin_bresenham() steps the two
+#    motors in turn, but each motor only has to wait out its own step
+#    delay, so a move takes max(|dr0|, |dr1|) step times.
+#  - pen_up()/pen_down() block for delay(1000).
+#  - The link runs at 9600 baud, 10 bits a byte, in each direction.
+#  - The firmware only reads serial between commands.  It replies to
+#    a move ("Rotating i0 i1") before spinning, or with completion
+#    acks ("Done i0 i1") after, and to a pen command ("Pen up") after
+#    the delay.
+#  - With its command queue on, it also reads while the motors run,
+#    and answers each command when it's done, with the queue's free
+#    slots.  The host then keeps the queue full rather than the
+#    32-byte buffer.
+#  - The host either streams with a window of commands in flight
+#    (StreamingSender), or, with streamWindow = 0, waits for each
+#    reply, and without completion acks then sleeps 5 ms a step (the
+#    old cmd_move_rs).  It takes [host_latency] to react to a reply:
+#    USB, the OS, a busy planner.
+#
+# Given a calibrated muralizer_timing.TimeModel, its move and pen
+# times replace the step time and pen delay above.
+
+FIRMWARE_STEPS_PER_REV = 48
+FIRMWARE_RPM = 50
+PEN_DELAY_S = 1.0
+BAUD = 9600
+BITS_PER_BYTE = 10
+HOST_SLEEP_PER_STEP = 0.005
+FIRMWARE_BUFLEN = 32
+FIRMWARE_QUEUE_SLOTS = 16
+
+
+class PlotSimulator:
+    """Estimates time, distances and traffic for a plot
+
+    Takes the same move()/pen() calls as a PlanWriter, so it can be
+    hung off MuralizerState in the same way.  [ms] supplies the
+    kinematics used to turn steps back into distances on the wall.
+    [acks] says whether the firmware acknowledges moves when they're
+    done; by default, whether ms asks it to.  [queue_slots] is the
+    size of the firmware's command queue, 0 for none; by default it's
+    FIRMWARE_QUEUE_SLOTS if ms would use it.
+    """
+    def __init__(self, ms, window=None, window_bytes=FIRMWARE_BUFLEN,
+                 step_time=None, model=None, acks=None, queue_slots=None,
+                 host_latency=0.0):
+        self.ms = ms
+        if window is None:
+            window = ms.streamWindow
+        if acks is None:
+            acks = ms.completionAcks
+        if queue_slots is None:
+            queue_slots = (ms.commandQueue and ms.serialProtocol != "binary"
+                           and FIRMWARE_QUEUE_SLOTS or 0)
+        if queue_slots and window > 0:
+            # As StreamingSender does
+            window = queue_slots + 1
+            window_bytes = None
+        self.window = window
+        self.window_bytes = window_bytes
+        self.acks = acks or bool(queue_slots)
+        self.queue_slots = queue_slots
+        self.host_latency = host_latency
+        self.model = model
+
+        if step_time is None:
+            step_time = 60.0/(FIRMWARE_RPM*FIRMWARE_STEPS_PER_REV)
+        self.step_time = step_time
+        self.pen_delay = model and model.pen_s or PEN_DELAY_S
+        self.byte_time = float(BITS_PER_BYTE)/BAUD
+
+        self.r0 = ms.r0
+        self.r1 = ms.r1
+        self.pen_up = None
+
+        # Virtual clock state
+        self.t_host = 0.0       # when the host can next write
+        self.t_tx_free = 0.0    # host -> device line
+        self.t_rx_free = 0.0    # device -> host line
+        self.t_fw_free = 0.0    # when the firmware next reads serial
+        self.t_done = 0.0
+        self.in_flight = collections.deque()  # (reply arrival, nbytes)
+        self.last_reply = 0.0
+        self.last_sleep = 0.0
+
+        self.commands = 0
+        self.moves = 0
+        self.pen_lifts = 0
+        self.pen_drops = 0
+        self.steps = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.draw_mm = 0.0
+        self.travel_mm = 0.0
+        self.motor_time = 0.0
+        self.pen_time = 0.0
+        self.fw_idle = 0.0
+        self.fw_stalls = 0  # commands the firmware had to wait for
+
+    def _command(self, line, reply, busy, reply_after):
+        nout = len(line) + 1
+        nin = len(reply) + 2
+        if self.queue_slots:
+            nin += 3  # " <free>"
+
+        # When may the host write this command?
+        lag = self.host_latency
+        if self.window > 0:
+            t = self.t_host
+            while self.in_flight and self.in_flight[0][0] + lag <= t:
+                self.in_flight.popleft()
+            while self.in_flight and (
+                    len(self.in_flight) >= self.window or
+                    (self.window_bytes is not None and
+                     self._buffered() + nout > self.window_bytes)):
+                t = max(t, self.in_flight.popleft()[0] + lag)
+        else:
+            t = max(self.t_host, self.last_reply + lag + self.last_sleep)
+
+        # Over the wire, then wait for the firmware to get to it
+        arrive = max(t, self.t_tx_free) + nout*self.byte_time
+        self.t_tx_free = arrive
+        start = max(arrive, self.t_fw_free)
+        if self.commands and start > self.t_fw_free:
+            self.fw_idle += start - self.t_fw_free
+            self.fw_stalls += 1
+
+        if reply_after:
+            t_reply = start + busy
+        else:
+            t_reply = start
+        reply_at = max(t_reply, self.t_rx_free) + nin*self.byte_time
+        self.t_rx_free = reply_at
+        self.t_fw_free = start + busy
+
+        self.t_host = t
+        if self.window > 0:
+            self.in_flight.append((reply_at, nout))
+        self.last_reply = reply_at
+        self.t_done = max(self.t_fw_free, reply_at)
+
+        self.commands += 1
+        self.bytes_out += nout
+        self.bytes_in += nin
+
+    def _buffered(self):
+        """Bytes in flight that StreamingSender counts against its window"""
+        n = sum(n for (_, n) in self.in_flight)
+        if self.acks and self.in_flight:
+            n -= self.in_flight[0][1]  # running, so out of the buffer
+        return n
+
+    def move(self, dr0, dr1, path=0, node=0):
+        steps = max(abs(dr0), abs(dr1))
+        if self.model:
+            busy = self.model.move_time(dr0, dr1)
+        else:
+            busy = steps*self.step_time
+
+        if self.acks:
+            self._command("r %d %d" % (dr0, dr1), "Done %d %d" % (dr0, dr1),
+                          busy, True)
+            self.last_sleep = 0.0
+        else:
+            self._command("r %d %d" % (dr0, dr1), "Rotating %d %d" % (dr0, dr1),
+                          busy, False)
+            if self.model:
+                self.last_sleep = busy
+            else:
+                self.last_sleep = steps*HOST_SLEEP_PER_STEP
+
+        a = self.ms.area_for_steps(self.r0, self.r1)
+        self.r0 += dr0
+        self.r1 += dr1
+        b = self.ms.area_for_steps(self.r0, self.r1)
+        d = math.hypot(b[0] - a[0], b[1] - a[1])
+        if self.pen_up is False:
+            self.draw_mm += d
+        else:
+            self.travel_mm += d
+
+        self.moves += 1
+        self.steps += steps
+        self.motor_time += busy
+
+    def pen(self, up, path=0, node=0):
+        if up:
+            self._command("p u", "Pen up", self.pen_delay, True)
+            self.pen_lifts += 1
+        else:
+            self._command("p d", "Pen down", self.pen_delay, True)
+            self.pen_drops += 1
+        self.last_sleep = 0.0
+        self.pen_up = up
+        self.pen_time += self.pen_delay
+
+    def report(self):
+        return {
+            "total_s": self.t_done,
+            "motor_s": self.motor_time,
+            "pen_s": self.pen_time,
+            "firmware_idle_s": self.fw_idle,
+            "firmware_stalls": self.fw_stalls,
+            "draw_mm": self.draw_mm,
+            "travel_mm": self.travel_mm,
+            "pen_lifts": self.pen_lifts,
+            "pen_drops": self.pen_drops,
+            "commands": self.commands,
+            "moves": self.moves,
+            "steps": self.steps,
+            "bytes_out": self.bytes_out,
+            "bytes_in": self.bytes_in,
+        }
+
+    def summary(self):
+        r = self.report()
+        return "\n".join([
+            "Estimated plot time: %s (motors %s, pen %s, firmware idle %s in %d gaps)" % (
+                format_duration(r["total_s"]), format_duration(r["motor_s"]),
+                format_duration(r["pen_s"]), format_duration(r["firmware_idle_s"]),
+                r["firmware_stalls"]),
+            "Drawing %.2f m, travelling %.2f m with the pen up, %d pen lifts" % (
+                r["draw_mm"]/1000, r["travel_mm"]/1000, r["pen_lifts"]),
+            "%d commands (%d moves, %d steps), %d bytes sent, %d bytes received" % (
+                r["commands"], r["moves"], r["steps"], r["bytes_out"], r["bytes_in"]),
+        ])
+
+
+def format_duration(s):
+    s = int(round(s))
+    return "%d:%02d:%02d" % (s/3600, (s/60) % 60, s % 60)
+
+
+if __name__ == '__main__':
+    # Estimate how long a compiled plan will take to draw
+    from optparse import OptionParser
+    from muralizer_state import MuralizerState
+    from muralizer_plan import PlanReader, replay_plan
+    from muralizer_timing import load_time_model
+
+    parser = OptionParser(usage="%prog [options] plan-file")
+    parser.add_option("--streamWindow", dest="streamWindow", type="int",
+                      default=4, help="Commands kept in flight (0: wait on each)")
+    (opts, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("need exactly one plan file")
+
+    plan = PlanReader(args[0])
+    try:
+        ms = MuralizerState(options=plan.options(streamWindow=opts.streamWindow,
+                                                 optimizeCommands=False),
+                            serialPort=None)
+        ms.simulator = PlotSimulator(ms, model=load_time_model())
+        replay_plan(plan, ms)
+        print(ms.simulator.summary())
+    finally:
+        plan.close()
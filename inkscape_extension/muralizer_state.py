@@ -7,10 +7,24 @@ import os
 import string
 import sys
 import time
-import json
 
 import serial
 
+# NumPy is optional; without it the batch kinematics fall back to
+# plain Python loops (still without the per-point logging).
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from muralizer_sender import StreamingSender, CommandPipeline, PIPELINE_DEPTH
+from muralizer_plan import PlanWriter
+from muralizer_peephole import CommandOptimizer
+from muralizer_log import DebugLog, parse_level
+from muralizer_telemetry import Telemetry
+from muralizer_timing import load_time_model
+from muralizer_binary import FrameSender, BINARY_BAUD, BAUD_SWITCH_S
+
 platform = sys.platform.lower()
 
 if platform == 'win32':
@@ -26,6 +40,63 @@ else:
 # findCustomSerial
 # findSerialPorts
 
+
+def find_muralizers(alert, first_only=False):
+    """Every attached muralizer, as (path, open serial port) pairs
+
+    A port counts if it answers "v" with our firmware version.  With
+    [first_only], stop at the first one found.
+    """
+    boards = [
+        ("Muralizer"       , "F054", "0100"),
+        ("Leonardo"        , "2341", "8036"),
+    ]
+
+    all_ports = []
+
+    for board, vid, pid in boards:
+        for p in findCustomSerial(board, vid, pid):
+            all_ports.append((board, p))
+
+    for p in findSerialPorts():
+        all_ports.append(("COM",p))
+
+    found = []
+    seen = set()
+    for t, path in all_ports:
+        if path in seen:
+            continue
+        seen.add(path)
+
+        alert("Trying port of type %s, at path %s" % (t, path))
+
+        try:
+            s = serial.Serial(path, 9600, timeout=1)
+        except (serial.SerialException, OSError) as e:
+            alert("Passing on port %s/%s: %s" % (path, t, e))
+            continue
+
+        while(s.readline()):
+            pass
+
+        s.write("v\n")
+        reply = s.readline().strip()
+
+        if reply != "3.1":
+            alert("Passing on port %s/%s: invalid reply '%s'" % (path, t, reply) )
+            s.close()
+        else:
+            found.append((path, s))
+            if first_only:
+                break
+
+    return found
+
+
+def spool_distance(a, b):
+    """Steps the firmware takes to move between spool positions a and b"""
+    return max(abs(a[0] - b[0]), abs(a[1] - b[1]))
+
 class MuralizerState:
     """Encapsulates the state of the muralizer hardware
 
@@ -45,11 +116,19 @@ class MuralizerState:
 
     """
     def __init__(self, *args, **kwargs):
-        self.debug_path = "/tmp/muralizer_debug"
-        self.debug_fd = file(self.debug_path, "w")
+        self.debug_path = kwargs.get("debugPath", "/tmp/muralizer_debug")
+        self.log = DebugLog(self.debug_path,
+                            parse_level(getattr(kwargs["options"], "logLevel", "info")))
 
         self.alert("Set up state.")
 
+        self.plan = None
+        self.cursor = (0, 0)
+        self.mark = None  # for the next command; see set_mark()
+        self.optimizer = None
+        self.simulator = None  # a PlotSimulator, for dry runs
+        self.compiling = None
+
         options = kwargs["options"]
         self.update_options(options)
 
@@ -67,51 +146,196 @@ class MuralizerState:
             self.alert("Got header line: " + header_line.strip())
 
         if not self.has_serial:
-            self.serial_path = ""
-            self.serial_fd = file(os.devnull, "w")
+            # With no device, commands go to the bit bucket, or to a
+            # text file for dry runs
+            self.serial_path = kwargs.get("dryRunPath") or os.devnull
+            self.serial_fd = file(self.serial_path, "w")
             self.has_serial = False
-            self.alert("Running with no real serial port")
+            self.alert("Running with no real serial port, writing to %s" % self.serial_path)
 
-    
-        
+        # Per-command timings, written to telemetryFile by drain()
+        self.telemetry = Telemetry()
+        self.telemetry_path = kwargs.get("telemetryPath") or getattr(options, "telemetryFile", "")
 
-    def find_serial(self):
-        boards = [
-            ("Muralizer"       , "F054", "0100"),
-            ("Leonardo"        , "2341", "8036"),
-        ]
+        self.sender = None
+        self.pipeline = None
+        self.acks = False  # the firmware answers moves once they're done
+        self.binary = None  # firmware version, if we're talking in frames
+        self.queue_slots = 0  # size of the firmware's command queue, if it's on
+        self.time_model = None  # a TimeModel, for firmware that can't
+        self.start_sender()
 
-        all_ports = []
+        if options.optimizeCommands:
+            self.optimizer = CommandOptimizer(self._emit_move, self._emit_pen)
 
-        for board, vid, pid in boards:
-            for p in findCustomSerial(board, vid, pid):
-                all_ports.append((board, p))
 
-        for p in findSerialPorts():
-            all_ports.append(("COM",p))
+    def start_sender(self):
+        """Stream commands through a windowed sender, if configured.
 
-        for t, path in all_ports:
-            self.alert("Trying port of type %s, at path %s" % (t, path))
+        With streamWindow == 0 (or no real serial port), we fall back
+        to the old query-then-sleep behavior for every command.
 
-            s = serial.Serial(path, 9600, timeout=1)
+        With serialProtocol "binary", and firmware that can, commands
+        go out packed into frames by a FrameSender instead.  Otherwise,
+        with commandQueue, the firmware's command queue is turned on,
+        and the window is kept as full as the queue allows.
 
+        With pipelineDepth > 0, sending also gets its own thread, so
+        planning can run ahead of the device."""
+        self.stop_sender()
 
-            while(s.readline()):
-                pass
+        if self.has_serial:
+            self.acks = self.completionAcks and self.enable_acks()
+            if self.serialProtocol == "binary":
+                self.binary = self.enable_binary()
+            elif self.commandQueue:
+                self.queue_slots = self.enable_queue()
+            if not self.acks and not self.queue_slots:
+                self.time_model = load_time_model(self.serial_path)
+
+        if self.has_serial and self.binary:
+            self.sender = FrameSender(self.serial_fd,
+                                      alert=self.alert,
+                                      telemetry=self.telemetry,
+                                      version=self.binary,
+                                      baud=self.binaryBaud)
+            self.alert("Sending binary frames at %d baud" % self.binaryBaud)
+        elif self.has_serial and self.streamWindow > 0:
+            self.sender = StreamingSender(self.serial_fd,
+                                          window=self.streamWindow,
+                                          alert=self.alert,
+                                          telemetry=self.telemetry,
+                                          completion_acks=self.acks,
+                                          queue_slots=self.queue_slots)
+            self.alert("Streaming with a window of %d commands" % self.sender.window)
+
+        if self.has_serial and self.pipelineDepth > 0:
+            self.pipeline = CommandPipeline(self._send, depth=self.pipelineDepth,
+                                            alert=self.alert)
+            self.alert("Planning up to %d commands ahead" % self.pipelineDepth)
+
+    def enable_acks(self):
+        """Ask the firmware to answer moves when they're finished;
+        False if it doesn't know how"""
+        reply = self._send("a 1", wait=True)
+        if reply == "Acks on":
+            self.alert("Firmware acknowledges moves when they're done")
+            return True
+
+        self.alert("No completion acks from the firmware ('%s')" % reply)
+        return False
 
-            s.write("v\n")
-            reply = s.readline().strip()
+    def enable_queue(self):
+        """Turn on the firmware's command queue; its size in commands,
+        or 0 if it hasn't got one"""
+        reply = self._send("q 1", wait=True)
+        f = reply.split()
+        if len(f) == 2 and f[0] == "Queue" and f[1].isdigit():
+            self.alert("Firmware queues up to %s commands" % f[1])
+            return int(f[1])
+
+        self.alert("No command queue in the firmware ('%s')" % reply)
+        return 0
+
+    def enable_binary(self):
+        """Switch the firmware, and the port, to binary framing; the
+        firmware version if that worked, else None"""
+        reply = self._send("v b", wait=True)
+        f = reply.split()
+        if f[1:] != ["b"]:
+            self.alert("Firmware can't do binary framing ('%s'), staying with ASCII" % reply)
+            return None
+
+        reply = self._send("b %d" % self.binaryBaud, wait=True)
+        if reply != "Binary %d" % self.binaryBaud:
+            self.alert("Firmware wouldn't switch to binary ('%s'), staying with ASCII" % reply)
+            return None
+
+        try:
+            self.serial_fd.baudrate = self.binaryBaud
+        except AttributeError:
+            pass
+        time.sleep(BAUD_SWITCH_S)
+        return f[0]
+
+    def move_wait(self, dr0, dr1):
+        """How long move (dr0, dr1) takes, for firmware that answers
+        before moving: measured if we've calibrated, else a guess"""
+        if self.time_model:
+            return self.time_model.move_time(dr0, dr1)
+        return max(abs(dr0), abs(dr1))*0.005
+
+    def stop_sender(self):
+        """Send anything still queued, and shut down the send stage"""
+        if self.pipeline:
+            self.pipeline.close()
+            self.pipeline = None
+
+        if self.queue_slots:
+            # Once everything queued has run; leave the firmware as it
+            # was at power-up
+            self.queue_slots = 0
+            try:
+                self._send("q 0", wait=True)
+            except Exception as e:
+                self.alert("Couldn't turn off the firmware's queue: %s" % e)
+
+        if self.sender:
+            self.sender.close()  # a FrameSender goes back to ASCII
+            self.sender = None
+        self.binary = None
+
+        self.log.flush()
+
+    def drain(self):
+        """Send anything held back, and wait for the device to
+        acknowledge everything we've sent.
+
+        Returns a summary of what the optimizer saved and the
+        throughput of the commands streamed since the last drain(),
+        or None if there's nothing to report."""
+        lines = []
+
+        if self.optimizer:
+            self.optimizer.flush()
+            lines.append(self.optimizer.summary())
+            self.optimizer.reset_stats()
+
+        if self.pipeline:
+            self.pipeline.flush()
+            lines.append(self.pipeline.summary())
+            self.pipeline.reset_stats()
+
+        if self.sender:
+            self.sender.drain()
+            lines.append(self.sender.summary())
+            self.sender.reset_stats()
+
+        if self.telemetry.commands:
+            lines.append(self.telemetry.summary())
+            if self.telemetry_path:
+                self.telemetry.export(self.telemetry_path)
+                lines.append("Telemetry written to %s" % self.telemetry_path)
+            self.telemetry.reset()
+
+        if not lines:
+            return None
+
+        summary = "\n".join(lines)
+        self.alert("THROUGHPUT: " + summary)
+        self.log.flush()
+        return summary
 
-            if reply != "3.1":
-                self.alert("Passing on port %s/%s: invalid reply '%s'" % (path, t, reply) )
-                s.close()
-            else:
-                self.serial_path = path
-                self.serial_fd = s
-                self.has_serial = True
-                return
+
+    def find_serial(self):
+        found = find_muralizers(self.alert, first_only=True)
+        if found:
+            (self.serial_path, self.serial_fd) = found[0]
+            self.has_serial = True
             
     def update_options(self, options):
+        self.options = options
+
         self.canvasWidth  = 10.0*options.canvasWidth  # cm to mm
         self.canvasHeight = 10.0*options.canvasHeight # 
         self.marginXL     = 10.0*options.marginXL     # 
@@ -123,6 +347,13 @@ class MuralizerState:
         
         self.stepMM = self.spoolDiameter*math.pi/self.stepsPerRev
 
+        self.streamWindow = int(options.streamWindow) # commands in flight
+        self.pipelineDepth = int(getattr(options, "pipelineDepth", PIPELINE_DEPTH)) # commands queued to send
+        self.completionAcks = bool(getattr(options, "completionAcks", True)) # ask for "Done" replies
+        self.serialProtocol = getattr(options, "serialProtocol", "ascii") # or "binary" framing
+        self.binaryBaud = int(getattr(options, "binaryBaud", BINARY_BAUD))
+        self.commandQueue = bool(getattr(options, "commandQueue", True)) # firmware queues moves
+
 
         # XXX TODO There must be better bounds to use here
         self.MIN_R = (self.spoolDiameter+25) / self.stepMM
@@ -177,21 +408,84 @@ class MuralizerState:
         self.go_to_area(self.initial_x-self.marginXL, self.initial_y-self.marginYT)
 
 
-    def attach_serial(self, serial_fd):
+    def attach_serial(self, serial_fd, path=None):
         if not self.has_serial:
             self.serial_fd.close()
 
         self.serial_fd = serial_fd
+        if path:
+            self.serial_path = path
         self.has_serial = True
+        self.start_sender()
 
         self.alert("Attached serial.")
 
     def detach_serial(self):
+        self.stop_sender()
+
         self.has_serial = False
         self.serial_fd = file("/dev/null", "w")
 
         self.alert("Detached serial.")
 
+    def record_plan(self, path):
+        """Start writing every command we send to a compiled plan file"""
+        self.stop_recording()
+        self.plan = PlanWriter(path, self.options, self.r0, self.r1)
+        self.alert("Recording plan to %s" % path)
+
+    def stop_recording(self):
+        """Finish the plan being recorded, if any; returns its length"""
+        if not self.plan:
+            return 0
+
+        if self.optimizer:
+            self.optimizer.flush()
+
+        n = self.plan.count
+        self.plan.close()
+        self.alert("Recorded %d plan commands to %s" % (n, self.plan.path))
+        self.plan = None
+        return n
+
+    def start_compiling(self, path):
+        """Record a plan to [path] without sending anything: commands go
+        to the bit bucket until stop_compiling()"""
+        self.compiling = (self.serial_fd, self.has_serial, self.simulator,
+                          self.r0, self.r1)
+        self.stop_sender()
+        self.serial_fd = file(os.devnull, "w")
+        self.has_serial = False
+        self.simulator = None
+
+        self.record_plan(path)
+
+    def stop_compiling(self):
+        """Finish the plan and reconnect the device, which hasn't moved;
+        returns the plan's length"""
+        n = self.stop_recording()
+
+        self.serial_fd.close()
+        (self.serial_fd, self.has_serial, self.simulator,
+         self.r0, self.r1) = self.compiling
+        self.compiling = None
+
+        if self.optimizer:
+            # It's seen pen commands the device hasn't
+            self.optimizer = CommandOptimizer(self._emit_move, self._emit_pen)
+        self.start_sender()
+        return n
+
+    def set_mark(self, mark):
+        """Have the next command carry [mark], a callable, which is
+        called once the device has answered that command: after the
+        pipeline, the sender's window and the firmware's queue"""
+        self.mark = mark
+
+    def set_cursor(self, path, node):
+        """Note the traversal position, for tagging recorded commands"""
+        self.cursor = (path, node)
+
     def page_width(self):
         """Get the width of the actual drawing area, in mm"""
         return (self.canvasWidth - self.marginXL - self.marginXR)
@@ -215,10 +509,12 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
         return retval
 
     def alert(self, str):
-        self.debug_fd.write(str + "\n")
-        self.debug_fd.flush()
-        pass
-        
+        self.log.info(str)
+
+    def dump_recent(self, why):
+        """Log the last commands sent, after [why] went wrong"""
+        self.log.dump_recent(why)
+        self.log.flush()
 
 
     def clip_abs_xy(self, x, y):
@@ -226,17 +522,17 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
         y_bounds = (self.marginYT, self.marginYT+self.page_height())
         
         if x < x_bounds[0]:
-            self.alert("x would violate left margin, clipping (%.1f < %.1f)" % (x,x_bounds[0]))
+            self.log.debug("x would violate left margin, clipping (%.1f < %.1f)", x,x_bounds[0])
             x = x_bounds[0]
         elif x > x_bounds[1]:
-            self.alert("x would violate right margin, clipping (%.1f > %.1f)" % (x, x_bounds[1]))
+            self.log.debug("x would violate right margin, clipping (%.1f > %.1f)", x, x_bounds[1])
             x = x_bounds[1]
 
         if y < y_bounds[0]:
-            self.alert("y would violate top margin, clipping (%.1f < %.1f)" % (y,y_bounds[0]))
+            self.log.debug("y would violate top margin, clipping (%.1f < %.1f)", y,y_bounds[0])
             y = y_bounds[0]
         elif y > y_bounds[1]:
-            self.alert("y would violate bottom margin, clipping (%.1f > %.1f)" % (y, y_bounds[1]))
+            self.log.debug("y would violate bottom margin, clipping (%.1f > %.1f)", y, y_bounds[1])
             y = y_bounds[1]
 
         return (x,y)
@@ -261,12 +557,16 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
         #
         # Yay, my math degree was good for something!
         #
+        # (r0 and r1 are kept in steps, so convert them to mm first.)
         
-        return (self.r0*self.r0 - self.r1*self.r1 + self.canvasWidth*self.canvasWidth)/(2*self.canvasWidth)
+        r0 = self.r0*self.stepMM
+        r1 = self.r1*self.stepMM
+        return (r0*r0 - r1*r1 + self.canvasWidth*self.canvasWidth)/(2*self.canvasWidth)
 
     def abs_y(self):
         x = self.abs_x()
-        return math.sqrt( self.r0*self.r0 - x*x )
+        r0 = self.r0*self.stepMM
+        return math.sqrt( max(r0*r0 - x*x, 0.0) )
         
 
     def area_x(self):
@@ -283,11 +583,11 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
         r = round( l/self.stepMM )
 
         if r < self.MIN_R:
-            self.alert("Move would violate r0 MIN_R, clipping")
+            self.log.debug("Move would violate r0 MIN_R, clipping")
             r = self.MIN_R
 
         if r > self.MAX_R:
-            self.alert("Move would violate r0 MAX_R, clipping")
+            self.log.debug("Move would violate r0 MAX_R, clipping")
             r = self.MAX_R
 
         return r
@@ -300,15 +600,215 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
 
         r = round( l/self.stepMM )
         if r < self.MIN_R:
-            self.alert("Move would violate r1 MIN_R, clipping")
+            self.log.debug("Move would violate r1 MIN_R, clipping")
             r = self.MIN_R
 
         if r > self.MAX_R:
-            self.alert("Move would violate r1 MAX_R, clipping")
+            self.log.debug("Move would violate r1 MAX_R, clipping")
             r = self.MAX_R
 
         return r
 
+    def spool_steps(self, x, y):
+        """Unclipped, unrounded (r0, r1) for a drawing-area point.
+
+        This is for planning estimates (path ordering and the like),
+        so unlike calc_r0/calc_r1 it doesn't clip or log anything."""
+        xp = x + self.marginXL
+        yp = y + self.marginYT
+        return (math.sqrt(xp*xp + yp*yp)/self.stepMM,
+                math.sqrt((self.canvasWidth-xp)*(self.canvasWidth-xp) + yp*yp)/self.stepMM)
+
+    def area_for_steps(self, r0, r1):
+        """Drawing-area point for (unrounded) spool lengths in steps;
+        the inverse of spool_steps(), by the same triangles as abs_x()"""
+        l0 = r0*self.stepMM
+        l1 = r1*self.stepMM
+        W = self.canvasWidth
+        x = (l0*l0 - l1*l1 + W*W)/(2*W)
+        y = math.sqrt(max(l0*l0 - x*x, 0.0))
+        return (x - self.marginXL, y - self.marginYT)
+
+    def move_deviation(self, a, b):
+        """How far (mm) a single move from area point a to b strays
+        from the straight line between them.
+
+        The firmware interpolates linearly in (r0, r1), which traces a
+        curve on the wall.  We measure it where it bulges the most,
+        about halfway along in spool space."""
+        ra = self.spool_steps(*a)
+        rb = self.spool_steps(*b)
+        m = self.area_for_steps((ra[0]+rb[0])/2, (ra[1]+rb[1])/2)
+
+        dx = b[0] - a[0]
+        dy = b[1] - a[1]
+        l = math.sqrt(dx*dx + dy*dy)
+        if l == 0:
+            return 0.0
+        return abs(dx*(a[1] - m[1]) - (a[0] - m[0])*dy) / l
+
+    def straight_line(self, a, b, tolerance):
+        """Split the move from area point a to b into the fewest equal
+        pieces that each stay within [tolerance] mm of the straight
+        line.  Returns the points after a, ending with b."""
+        d = self.move_deviation(a, b)
+        if d <= tolerance:
+            return [b]
+
+        # Deviation falls off roughly as 1/k^2 over k pieces; start
+        # there and check, but never split finer than a step.
+        ra = self.spool_steps(*a)
+        rb = self.spool_steps(*b)
+        max_k = max(int(spool_distance(ra, rb)), 1)
+        k = min(max(2, int(math.ceil(math.sqrt(d/tolerance)))), max_k)
+
+        while True:
+            pts = [(a[0] + (b[0]-a[0])*i/k, a[1] + (b[1]-a[1])*i/k)
+                   for i in xrange(1, k+1)]
+            pts[-1] = b
+
+            if k >= max_k:
+                return pts
+
+            prev = a
+            worst = 0.0
+            for p in pts:
+                worst = max(worst, self.move_deviation(prev, p))
+                prev = p
+            if worst <= tolerance:
+                return pts
+            k += 1
+
+    def straight_run(self, start, points, tolerance):
+        """straight_line() for each move of a pen-down run from [start]
+        through [points].  Returns (points, index), where index[i] is
+        the position in [points] of the move each output point is on."""
+        out = []
+        index = []
+        prev = start
+        for i, p in enumerate(points):
+            pts = self.straight_line(prev, p, tolerance)
+            out.extend(pts)
+            index.extend([i]*len(pts))
+            prev = p
+        return (out, index)
+
+    def batch_kinematics(self, xy):
+        """Clipped integer (r0, r1) for a whole run of drawing-area points.
+
+        [xy] is an (N,2) array (or list of pairs) of area coordinates.
+        Returns (r0, r1, dr0, dr1, violations), where the deltas are
+        relative to the previous point (the current position, for the
+        first one) and [violations] maps "x_margin", "y_margin",
+        "r_min" and "r_max" to boolean masks of the points that had to
+        be clipped.  Unlike calc_r0/calc_r1, radii are clipped to whole
+        steps (ceil(MIN_R), floor(MAX_R)), and nothing is logged.
+
+        Arrays are NumPy arrays when NumPy is available, lists otherwise.
+        """
+        lo_r = math.ceil(self.MIN_R)
+        hi_r = math.floor(self.MAX_R)
+        x_lo, x_hi = self.marginXL, self.marginXL + self.page_width()
+        y_lo, y_hi = self.marginYT, self.marginYT + self.page_height()
+
+        if numpy is None:
+            return self._batch_kinematics_py(xy, lo_r, hi_r, x_lo, x_hi, y_lo, y_hi)
+
+        xy = numpy.asarray(xy, dtype=float).reshape(-1, 2)
+        x = xy[:,0] + self.marginXL
+        y = xy[:,1] + self.marginYT
+
+        x_bad = (x < x_lo) | (x > x_hi)
+        y_bad = (y < y_lo) | (y > y_hi)
+        x = numpy.clip(x, x_lo, x_hi)
+        y = numpy.clip(y, y_lo, y_hi)
+
+        # floor(v+0.5) rather than rint, to round halves the way round() does
+        r0 = numpy.floor(numpy.hypot(x, y)/self.stepMM + 0.5)
+        r1 = numpy.floor(numpy.hypot(self.canvasWidth - x, y)/self.stepMM + 0.5)
+
+        r_min = (r0 < lo_r) | (r1 < lo_r)
+        r_max = (r0 > hi_r) | (r1 > hi_r)
+        r0 = numpy.clip(r0, lo_r, hi_r).astype(numpy.int32)
+        r1 = numpy.clip(r1, lo_r, hi_r).astype(numpy.int32)
+
+        dr0 = numpy.empty_like(r0)
+        dr1 = numpy.empty_like(r1)
+        if len(r0):
+            dr0[0] = r0[0] - int(round(self.r0))
+            dr1[0] = r1[0] - int(round(self.r1))
+            dr0[1:] = r0[1:] - r0[:-1]
+            dr1[1:] = r1[1:] - r1[:-1]
+
+        violations = {"x_margin": x_bad, "y_margin": y_bad,
+                      "r_min": r_min, "r_max": r_max}
+        return (r0, r1, dr0, dr1, violations)
+
+    def _batch_kinematics_py(self, xy, lo_r, hi_r, x_lo, x_hi, y_lo, y_hi):
+        W = self.canvasWidth
+        r0s, r1s, dr0s, dr1s = [], [], [], []
+        violations = {"x_margin": [], "y_margin": [], "r_min": [], "r_max": []}
+
+        p0 = int(round(self.r0))
+        p1 = int(round(self.r1))
+        for (ax, ay) in xy:
+            x = ax + self.marginXL
+            y = ay + self.marginYT
+
+            violations["x_margin"].append(x < x_lo or x > x_hi)
+            violations["y_margin"].append(y < y_lo or y > y_hi)
+            x = min(max(x, x_lo), x_hi)
+            y = min(max(y, y_lo), y_hi)
+
+            r0 = math.floor(math.sqrt(x*x + y*y)/self.stepMM + 0.5)
+            r1 = math.floor(math.sqrt((W-x)*(W-x) + y*y)/self.stepMM + 0.5)
+
+            violations["r_min"].append(r0 < lo_r or r1 < lo_r)
+            violations["r_max"].append(r0 > hi_r or r1 > hi_r)
+            r0 = int(min(max(r0, lo_r), hi_r))
+            r1 = int(min(max(r1, lo_r), hi_r))
+
+            r0s.append(r0)
+            r1s.append(r1)
+            dr0s.append(r0 - p0)
+            dr1s.append(r1 - p1)
+            p0, p1 = r0, r1
+
+        return (r0s, r1s, dr0s, dr1s, violations)
+
+    def go_to_area_batch(self, xy, path=0, node=0):
+        """Move through a run of drawing-area points, as go_to_area()
+        would for each of them, but with one kinematics call and one
+        log line.  Recorded plan commands are tagged with consecutive
+        node numbers starting at [node], or with node[i] for point i
+        if [node] is a list."""
+        r0, r1, dr0, dr1, violations = self.batch_kinematics(xy)
+
+        n = len(r0)
+        if not n:
+            return
+
+        clipped = []
+        for k, m in sorted(violations.items()):
+            if numpy is not None:
+                c = int(numpy.count_nonzero(m))
+            else:
+                c = sum(m)
+            if c:
+                clipped.append("%d %s" % (c, k))
+        if clipped:
+            self.log.warn("MOVE/ batch of %d points to <%d, %d>, clipped: %s",
+                          n, r0[-1], r1[-1], ", ".join(clipped))
+        else:
+            self.log.debug("MOVE/ batch of %d points to <%d, %d>", n, r0[-1], r1[-1])
+
+        for i in xrange(n):
+            if isinstance(node, list):
+                self.cursor = (path, node[i])
+            else:
+                self.cursor = (path, node + i)
+            self._move_to(int(r0[i]), int(r1[i]))
+
     def go_to_area(self, x,y):
         xp = x + self.marginXL
         yp = y + self.marginYT
@@ -316,26 +816,67 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
         r0p = self.calc_r0(xp,yp)
         r1p = self.calc_r1(xp,yp)
 
-
-        command_summary = {
-            "dest_area": (x,y),
-            "dest_abs": (xp,yp),
-            "cur_r": (self.r0,self.r1),
-            "dest_r": (r0p, r1p),
-            }
-            
-
-        self.alert("MOVE/ " + json.dumps(command_summary))
+        self.log.debug("MOVE/ area (%.2f, %.2f), abs (%.2f, %.2f), <%d, %d> to <%d, %d>",
+                       x, y, xp, yp, self.r0, self.r1, r0p, r1p)
         self.cmd_move_rs(r0p, r1p)
 
 
     def _query(self, s):
+        if self.pipeline:
+            self.pipeline.flush()  # the reply has to be to this command
+
+        return self._send(s, wait=True)
+
+    def _command(self, s, dr0=0, dr1=0):
+        """Send a command whose reply we don't need to wait for;
+        (dr0, dr1) is the move it makes, if any."""
+        mark = self.mark
+        self.mark = None
+        if self.pipeline:
+            self.pipeline.put(s, dr0, dr1, mark)
+            return "-queued-"
+
+        return self._send(s, dr0, dr1, mark=mark)
+
+    def _send(self, s, dr0=0, dr1=0, mark=None, wait=False):
+        """Write one command to the device; this is the send stage"""
+        steps = max(abs(dr0), abs(dr1))
+        self.log.command(s)
+        self.telemetry.command(s, steps)
+        if self.sender:
+            if wait:
+                return self.sender.query(s)
+            self.sender.send(s, steps=steps, mark=mark)
+            return "-streamed-"
+
+        t0 = time.time()
         self.serial_fd.write(s + "\n")
-        if self.has_serial:
-            return self.serial_fd.readline().strip()
-        else:
+        t1 = time.time()
+        self.telemetry.record("write", t1 - t0)
+        if not self.has_serial:
+            if mark:
+                mark()
             return "-null serial-"
 
+        self.telemetry.device_busy(t0)
+        retval = self.serial_fd.readline().strip()
+        t2 = time.time()
+        self.telemetry.record("reply", t2 - t1)
+        if not wait and not self.acks and not self.queue_slots:
+            # The reply came before the move; wait it out
+            time.sleep(self.move_wait(dr0, dr1))
+            t3 = time.time()
+            self.telemetry.record("sleep", t3 - t2)
+            t2 = t3
+        self.telemetry.device_idle(t2)
+        if mark:
+            mark()
+        return retval
+
+    def telemetry_status(self):
+        """Live counters and timings, as for telemetryFile"""
+        return self.telemetry.status()
+
 
     ####################
     # Command wrappers
@@ -355,47 +896,78 @@ Cursor: <%.1f,%.1f>, which is  (%.2f,%.2f), (%.2f,%.2f) in print area.""" % (
     def cmd_move_rs(self, r0, r1):
         dr0 = r0 - self.r0
         dr1 = r1 - self.r1
-        self.alert("CMD: WALK: Dest <%d, %d>, delta d<%d, %d>" % (r0, r1, dr0, dr1))
+        self.log.debug("CMD: WALK: Dest <%d, %d>, delta d<%d, %d>", r0, r1, dr0, dr1)
+        self._move_to(r0, r1)
+
+    def _move_to(self, r0, r1):
+        dr0 = r0 - self.r0
+        dr1 = r1 - self.r1
         self.r0 = r0
         self.r1 = r1
 
+        if self.optimizer:
+            self.optimizer.move(dr0, dr1)
+        else:
+            self._emit_move(dr0, dr1)
+
+    def _emit_move(self, dr0, dr1):
+        if self.plan:
+            self.plan.move(dr0, dr1, *self.cursor)
+        if self.simulator:
+            self.simulator.move(dr0, dr1)
+
         q = "r %d %d" % (dr0, dr1)
-        retval = self._query(q)
-        if self.has_serial:
-            time.sleep(max(abs(dr0),abs(dr1))*0.005)
-        self.alert(" %s  => %s" % (q.strip(), retval))
+        retval = self._command(q, dr0, dr1)
+        self.log.trace(" %s  => %s", q, retval)
+
+    def _emit_pen(self, up):
+        if self.plan:
+            self.plan.pen(up, *self.cursor)
+        if self.simulator:
+            self.simulator.pen(up)
+
+        if up:
+            return self._command("p u")
+        return self._command("p d")
         
 
     def cmd_move_r0(self, n):
-        self.alert("CMD: WALK R0: %d" % n)
+        self.log.debug("CMD: WALK R0: %d", n)
         self.cmd_move_rs(self.r0+n, self.r1)
 
     def cmd_move_r1(self, n):
-        self.alert("CMD: WALK R1: %d" % n)
+        self.log.debug("CMD: WALK R1: %d", n)
         self.cmd_move_rs(self.r0, self.r1+n)
 
     def cmd_version(self):
         self.alert("CMD: VERSION QUERY")
 
+        if self.optimizer:
+            self.optimizer.flush()
+
         if self.has_serial:
             return self._query("v")
 
         return "v0.1"
 
     def cmd_button_down(self):
-        self.alert("CMD: BUTTON DOWN?")
+        self.log.debug("CMD: BUTTON DOWN?")
         return False
 
     def cmd_pen_up(self):
-        self.alert("CMD: RAISE PEN")
-        return self._query("p u")
+        self.log.debug("CMD: RAISE PEN")
+        if self.optimizer:
+            return self.optimizer.pen(True)
+        return self._emit_pen(True)
 
     def cmd_pen_down(self):
-        self.alert("CMD: LOWER PEN")
-        return self._query("p d")
+        self.log.debug("CMD: LOWER PEN")
+        if self.optimizer:
+            return self.optimizer.pen(False)
+        return self._emit_pen(False)
     
     def cmd_pen_toggle(self):
-        self.alert("CMD: TOGGLE PEN")
+        self.log.debug("CMD: TOGGLE PEN")
 
     def cmd_scram(self):
         self.alert("CMD: SCRAM!")
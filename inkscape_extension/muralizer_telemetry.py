@@ -0,0 +1,194 @@
+import bisect
+import collections
+import csv
+import json
+import os
+import threading
+import time
+
+# Where the plot's time goes, command by command.
+#
+# For every command written to the device we record how long the
+# serial write took, how long the firmware took to reply ("Rotating
+# ...", "Pen up"), how long the host then slept waiting on the motors,
+# and how long the device sat with nothing to do before the command
+# arrived.  Each of those goes into a histogram, next to command and
+# step counters, so a slow plot can be pinned on the right stage:
+#
+#   idle    the device waited on the host: planning, or the pipeline
+#   write   the serial link (or the OS) was slow to take the bytes
+#   reply   the firmware was slow to answer: motors, or a full window
+#   sleep   the host's guess at how long a move takes
+#
+# status() is cheap enough to call live; export() writes the lot as
+# JSON, or as CSV if the path ends in .csv.
+
+# Histogram bucket bounds, seconds: 0.1 ms doubling up to about 100 s
+BUCKET_BOUNDS = [0.0001*2**k for k in range(21)]
+
+HISTOGRAMS = ("idle", "write", "reply", "sleep")
+
+RATE_WINDOW_S = 10.0  # for the live steps-per-second figure
+
+
+def numbered_path(path, i):
+    """[path] with [i] before its extension: plot.json -> plot.1.json"""
+    (base, ext) = os.path.splitext(path)
+    return "%s.%d%s" % (base, i, ext)
+
+
+class Histogram:
+    """Counts of durations, in buckets bounded by BUCKET_BOUNDS"""
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)  # the last is for overflow
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, v):
+        self.counts[bisect.bisect_left(self.bounds, v)] += 1
+        self.count += 1
+        self.total += v
+        if v > self.max:
+            self.max = v
+
+    def percentile(self, p):
+        """The bucket bound below which [p] percent of values fall"""
+        if not self.count:
+            return 0.0
+        want = p/100.0*self.count
+        seen = 0
+        for (i, c) in enumerate(self.counts):
+            seen += c
+            if seen >= want and c:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "total_s": self.total,
+            "mean_s": self.count and self.total/self.count or 0.0,
+            "p50_s": self.percentile(50),
+            "p90_s": self.percentile(90),
+            "p99_s": self.percentile(99),
+            "max_s": self.max,
+        }
+
+    def buckets(self):
+        """(upper bound, count) for each bucket; None bounds the last"""
+        return zip(self.bounds + [None], self.counts)
+
+
+class Telemetry:
+    """Per-command timings and counters for one device
+
+    The send stage records from its own thread, so everything here
+    takes the lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.t_start = time.time()
+            self.histograms = dict((k, Histogram()) for k in HISTOGRAMS)
+            self.commands = 0
+            self.moves = 0
+            self.pen = 0
+            self.steps = 0
+            self.idle_since = None
+            self.recent = collections.deque()  # (time, steps) of recent moves
+
+    def command(self, line, steps=0):
+        """Count command [line], about to be written"""
+        now = time.time()
+        steps = int(steps)
+        with self.lock:
+            self.commands += 1
+            if steps:
+                self.moves += 1
+                self.steps += steps
+                self.recent.append((now, steps))
+                while now - self.recent[0][0] > RATE_WINDOW_S:
+                    self.recent.popleft()
+            elif line.startswith("p "):
+                self.pen += 1
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.histograms[name].add(seconds)
+
+    def device_idle(self, t=None):
+        """The device has just run out of commands"""
+        with self.lock:
+            self.idle_since = t or time.time()
+
+    def device_busy(self, t=None):
+        """A command is going to an idle device: record how long it
+        waited, if we know"""
+        with self.lock:
+            if self.idle_since is not None:
+                self.histograms["idle"].add(max(0.0, (t or time.time()) - self.idle_since))
+                self.idle_since = None
+
+    def status(self):
+        """Counters and histogram summaries so far"""
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.t_start, 1e-6)
+            while self.recent and now - self.recent[0][0] > RATE_WINDOW_S:
+                self.recent.popleft()
+            window = min(RATE_WINDOW_S, elapsed)
+            return {
+                "elapsed_s": elapsed,
+                "commands": self.commands,
+                "moves": self.moves,
+                "pen": self.pen,
+                "steps": self.steps,
+                "steps_per_s": self.steps/elapsed,
+                "recent_steps_per_s": sum(s for (t, s) in self.recent)/window,
+                "histograms": dict((k, h.stats()) for (k, h) in self.histograms.items()),
+            }
+
+    def as_dict(self):
+        d = self.status()
+        with self.lock:
+            d["buckets"] = dict((k, h.buckets()) for (k, h) in self.histograms.items())
+        return d
+
+    def export(self, path):
+        """Write everything to [path]: CSV if it ends in .csv, else JSON"""
+        d = self.as_dict()
+        fd = open(path, "wb")
+        try:
+            if not path.lower().endswith(".csv"):
+                json.dump(d, fd, indent=1)
+                return
+
+            w = csv.writer(fd)
+            w.writerow(["histogram", "le_s", "count"])
+            for k in HISTOGRAMS:
+                for (le, c) in d["buckets"][k]:
+                    w.writerow([k, le is None and "inf" or "%g" % le, c])
+            w.writerow([])
+            w.writerow(["counter", "value"])
+            for k in ("elapsed_s", "commands", "moves", "pen", "steps", "steps_per_s"):
+                w.writerow([k, d[k]])
+        finally:
+            fd.close()
+
+    def summary(self):
+        s = self.status()
+        h = s["histograms"]
+        return ("Telemetry: %d commands, %d steps at %.1f steps/s; "
+                "reply p50 %.3f s, p99 %.3f s; device idle %.1f s, "
+                "host sleeping %.1f s, writing %.1f s"
+                % (s["commands"], s["steps"], s["steps_per_s"],
+                   h["reply"]["p50_s"], h["reply"]["p99_s"],
+                   h["idle"]["total_s"], h["sleep"]["total_s"],
+                   h["write"]["total_s"]))
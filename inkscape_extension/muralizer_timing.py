@@ -0,0 +1,176 @@
+import json
+import os
+import time
+
+from muralizer_sim import FIRMWARE_STEPS_PER_REV, FIRMWARE_RPM, PEN_DELAY_S, \
+    BAUD, BITS_PER_BYTE
+
+# How long this machine takes to do things, measured.
+#
+# On paper a move takes max(|dr0|, |dr1|) steps of 25 ms, but every
+# machine is a bit different: spin_bresenham() calls Stepper.step()
+# for each motor in turn, each call has its own overhead, and the pen
+# servo delay is whatever the firmware says it is.  Calibration runs a
+# set of test moves with completion acks on, times each one from the
+# write to its "Done" (less the time its bytes spend on the wire), and
+# fits
+#
+#   t = overhead + major*step_s + minor*minor_step_s
+#
+# by least squares, where major and minor are the larger and smaller
+# of |dr0| and |dr1|.  Pen time is the mean of a few timed "p u"s.
+#
+# Models are kept in TIME_MODEL_FILE by serial port, the most recent
+# also as the default.  PlotSimulator uses one for its estimates, and
+# with firmware that can't ack, MuralizerState sleeps for the model's
+# move time instead of a fixed 5 ms a step.
+
+TIME_MODEL_FILE = os.path.expanduser("~/.muralizer_timing.json")
+
+# Test moves, each followed by its reverse so the gondola ends up
+# where it started
+CALIBRATION_MOVES = [(dr0*d, dr1*d) for d in (1, 3, 8, 20)
+                     for (dr0, dr1) in ((1, 0), (0, 1), (1, 1), (2, 1), (1, -2))]
+CALIBRATION_PEN = 3  # timed pen lifts
+
+
+class TimeModel:
+    """Move and pen durations for one machine"""
+    def __init__(self, overhead_s=0.0, step_s=None, minor_step_s=0.0,
+                 pen_s=PEN_DELAY_S, samples=0):
+        if step_s is None:
+            step_s = 60.0/(FIRMWARE_RPM*FIRMWARE_STEPS_PER_REV)
+        self.overhead_s = overhead_s
+        self.step_s = step_s
+        self.minor_step_s = minor_step_s
+        self.pen_s = pen_s
+        self.samples = samples
+
+    def move_time(self, dr0, dr1=0):
+        """Seconds for the firmware to do move (dr0, dr1)"""
+        a = abs(dr0)
+        b = abs(dr1)
+        if a < b:
+            (a, b) = (b, a)
+        if not a:
+            return 0.0
+        return self.overhead_s + a*self.step_s + b*self.minor_step_s
+
+    def as_dict(self):
+        return {"overhead_s": self.overhead_s, "step_s": self.step_s,
+                "minor_step_s": self.minor_step_s, "pen_s": self.pen_s,
+                "samples": self.samples}
+
+    def summary(self):
+        return ("Timing: %.1f ms a step (%.1f ms a minor step) plus %.1f ms a move, "
+                "pen %.2f s, from %d samples" %
+                (1000*self.step_s, 1000*self.minor_step_s, 1000*self.overhead_s,
+                 self.pen_s, self.samples))
+
+
+def fit_time_model(moves, pens=()):
+    """A TimeModel fitted to [moves], (dr0, dr1, seconds) each, and
+    [pens], seconds each"""
+    # Normal equations for t = c0 + c1*major + c2*minor
+    rows = []
+    for (dr0, dr1, t) in moves:
+        a = abs(dr0)
+        b = abs(dr1)
+        if a < b:
+            (a, b) = (b, a)
+        rows.append((1.0, float(a), float(b), t))
+
+    m = [[sum(r[i]*r[j] for r in rows) for j in range(3)] +
+         [sum(r[i]*r[3] for r in rows)] for i in range(3)]
+
+    # Gaussian elimination with partial pivoting
+    for i in range(3):
+        p = max(range(i, 3), key=lambda k: abs(m[k][i]))
+        if abs(m[p][i]) < 1e-12:
+            raise Exception("Not enough different moves to fit a timing model")
+        (m[i], m[p]) = (m[p], m[i])
+        for k in range(i + 1, 3):
+            f = m[k][i]/m[i][i]
+            m[k] = [x - f*y for (x, y) in zip(m[k], m[i])]
+    c = [0.0]*3
+    for i in (2, 1, 0):
+        c[i] = (m[i][3] - sum(m[i][j]*c[j] for j in range(i + 1, 3)))/m[i][i]
+
+    pen_s = pens and sum(pens)/len(pens) or PEN_DELAY_S
+    return TimeModel(max(c[0], 0.0), c[1], max(c[2], 0.0), pen_s,
+                     samples=len(rows) + len(pens))
+
+
+def wire_time(line, reply):
+    """Seconds [line] and [reply] spend on the serial link"""
+    return (len(line) + 1 + len(reply) + 2)*float(BITS_PER_BYTE)/BAUD
+
+
+def calibrate_time_model(ms, alert, moves=CALIBRATION_MOVES, pens=CALIBRATION_PEN):
+    """Time test moves on [ms]'s device and fit a TimeModel to them
+
+    Needs completion acks, and leaves the pen up and the gondola where
+    it found it."""
+    if not ms.acks:
+        raise Exception("Calibration needs firmware with completion acks")
+
+    ms.cmd_pen_up()
+    ms.drain()
+
+    # Time each reply straight off the port, not through the sender's
+    # threads
+    ms.stop_sender()
+
+    def timed(line):
+        t0 = time.time()
+        reply = ms._query(line)
+        return time.time() - t0 - wire_time(line, reply)
+
+    try:
+        move_samples = []
+        for (dr0, dr1) in moves:
+            for (a, b) in ((dr0, dr1), (-dr0, -dr1)):
+                t = timed("r %d %d" % (a, b))
+                move_samples.append((a, b, t))
+                alert("CALIBRATE: move %d %d took %.3f s" % (a, b, t))
+
+        pen_samples = []
+        for i in range(pens):
+            t = timed("p u")
+            pen_samples.append(t)
+            alert("CALIBRATE: pen up took %.3f s" % t)
+    finally:
+        ms.start_sender()
+
+    return fit_time_model(move_samples, pen_samples)
+
+
+def load_time_model(port=None, path=TIME_MODEL_FILE):
+    """The TimeModel saved for [port], else the latest saved; None if
+    nothing's been calibrated"""
+    try:
+        models = json.load(open(path))
+    except (IOError, OSError, ValueError):
+        return None
+
+    d = (port and models.get(port)) or models.get("default")
+    if not d:
+        return None
+    return TimeModel(**dict((str(k), v) for (k, v) in d.items()))
+
+
+def save_time_model(model, port, path=TIME_MODEL_FILE):
+    try:
+        models = json.load(open(path))
+    except (IOError, OSError, ValueError):
+        models = {}
+
+    models["default"] = model.as_dict()
+    if port:
+        models[port] = model.as_dict()
+
+    fd = open(path, "w")
+    try:
+        json.dump(models, fd, indent=1)
+    finally:
+        fd.close()
@@ -0,0 +1,80 @@
+from simpletransform import parseTransform, composeTransform
+
+# SVG transforms, cheaply.
+#
+# The traversal composes a transform for every node it visits, but
+# most nodes have no transform attribute, and the ones that do tend to
+# repeat a handful of strings.  So parsed transforms are cached by
+# string, the identity is never multiplied through, and applying a
+# matrix to a path is one loop over its points instead of a function
+# call per point.
+#
+# Matrices are simpletransform's [[a, c, e], [b, d, f]] lists.  The
+# ones handed out here may be shared: never modify them in place.
+
+IDENTITY = [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]]
+
+TRANSFORM_CACHE_SIZE = 4096  # distinct transform strings kept parsed
+
+_parsed = {}
+
+
+def is_identity(m):
+    return m is IDENTITY or m == IDENTITY
+
+
+def parse_transform(s):
+    """parseTransform(s), cached by string; IDENTITY if there's none"""
+    if not s:
+        return IDENTITY
+
+    m = _parsed.get(s)
+    if m is None:
+        m = parseTransform(s)
+        if is_identity(m):
+            m = IDENTITY
+        if len(_parsed) >= TRANSFORM_CACHE_SIZE:
+            _parsed.clear()
+        _parsed[s] = m
+    return m
+
+
+def compose_transform(m1, m2):
+    """composeTransform(m1, m2), skipping the work if either is IDENTITY"""
+    if m2 is IDENTITY:
+        return m1
+    if m1 is IDENTITY:
+        return m2
+    return composeTransform(m1, m2)
+
+
+def translate_transform(dx, dy):
+    return [[1.0, 0.0, float(dx)], [0.0, 1.0, float(dy)]]
+
+
+def scale_transform(sx, sy):
+    return [[float(sx), 0.0, 0.0], [0.0, float(sy), 0.0]]
+
+
+def apply_transform(mat, p):
+    """applyTransformToPath(mat, p): transform cubicsuperpath [p] in place"""
+    if is_identity(mat):
+        return
+
+    ((a, c, e), (b, d, f)) = mat
+    if a == 1 and c == 0 and b == 0 and d == 1:
+        # Just a translation, as with most clones
+        for sp in p:
+            for ctl in sp:
+                for pt in ctl:
+                    pt[0] += e
+                    pt[1] += f
+        return
+
+    for sp in p:
+        for ctl in sp:
+            for pt in ctl:
+                x = pt[0]
+                y = pt[1]
+                pt[0] = a*x + c*y + e
+                pt[1] = b*x + d*y + f
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Tests for the binary protocol: op encoding, and FrameSender against
+# a fake device that runs the firmware's frame logic over a noisy line
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import random
+import sys
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+
+import muralizer_binary
+from muralizer_binary import ACK, NAK, FRAME_PAYLOAD, FRAME_SYNC, OP_ASCII, \
+    OP_MOVE, OP_PEN_DOWN, OP_PEN_UP, SHORT_MOVE, FrameSender, crc8, \
+    decode_ops, encode_command, encode_move, frame
+
+
+class NoisyDevice:
+    """Stands in for the serial port and the firmware behind it
+
+    Frames are checked and run as binary_loop() does: a good frame is
+    run and acknowledged, one we've already run is acknowledged again
+    but not run, and a bad one, or one from after a frame we've missed,
+    gets a NAK for the one we want, after which input is dropped until
+    the line goes quiet.  Each byte, either way, is corrupted with
+    probability [noise].  [ops] collects what was run.
+    """
+    QUIET_S = 0.02  # FRAME_QUIET_MS
+    BYTE_TIMEOUT_S = 0.1  # FRAME_BYTE_TIMEOUT_MS
+
+    def __init__(self, noise=0.0, seed=0):
+        self.noise = noise
+        self.rnd = random.Random(seed)
+        self.cond = threading.Condition()
+        self.timeout = None
+        self.baudrate = None
+
+        self.rx = bytearray()
+        self.t_rx = 0.0
+        self.tx = bytearray()
+        self.drop_until = 0.0
+        self.expected_seq = 0
+        self.ops = []
+
+    def _noisy(self, data):
+        out = bytearray(data)
+        for i in range(len(out)):
+            if self.rnd.random() < self.noise:
+                out[i] ^= 1 << self.rnd.randrange(8)
+        return out
+
+    def _reply(self, kind, seq):
+        self.tx += self._noisy([kind, seq, ~seq & 0xFF])
+        self.cond.notifyAll()
+
+    def _nak(self, now):
+        self._reply(NAK, self.expected_seq)
+        self.rx = bytearray()
+        self.drop_until = now + self.QUIET_S
+
+    def _run(self, now):
+        """Take whole frames off the front of [rx]"""
+        while self.rx:
+            if self.rx[0] != FRAME_SYNC:
+                del self.rx[0]
+                continue
+            if len(self.rx) < 3:
+                return
+            (seq, n) = (self.rx[1], self.rx[2])
+            if n > FRAME_PAYLOAD:
+                self._nak(now)
+                return
+            if len(self.rx) < 4 + n:
+                return  # wait for the rest, or BYTE_TIMEOUT_S
+            payload = self.rx[3:3 + n]
+            crc = self.rx[3 + n]
+            del self.rx[:4 + n]
+            if crc != crc8(payload, crc8([seq, n])):
+                self._nak(now)
+                return
+            if seq != self.expected_seq:
+                if (self.expected_seq - seq) & 0xFF < 128:
+                    self._reply(ACK, seq)
+                else:
+                    self._reply(NAK, self.expected_seq)
+                continue
+            self.ops.extend(op for op in decode_ops(payload) if op[0] != OP_ASCII)
+            self._reply(ACK, seq)
+            self.expected_seq = (self.expected_seq + 1) & 0xFF
+
+    def write(self, data):
+        self.cond.acquire()
+        try:
+            now = time.time()
+            if now < self.drop_until:
+                self.drop_until = now + self.QUIET_S
+                return
+            self.rx += self._noisy(bytearray(data))
+            self.t_rx = now
+            self._run(now)
+        finally:
+            self.cond.release()
+
+    def read(self, n):
+        self.cond.acquire()
+        try:
+            t_end = time.time() + (self.timeout or 0.25)
+            while not self.tx:
+                now = time.time()
+                if self.rx and now - self.t_rx > self.BYTE_TIMEOUT_S:
+                    self._nak(now)  # a frame that never finished
+                    continue
+                if now >= t_end:
+                    return b""
+                self.cond.wait(min(t_end - now, self.BYTE_TIMEOUT_S))
+            out = self.tx[:n]
+            del self.tx[:n]
+            return bytes(out)
+        finally:
+            self.cond.release()
+
+
+def random_commands(rnd, n):
+    """[n] ASCII commands, with pen changes, short moves and long ones"""
+    lines = []
+    for i in range(n):
+        if i % 40 == 0:
+            lines.append(rnd.choice(["p u", "p d"]))
+        elif rnd.random() < 0.2:
+            lines.append("r %d %d" % (rnd.randint(-300, 300), rnd.randint(-300, 300)))
+        else:
+            lines.append("r %d %d" % (rnd.randint(-SHORT_MOVE, SHORT_MOVE),
+                                      rnd.randint(-SHORT_MOVE, SHORT_MOVE)))
+    return lines
+
+
+class EncodingTest(unittest.TestCase):
+    def test_move_round_trip(self):
+        for dr0 in range(-20, 21) + [-32767, -300, -128, -64, 63, 64, 127, 128, 300, 32767]:
+            for dr1 in (-32767, -129, -8, -7, -1, 0, 1, 7, 8, 129, 32767):
+                self.assertEqual(decode_ops(encode_move(dr0, dr1)),
+                                 [(OP_MOVE, dr0, dr1)])
+
+    def test_short_moves_take_one_byte(self):
+        for dr0 in range(-SHORT_MOVE, SHORT_MOVE + 1):
+            for dr1 in range(-SHORT_MOVE, SHORT_MOVE + 1):
+                self.assertEqual(len(encode_move(dr0, dr1)), 1)
+        self.assertEqual(encode_move(SHORT_MOVE + 1, 0)[0], OP_MOVE)
+        self.assertEqual(encode_move(0, -SHORT_MOVE - 1)[0], OP_MOVE)
+
+    def test_commands_round_trip(self):
+        rnd = random.Random(1)
+        lines = random_commands(rnd, 500)
+        payload = bytearray()
+        expect = []
+        for line in lines:
+            payload += encode_command(line)
+            f = line.split()
+            if f[0] == "r":
+                expect.append((OP_MOVE, int(f[1]), int(f[2])))
+            else:
+                expect.append((f[1] == "u" and OP_PEN_UP or OP_PEN_DOWN, 0, 0))
+        self.assertEqual(decode_ops(payload), expect)
+        self.assertEqual(encode_command("v"), None)
+
+    def test_frame_crc(self):
+        payload = encode_move(3, -300)
+        data = frame(258, payload)
+        self.assertEqual(data[:3], bytearray([FRAME_SYNC, 2, len(payload)]))
+        self.assertEqual(data[-1], crc8(data[1:-1]))
+
+
+class FrameSenderTest(unittest.TestCase):
+    def setUp(self):
+        # Keep resends quick: the fake device runs ops instantly
+        self.saved = (muralizer_binary.ACK_TIMEOUT_S,
+                      muralizer_binary.ACK_TIMEOUT_PER_STEP_S,
+                      muralizer_binary.ACK_TIMEOUT_PER_PEN_S,
+                      muralizer_binary.NAK_RESEND_DELAY_S,
+                      muralizer_binary.MAX_RETRIES)
+        muralizer_binary.ACK_TIMEOUT_S = 0.1
+        muralizer_binary.ACK_TIMEOUT_PER_STEP_S = 0.0
+        muralizer_binary.ACK_TIMEOUT_PER_PEN_S = 0.0
+        muralizer_binary.NAK_RESEND_DELAY_S = 2*NoisyDevice.QUIET_S
+        muralizer_binary.MAX_RETRIES = 50
+
+    def tearDown(self):
+        (muralizer_binary.ACK_TIMEOUT_S,
+         muralizer_binary.ACK_TIMEOUT_PER_STEP_S,
+         muralizer_binary.ACK_TIMEOUT_PER_PEN_S,
+         muralizer_binary.NAK_RESEND_DELAY_S,
+         muralizer_binary.MAX_RETRIES) = self.saved
+
+    def run_commands(self, noise, seed, n):
+        rnd = random.Random(seed)
+        lines = random_commands(rnd, n)
+        device = NoisyDevice(noise, seed)
+        sender = FrameSender(device)
+        marks = []
+        for (i, line) in enumerate(lines):
+            sender.send(line, steps=line[0] == "r" and 1 or 0,
+                        mark=lambda i=i: marks.append(i))
+        sender.drain()
+        sender.close()
+        self.assertEqual(device.ops, decode_ops(
+            bytearray().join(encode_command(line) for line in lines)))
+        self.assertEqual(marks, range(n))
+        return sender
+
+    def test_clean_line(self):
+        sender = self.run_commands(0.0, 2, 2000)
+        self.assertEqual(sender.n_resent, 0)
+        self.assertEqual(sender.n_naks, 0)
+
+    def test_noisy_line(self):
+        sender = self.run_commands(0.003, 3, 2000)
+        self.assertTrue(sender.n_resent > 0)
+
+    def test_very_noisy_line(self):
+        self.run_commands(0.01, 4, 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Tests for CommandOptimizer: whatever it drops or merges, the machine
+# must end up in the same places with the pen in the same state, and
+# draw the same lines
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import random
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+
+from muralizer_peephole import MAX_MOVE_STEPS, CommandOptimizer
+
+
+def random_stream(rnd, n):
+    """[n] commands like the traversal's: ("m", dr0, dr1) or ("p", up),
+    with redundant pen changes, zero-step moves, straight runs, and
+    pen-up travel long enough to hit the step limit"""
+    cmds = []
+    while len(cmds) < n:
+        r = rnd.random()
+        if r < 0.15:
+            cmds.append(("p", rnd.random() < 0.5))
+        elif r < 0.25:
+            cmds.append(("m", 0, 0))
+        elif r < 0.45:
+            (d0, d1) = (rnd.randint(-5, 5), rnd.randint(-5, 5))
+            for i in range(rnd.randint(2, 6)):
+                k = rnd.randint(1, 3)
+                cmds.append(("m", k*d0, k*d1))
+        elif r < 0.5:
+            cmds.append(("m", rnd.choice([-1, 1])*rnd.randint(20000, MAX_MOVE_STEPS),
+                         rnd.randint(-20000, 20000)))
+        else:
+            cmds.append(("m", rnd.randint(-9, 9), rnd.randint(-9, 9)))
+    return cmds
+
+
+def play(cmds):
+    """Where a stream takes the machine: the final (position, pen),
+    the (position, pen) at each pen change, and the vertices of each
+    pen-down stroke, dropping repeats"""
+    pos = (0, 0)
+    pen = None
+    changes = []
+    strokes = []
+    for c in cmds:
+        if c[0] == "p":
+            if c[1] != pen:
+                pen = c[1]
+                changes.append((pos, pen))
+                if not pen:
+                    strokes.append([pos])
+        else:
+            pos = (pos[0] + c[1], pos[1] + c[2])
+            if pen is False and pos != strokes[-1][-1]:
+                strokes[-1].append(pos)
+    return ((pos, pen), changes, strokes)
+
+
+def on_segment(p, a, b):
+    """True if p is on the line from a to b"""
+    cross = (b[0] - a[0])*(p[1] - a[1]) - (b[1] - a[1])*(p[0] - a[0])
+    dot = (p[0] - a[0])*(b[0] - a[0]) + (p[1] - a[1])*(b[1] - a[1])
+    return cross == 0 and 0 <= dot <= (b[0] - a[0])**2 + (b[1] - a[1])**2
+
+
+class CommandOptimizerTest(unittest.TestCase):
+    def optimize(self, cmds):
+        out = []
+        opt = CommandOptimizer(lambda dr0, dr1: out.append(("m", dr0, dr1)),
+                               lambda up: out.append(("p", up)))
+        for c in cmds:
+            if c[0] == "p":
+                opt.pen(c[1])
+            else:
+                opt.move(c[1], c[2])
+        opt.flush()
+        return (opt, out)
+
+    def check_stream(self, cmds):
+        (opt, out) = self.optimize(cmds)
+        (end, changes, strokes) = play(cmds)
+        (opt_end, opt_changes, opt_strokes) = play(out)
+
+        self.assertEqual(opt_end, end)
+        self.assertEqual(opt_changes, changes)
+
+        # Each stroke keeps its ends and corners; only points on the
+        # way along a straight line go
+        self.assertEqual(len(opt_strokes), len(strokes))
+        for (s, o) in zip(strokes, opt_strokes):
+            self.assertEqual((o[0], o[-1]), (s[0], s[-1]))
+            j = 0
+            for p in s:
+                if p == o[j]:
+                    j += 1
+                    if j == len(o):
+                        break
+                else:
+                    self.assertTrue(on_segment(p, o[j - 1], o[j]))
+            self.assertEqual(j, len(o))
+
+        # Nothing that does nothing gets through
+        pen = None
+        for c in out:
+            if c[0] == "p":
+                self.assertNotEqual(c[1], pen)
+                pen = c[1]
+            else:
+                self.assertNotEqual(c[1:], (0, 0))
+                self.assertTrue(abs(c[1]) <= MAX_MOVE_STEPS and abs(c[2]) <= MAX_MOVE_STEPS)
+
+        s = opt.stats()
+        self.assertEqual((s["moves_in"], s["pens_in"]),
+                         (sum(c[0] == "m" for c in cmds), sum(c[0] == "p" for c in cmds)))
+        self.assertEqual((s["moves_out"], s["pens_out"]),
+                         (sum(c[0] == "m" for c in out), sum(c[0] == "p" for c in out)))
+        return (opt, out)
+
+    def test_random_streams(self):
+        for seed in range(20):
+            (opt, out) = self.check_stream(random_stream(random.Random(seed), 2000))
+            self.assertTrue(len(out) < 2000)
+
+    def test_merges(self):
+        up = [("p", True), ("m", 3, 4), ("m", -10, 2), ("m", 7, -6), ("m", 5, 5)]
+        self.assertEqual(self.check_stream(up)[1], [("p", True), ("m", 5, 5)])
+
+        down = [("p", False), ("m", 1, 2), ("m", 0, 0), ("m", 2, 4), ("m", -1, -2),
+                ("p", False), ("m", 3, 1)]
+        self.assertEqual(self.check_stream(down)[1],
+                         [("p", False), ("m", 3, 6), ("m", -1, -2), ("m", 3, 1)])
+
+    def test_step_limit(self):
+        cmds = [("p", True)] + [("m", 20000, -20000)]*5
+        out = self.check_stream(cmds)[1]
+        self.assertEqual(len(out), 6)
+
+    def test_round_trip_travel(self):
+        cmds = [("p", True), ("m", 100, 5), ("m", -100, -5), ("p", False)]
+        self.assertEqual(self.check_stream(cmds)[1], [("p", True), ("p", False)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# Tests for compiled plans: PlanWriter to PlanReader, and checkpoints
+#
+#   python -m unittest discover -s tests
+#
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "inkscape_extension"))
+
+from muralizer_plan import CHECKPOINT_EVERY, CHECKPOINT_SUFFIX, OP_MOVE, \
+    OP_PEN_DOWN, OP_PEN_UP, PLAN_MACHINE_OPTIONS, WRITE_BATCH, Checkpoint, \
+    PlanOptions, PlanReader, PlanWriter
+
+MACHINE = dict(canvasWidth=122, canvasHeight=183, marginXL=23, marginXR=23,
+               marginYT=23.5, stepsPerRev=48, spoolDiameter=63)
+
+
+class PlanTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.plan")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_plan(self, n, seed=0):
+        """A plan of [n] random records; and the records"""
+        rnd = random.Random(seed)
+        w = PlanWriter(self.path, PlanOptions(**MACHINE), 1234, -56)
+        expect = []
+        for i in range(n):
+            if rnd.random() < 0.1:
+                up = rnd.random() < 0.5
+                w.pen(up, i//100, i % 100)
+                expect.append((up and OP_PEN_UP or OP_PEN_DOWN, 0, 0, i//100, i % 100))
+            else:
+                (dr0, dr1) = (rnd.randint(-40000, 40000), rnd.randint(-40000, 40000))
+                w.move(dr0, dr1, i//100, i % 100)
+                expect.append((OP_MOVE, dr0, dr1, i//100, i % 100))
+        w.close()
+        return expect
+
+    def test_round_trip(self):
+        # Enough records to need more than one batch
+        expect = self.write_plan(2*WRITE_BATCH + 7)
+        plan = PlanReader(self.path)
+        try:
+            self.assertEqual(len(plan), len(expect))
+            self.assertEqual(plan.start, (1234, -56))
+            self.assertEqual(list(plan.records()), expect)
+            self.assertEqual(list(plan.records(WRITE_BATCH + 3)), expect[WRITE_BATCH + 3:])
+            self.assertEqual(plan[0], expect[0])
+            self.assertEqual(plan[-1], expect[-1])
+            self.assertRaises(IndexError, lambda: plan[len(expect)])
+
+            opts = plan.options(logLevel="error")
+            for k in PLAN_MACHINE_OPTIONS:
+                self.assertEqual(getattr(opts, k), MACHINE[k])
+            self.assertEqual(opts.logLevel, "error")
+        finally:
+            plan.close()
+
+    def test_empty_plan(self):
+        self.write_plan(0)
+        plan = PlanReader(self.path)
+        self.assertEqual(len(plan), 0)
+        self.assertEqual(list(plan.records()), [])
+        plan.close()
+
+    def test_truncated_plan(self):
+        self.write_plan(100)
+        fd = open(self.path, "r+b")
+        fd.truncate(os.path.getsize(self.path) - 1)
+        fd.close()
+        self.assertRaises(Exception, PlanReader, self.path)
+
+    def test_not_a_plan(self):
+        fd = open(self.path, "wb")
+        fd.write("<svg/>" * 100)
+        fd.close()
+        self.assertRaises(Exception, PlanReader, self.path)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "test.plan")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        Checkpoint(self.path, 300, 1000, -200, False).save()
+        cp = Checkpoint.load(self.path)
+        self.assertEqual((cp.plan_path, cp.offset, cp.r0, cp.r1, cp.pen_up),
+                         (self.path, 300, 1000, -200, False))
+        self.assertTrue(cp.positioned())
+
+    def test_unpositioned(self):
+        Checkpoint(self.path).save()
+        cp = Checkpoint.load(self.path)
+        self.assertEqual((cp.offset, cp.r0, cp.r1, cp.pen_up), (0, None, None, None))
+        self.assertFalse(cp.positioned())
+
+    def test_missing_or_bad(self):
+        self.assertEqual(Checkpoint.load(self.path), None)
+        fd = open(self.path + CHECKPOINT_SUFFIX, "w")
+        fd.write("{\"plan\": ")
+        fd.close()
+        self.assertEqual(Checkpoint.load(self.path), None)
+
+    def test_update_and_clear(self):
+        cp = Checkpoint(self.path)
+        cp.update(1, 10, 20, True)
+        self.assertEqual(Checkpoint.load(self.path), None)  # not due yet
+        cp.update(CHECKPOINT_EVERY, 30, 40, False)
+        self.assertEqual(Checkpoint.load(self.path).as_dict(), cp.as_dict())
+
+        cp.clear()
+        self.assertFalse(os.path.exists(cp.path()))
+        self.assertEqual(Checkpoint.load(self.path), None)
+        cp.clear()  # twice is fine
+
+
+if __name__ == "__main__":
+    unittest.main()